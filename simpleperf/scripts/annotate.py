@@ -18,17 +18,20 @@
 """annotate.py: annotate source files based on perf.data.
 """
 
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import hashlib
+import io
+import json
 import logging
 import os
 import os.path
-import shutil
 from texttable import Texttable
-from typing import Dict, Union
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
 
 from simpleperf_report_lib import GetReportLib
 from simpleperf_utils import (
     Addr2Nearestline, BaseArgumentParser, BinaryFinder, extant_dir, flatten_arg_list, is_windows,
-    log_exit, ReadElf, SourceFileSearcher)
+    log_exit, ReadElf, ReportLibOptions, SourceFileSearcher, StageProfiler)
 
 
 class SourceLine(object):
@@ -141,6 +144,70 @@ class FilePeriod(object):
         a[1] += period
 
 
+# Periods of source files, functions and lines, in json format.
+LINE_PERIOD_INDEX_FILE = 'line_periods.json'
+
+# A frame in a sample projection: (dso_id, symbol_addr, vaddr_in_file).
+ProjectedFrame = Tuple[int, int, int]
+
+
+class SampleProjection(object):
+    """ A compact projection of samples in a record file, keeping only what is needed to
+        generate periods. Frames not passing the dso filter are dropped, and samples with the
+        same frames are merged by adding up their periods.
+        dsos: a list of (dso_name, build_id), indexed by dso_id.
+        callchains: a map from (frames, has_self_frame) to the period of samples. frames are
+                    ordered from the sample ip to the callers. has_self_frame is True if the
+                    first frame is the sample ip, which takes the self period.
+    """
+
+    def __init__(self):
+        self.dsos: List[Tuple[str, str]] = []
+        self.callchains: Dict[Tuple[Tuple[ProjectedFrame, ...], bool], int] = {}
+
+
+def collect_sample_projection(
+        perf_data: str, symfs_dir: Optional[str], kallsyms: Optional[str],
+        report_lib_options: ReportLibOptions, dso_filter: Optional[Set[str]]) -> SampleProjection:
+    """ Read samples in a record file. It is a module level function to run in worker
+        processes.
+    """
+    projection = SampleProjection()
+    dso_ids: Dict[str, int] = {}
+    lib = GetReportLib(perf_data)
+    if symfs_dir:
+        lib.SetSymfs(symfs_dir)
+    if kallsyms:
+        lib.SetKallsymsFile(kallsyms)
+    lib.SetReportOptions(report_lib_options)
+    while True:
+        sample = lib.GetNextSample()
+        if sample is None:
+            lib.Close()
+            break
+        symbols = [lib.GetSymbolOfCurrentSample()]
+        callchain = lib.GetCallChainOfCurrentSample()
+        for i in range(callchain.nr):
+            symbols.append(callchain.entries[i].symbol)
+        frames = []
+        has_self_frame = False
+        for j, symbol in enumerate(symbols):
+            dso_name = symbol.dso_name
+            if dso_filter and dso_name not in dso_filter:
+                continue
+            if j == 0:
+                has_self_frame = True
+            dso_id = dso_ids.get(dso_name)
+            if dso_id is None:
+                dso_id = dso_ids[dso_name] = len(projection.dsos)
+                projection.dsos.append((dso_name, lib.GetBuildIdForPath(dso_name)))
+            frames.append((dso_id, symbol.symbol_addr, symbol.vaddr_in_file))
+        if frames:
+            key = (tuple(frames), has_self_frame)
+            projection.callchains[key] = projection.callchains.get(key, 0) + sample.period
+    return projection
+
+
 class SourceFileAnnotator(object):
     """group code for annotating source files"""
 
@@ -165,104 +232,106 @@ class SourceFileAnnotator(object):
 
         config['annotate_dest_dir'] = 'annotated_files'
         output_dir = config['annotate_dest_dir']
-        if os.path.isdir(output_dir):
-            shutil.rmtree(output_dir)
-        os.makedirs(output_dir)
+        # Annotated files of the previous run are kept, so unchanged files don't need to be
+        # written again. Stale files are removed after annotating.
+        self.prev_line_period_index = self._load_line_period_index(output_dir)
+        if os.path.isfile(output_dir):
+            os.remove(output_dir)
+        os.makedirs(output_dir, exist_ok=True)
 
         self.addr2line = Addr2Line(self.config['ndk_path'], symfs_dir, config.get('source_dirs'))
+        # Samples of all record files, projected by collect_sample_projection().
+        self.dso_names: List[str] = []
+        self.dso_ids: Dict[str, int] = {}
+        self.callchains: Dict[Tuple[Tuple[ProjectedFrame, ...], bool], int] = {}
         self.period = 0
         self.dso_periods = {}
         self.file_periods = {}
 
     def annotate(self):
-        self._collect_addrs()
+        with StageProfiler.stage('load samples'):
+            self._collect_addrs()
         self._convert_addrs_to_lines()
-        self._generate_periods()
-        self._write_summary()
-        self._annotate_files()
+        with StageProfiler.stage('generate periods'):
+            self._generate_periods()
+        with StageProfiler.stage('write annotated files'):
+            self._write_summary()
+            self._annotate_files()
 
     def _collect_addrs(self):
         """Read perf.data, collect all addresses we need to convert to
-           source file:line.
+           source file:line. Samples are kept as a SampleProjection, so perf.data only needs
+           to be read once. Record files are read in parallel.
         """
-        for perf_data in self.config['perf_data_list']:
-            lib = GetReportLib(perf_data)
-            if self.symfs_dir:
-                lib.SetSymfs(self.symfs_dir)
-            if self.kallsyms:
-                lib.SetKallsymsFile(self.kallsyms)
-            lib.SetReportOptions(self.config['report_lib_options'])
-            while True:
-                sample = lib.GetNextSample()
-                if sample is None:
-                    lib.Close()
-                    break
-                symbols = []
-                symbols.append(lib.GetSymbolOfCurrentSample())
-                callchain = lib.GetCallChainOfCurrentSample()
-                for i in range(callchain.nr):
-                    symbols.append(callchain.entries[i].symbol)
-                for symbol in symbols:
-                    if self._filter_symbol(symbol):
-                        build_id = lib.GetBuildIdForPath(symbol.dso_name)
-                        self.addr2line.add_addr(symbol.dso_name, build_id, symbol.symbol_addr,
-                                                symbol.vaddr_in_file)
-                        self.addr2line.add_addr(symbol.dso_name, build_id, symbol.symbol_addr,
-                                                symbol.symbol_addr)
-
-    def _filter_symbol(self, symbol):
-        if not self.dso_filter or symbol.dso_name in self.dso_filter:
-            return True
-        return False
+        perf_data_list = self.config['perf_data_list']
+        args = [(perf_data, self.symfs_dir, self.kallsyms, self.config['report_lib_options'],
+                 self.dso_filter) for perf_data in perf_data_list]
+        jobs = min(self.config.get('jobs') or 1, len(perf_data_list))
+        if jobs > 1:
+            with ProcessPoolExecutor(jobs) as executor:
+                futures = [executor.submit(collect_sample_projection, *arg) for arg in args]
+                for future in futures:
+                    self._add_sample_projection(future.result())
+        else:
+            for arg in args:
+                self._add_sample_projection(collect_sample_projection(*arg))
+
+    def _add_sample_projection(self, projection: SampleProjection):
+        # Map dso ids in the projection to dso ids in self.dso_names.
+        dso_id_map = []
+        for dso_name, build_id in projection.dsos:
+            dso_id = self.dso_ids.get(dso_name)
+            if dso_id is None:
+                dso_id = self.dso_ids[dso_name] = len(self.dso_names)
+                self.dso_names.append(dso_name)
+            dso_id_map.append((dso_id, dso_name, build_id))
+
+        added_frames: Set[ProjectedFrame] = set()
+        for (frames, has_self_frame), period in projection.callchains.items():
+            new_frames = []
+            for frame in frames:
+                dso_id, dso_name, build_id = dso_id_map[frame[0]]
+                new_frame = (dso_id, frame[1], frame[2])
+                new_frames.append(new_frame)
+                if new_frame not in added_frames:
+                    added_frames.add(new_frame)
+                    symbol_addr, vaddr_in_file = frame[1], frame[2]
+                    self.addr2line.add_addr(dso_name, build_id, symbol_addr, vaddr_in_file)
+                    self.addr2line.add_addr(dso_name, build_id, symbol_addr, symbol_addr)
+            key = (tuple(new_frames), has_self_frame)
+            self.callchains[key] = self.callchains.get(key, 0) + period
 
     def _convert_addrs_to_lines(self):
         self.addr2line.convert_addrs_to_lines()
 
     def _generate_periods(self):
-        """read perf.data, collect Period for all types:
-            binaries, source files, functions, lines.
+        """collect Period for all types: binaries, source files, functions, lines.
+           It uses samples collected by _collect_addrs(), instead of reading perf.data again.
         """
-        for perf_data in self.config['perf_data_list']:
-            lib = GetReportLib(perf_data)
-            if self.symfs_dir:
-                lib.SetSymfs(self.symfs_dir)
-            if self.kallsyms:
-                lib.SetKallsymsFile(self.kallsyms)
-            lib.SetReportOptions(self.config['report_lib_options'])
-            while True:
-                sample = lib.GetNextSample()
-                if sample is None:
-                    lib.Close()
-                    break
-                self._generate_periods_for_sample(lib, sample)
-
-    def _generate_periods_for_sample(self, lib, sample):
-        symbols = []
-        symbols.append(lib.GetSymbolOfCurrentSample())
-        callchain = lib.GetCallChainOfCurrentSample()
-        for i in range(callchain.nr):
-            symbols.append(callchain.entries[i].symbol)
+        for (frames, has_self_frame), period in self.callchains.items():
+            self._generate_periods_for_callchain(frames, has_self_frame, period)
+
+    def _generate_periods_for_callchain(
+            self, frames: Tuple[ProjectedFrame, ...], has_self_frame: bool, sample_period: int):
         # Each sample has a callchain, but its period is only used once
         # to add period for each function/source_line/source_file/binary.
         # For example, if more than one entry in the callchain hits a
         # function, the event count of that function is only increased once.
         # Otherwise, we may get periods > 100%.
-        is_sample_used = False
         used_dso_dict = {}
         used_file_dict = {}
         used_function_dict = {}
         used_line_dict = {}
-        period = Period(sample.period, sample.period)
-        for j, symbol in enumerate(symbols):
-            if j == 1:
-                period = Period(0, sample.period)
-            if not self._filter_symbol(symbol):
-                continue
-            is_sample_used = True
+        for j, (dso_id, symbol_addr, vaddr_in_file) in enumerate(frames):
+            if j == 0 and has_self_frame:
+                period = Period(sample_period, sample_period)
+            else:
+                period = Period(0, sample_period)
+            dso_name = self.dso_names[dso_id]
             # Add period to dso.
-            self._add_dso_period(symbol.dso_name, period, used_dso_dict)
+            self._add_dso_period(dso_name, period, used_dso_dict)
             # Add period to source file.
-            sources = self.addr2line.get_sources(symbol.dso_name, symbol.vaddr_in_file)
+            sources = self.addr2line.get_sources(dso_name, vaddr_in_file)
             for source in sources:
                 if source.file:
                     self._add_file_period(source, period, used_file_dict)
@@ -270,15 +339,14 @@ class SourceFileAnnotator(object):
                     if source.line:
                         self._add_line_period(source, period, used_line_dict)
             # Add period to function.
-            sources = self.addr2line.get_sources(symbol.dso_name, symbol.symbol_addr)
+            sources = self.addr2line.get_sources(dso_name, symbol_addr)
             for source in sources:
                 if source.file:
                     self._add_file_period(source, period, used_file_dict)
                     if source.function:
                         self._add_function_period(source, period, used_function_dict)
 
-        if is_sample_used:
-            self.period += sample.period
+        self.period += sample_period
 
     def _add_dso_period(self, dso_name: str, period: Period, used_dso_dict: Dict[str, bool]):
         if dso_name not in used_dso_dict:
@@ -379,27 +447,65 @@ class SourceFileAnnotator(object):
             return str(period)
         return '%.2f%%' % (100.0 * period / self.period)
 
+    @staticmethod
+    def _load_line_period_index(output_dir: str) -> Dict[str, Any]:
+        path = os.path.join(output_dir, LINE_PERIOD_INDEX_FILE)
+        if os.path.isfile(path):
+            try:
+                with open(path, 'r') as fh:
+                    return json.load(fh)
+            except ValueError:
+                logging.warning('failed to load %s' % path)
+        return {}
+
     def _annotate_files(self):
         """Annotate Source files: add acc_period/period for each source file.
            1. Annotate java source files, which have $JAVA_SRC_ROOT prefix.
            2. Annotate c++ source files.
+           Files are annotated in parallel. Then periods of all lines are written to
+           LINE_PERIOD_INDEX_FILE, which can be read by other tools.
         """
         dest_dir = self.config['annotate_dest_dir']
-        for key in self.file_periods:
-            from_path = key
-            if not os.path.isfile(from_path):
-                logging.warning("can't find source file for path %s" % from_path)
-                continue
-            if from_path.startswith('/'):
-                to_path = os.path.join(dest_dir, from_path[1:])
-            elif is_windows() and ':\\' in from_path:
-                to_path = os.path.join(dest_dir, from_path.replace(':\\', os.sep))
-            else:
-                to_path = os.path.join(dest_dir, from_path)
-            is_java = from_path.endswith('.java')
-            self._annotate_file(from_path, to_path, self.file_periods[key], is_java)
-
-    def _annotate_file(self, from_path, to_path, file_period, is_java):
+        prev_files = self.prev_line_period_index.get('files', {})
+        futures: Dict[str, Future] = {}
+        with ThreadPoolExecutor(self.config.get('jobs') or 1) as executor:
+            for key in self.file_periods:
+                from_path = key
+                if not os.path.isfile(from_path):
+                    logging.warning("can't find source file for path %s" % from_path)
+                    continue
+                if from_path.startswith('/'):
+                    to_path = os.path.join(dest_dir, from_path[1:])
+                elif is_windows() and ':\\' in from_path:
+                    to_path = os.path.join(dest_dir, from_path.replace(':\\', os.sep))
+                else:
+                    to_path = os.path.join(dest_dir, from_path)
+                is_java = from_path.endswith('.java')
+                futures[key] = executor.submit(
+                    self._annotate_file, from_path, to_path, self.file_periods[key], is_java,
+                    prev_files.get(key))
+            files = {key: future.result() for key, future in futures.items()}
+
+        self._remove_stale_files(dest_dir, [entry['annotated_path'] for entry in files.values()])
+        index = {'total_period': self.period, 'files': files}
+        with open(os.path.join(dest_dir, LINE_PERIOD_INDEX_FILE), 'w') as fh:
+            json.dump(index, fh, indent=1)
+
+    def _remove_stale_files(self, dest_dir: str, annotated_paths: List[str]):
+        """Remove files not generated by this run, like annotated files of the previous run."""
+        keep_paths = {os.path.normpath(path) for path in annotated_paths}
+        keep_paths.add(os.path.normpath(os.path.join(dest_dir, 'summary')))
+        keep_paths.add(os.path.normpath(os.path.join(dest_dir, LINE_PERIOD_INDEX_FILE)))
+        for parent, _, file_names in os.walk(dest_dir, topdown=False):
+            for file_name in file_names:
+                path = os.path.normpath(os.path.join(parent, file_name))
+                if path not in keep_paths:
+                    os.remove(path)
+            if parent != dest_dir and not os.listdir(parent):
+                os.rmdir(parent)
+
+    def _annotate_file(self, from_path, to_path, file_period, is_java,
+                       prev_entry: Optional[Dict[str, Any]]) -> Dict[str, Any]:
         """Annotate a source file.
 
         Annotate a source file in three steps:
@@ -407,10 +513,12 @@ class SourceFileAnnotator(object):
           2. For each function, show periods of this function.
           3. For each line not hitting the same line as functions, show
              line periods.
+        The file isn't written again if both the source file and the annotations are the
+        same as in the previous run.
+        Return an entry of LINE_PERIOD_INDEX_FILE.
         """
-        logging.info('annotate file %s' % from_path)
-        with open(from_path, 'r') as rf:
-            lines = rf.readlines()
+        with open(from_path, 'rb') as rf:
+            data = rf.read()
 
         annotates = {}
         for line in file_period.line_dict.keys():
@@ -423,6 +531,27 @@ class SourceFileAnnotator(object):
             annotates[line] = '[func] ' + self._get_period_str(period)
         annotates[1] = '[file] ' + self._get_period_str(file_period.period)
 
+        entry = {
+            'annotated_path': to_path,
+            'source_hash': hashlib.sha1(data).hexdigest(),
+            'annotate_hash': hashlib.sha1(
+                json.dumps(sorted(annotates.items())).encode('utf-8')).hexdigest(),
+            'period': [file_period.period.period, file_period.period.acc_period],
+            'functions': [[func_name, func_start_line, period.period, period.acc_period]
+                          for func_name, (func_start_line, period)
+                          in sorted(file_period.function_dict.items())],
+            'lines': [[line, period.period, period.acc_period]
+                      for line, period in sorted(file_period.line_dict.items())],
+        }
+        if prev_entry and os.path.isfile(to_path) and all(
+                prev_entry.get(key) == entry[key]
+                for key in ('annotated_path', 'source_hash', 'annotate_hash')):
+            logging.info('skip annotating unchanged file %s' % from_path)
+            return entry
+
+        logging.info('annotate file %s' % from_path)
+        # Split lines the same way as reading the file in text mode.
+        lines = io.StringIO(data.decode('utf-8', errors='replace'), newline=None).readlines()
         max_annotate_cols = 0
         for key in annotates:
             max_annotate_cols = max(max_annotate_cols, len(annotates[key]))
@@ -430,9 +559,11 @@ class SourceFileAnnotator(object):
         empty_annotate = ' ' * (max_annotate_cols + 6)
 
         dirname = os.path.dirname(to_path)
-        if not os.path.isdir(dirname):
-            os.makedirs(dirname)
-        with open(to_path, 'w') as wf:
+        os.makedirs(dirname, exist_ok=True)
+        # Write to a temporary file first, so an interrupted run doesn't leave a truncated file,
+        # which would be skipped as unchanged in the next run.
+        tmp_path = '%s.%d.tmp' % (to_path, os.getpid())
+        with open(tmp_path, 'w') as wf:
             for line in range(1, len(lines) + 1):
                 annotate = annotates.get(line)
                 if annotate is None:
@@ -445,6 +576,8 @@ class SourceFileAnnotator(object):
                         ' ' * (max_annotate_cols - len(annotate))) + ' */'
                 wf.write(annotate)
                 wf.write(lines[line-1])
+        os.replace(tmp_path, to_path)
+        return entry
 
 
 def main():
@@ -457,6 +590,10 @@ def main():
     parser.add_argument('-s', '--source_dirs', type=extant_dir, nargs='+', action='append', help="""
         Directories to find source files.""")
     parser.add_argument('--ndk_path', type=extant_dir, help='Set the path of a ndk release.')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=os.cpu_count(),
+        help="""Use multiprocessing to read multiple profiling data files in parallel, and
+                multithreading to write annotated files.""")
     parser.add_argument('--raw-period', action='store_true',
                         help='show raw period instead of percentage')
     parser.add_argument('--summary-width', type=int, default=80, help='max width of summary file')
@@ -466,6 +603,8 @@ def main():
     parser.add_report_lib_options(sample_filter_group=sample_filter_group)
 
     args = parser.parse_args()
+    if args.jobs < 1:
+        log_exit('Invalid --jobs option.')
     config = {}
     config['perf_data_list'] = flatten_arg_list(args.perf_data_list)
     if not config['perf_data_list']:
@@ -475,6 +614,7 @@ def main():
     config['ndk_path'] = args.ndk_path
     config['raw_period'] = args.raw_period
     config['summary_width'] = args.summary_width
+    config['jobs'] = args.jobs
     config['report_lib_options'] = args.report_lib_options
 
     annotator = SourceFileAnnotator(config)
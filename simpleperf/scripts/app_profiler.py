@@ -21,14 +21,18 @@
     and pulls profiling data and related binaries on host.
 """
 
+import io
 import logging
 import os
 import os.path
 import re
+import shlex
 import subprocess
 import sys
+import tarfile
+import tempfile
 import time
-from typing import Optional
+from typing import Dict, Optional
 
 from simpleperf_utils import (
     AdbHelper, BaseArgumentParser, bytes_to_str, extant_dir, get_script_dir, get_target_binary_path,
@@ -60,7 +64,11 @@ class NativeLibDownloader(object):
     1. Collect info of all native libs in the native_lib_dir on host.
     2. Check the available native libs in /data/local/tmp/native_libs on device.
     3. Sync native libs on device.
+
+    sync_native_libs_in_batch() does step 2 and 3 in a few adb commands: list native libs on
+    device in one shell command, push changed libs in one tar archive, and unpack it on device.
     """
+    ARCHIVE_NAME = 'native_libs.tar'
 
     def __init__(self, ndk_path, device_arch, adb):
         self.adb = adb
@@ -74,6 +82,10 @@ class NativeLibDownloader(object):
         self.name_count_map = {}  # Used to give a unique name for each library.
         self.dir_on_device = NATIVE_LIBS_DIR_ON_DEVICE
         self.build_id_list_file = 'build_id_list'
+        # Map from filename to file size on device, only collected in batch mode.
+        self.device_file_size_map = {}
+        # Map from sync step to time used in seconds.
+        self.timings: Dict[str, float] = {}
 
     def _get_need_archs(self):
         """Return the archs of binaries needed on device."""
@@ -87,13 +99,19 @@ class NativeLibDownloader(object):
             return ['x86']
         return []
 
+    def _add_timing(self, step: str, start_time: float):
+        self.timings[step] = time.time() - start_time
+        logging.info('%s: %.3f s', step, self.timings[step])
+
     def collect_native_libs_on_host(self, native_lib_dir):
+        start_time = time.time()
         self.host_build_id_map.clear()
         for root, _, files in os.walk(native_lib_dir):
             for name in files:
                 if not name.endswith('.so'):
                     continue
                 self.add_native_lib_on_host(os.path.join(root, name), name)
+        self._add_timing('collect native libs on host', start_time)
 
     def add_native_lib_on_host(self, path, name):
         arch = self.readelf.get_arch(path)
@@ -188,6 +206,96 @@ class NativeLibDownloader(object):
                         continue
             self.adb.check_run(['push', entry.path, target])
 
+    def sync_native_libs_in_batch(self) -> bool:
+        """ Sync native libs on device with one listing command, one push and one unpack
+            command. Return False if it isn't supported by the device, then the caller can
+            fall back to collect_native_libs_on_device() and sync_native_libs_on_device().
+        """
+        start_time = time.time()
+        if not self.list_native_libs_on_device():
+            return False
+        self._add_timing('list native libs on device', start_time)
+
+        # Diff the host manifest against the listing on device.
+        files_to_push: Dict[str, str] = {}
+        for build_id, entry in self.host_build_id_map.items():
+            if self.device_build_id_map.get(build_id) != entry.name:
+                files_to_push[entry.name] = entry.path
+        for entry in self.no_build_id_file_map.values():
+            if self.device_file_size_map.get(entry.name) != os.path.getsize(entry.path):
+                files_to_push[entry.name] = entry.path
+        host_names = {entry.name for entry in self.host_build_id_map.values()}
+        host_names.update(self.no_build_id_file_map)
+        files_to_remove = [name for name in self.device_build_id_map.values()
+                           if name not in host_names]
+        if not files_to_push and not files_to_remove and self.device_build_id_map == {
+                build_id: entry.name for build_id, entry in self.host_build_id_map.items()}:
+            logging.info('native libs on device are up to date')
+            return True
+        logging.info('push %d native libs, remove %d native libs on device',
+                     len(files_to_push), len(files_to_remove))
+
+        start_time = time.time()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            archive_path = os.path.join(tmp_dir, self.ARCHIVE_NAME)
+            self.create_archive(archive_path, files_to_push)
+            archive_on_device = self.dir_on_device + self.ARCHIVE_NAME
+            if not self.adb.run(['push', archive_path, archive_on_device]):
+                return False
+        self._add_timing('push native libs', start_time)
+
+        start_time = time.time()
+        cmd = 'cd %s' % shlex.quote(self.dir_on_device)
+        if files_to_remove:
+            cmd += ' && rm -f %s' % ' '.join(shlex.quote(name) for name in files_to_remove)
+        cmd += ' && tar -xf %s; result=$?; rm -f %s; exit $result' % (
+            self.ARCHIVE_NAME, self.ARCHIVE_NAME)
+        if not self.adb.run(['shell', cmd]):
+            return False
+        self._add_timing('unpack native libs on device', start_time)
+        return True
+
+    def list_native_libs_on_device(self) -> bool:
+        """ Read build_id_list and file sizes on device in one shell command. """
+        self.device_build_id_map.clear()
+        self.device_file_size_map.clear()
+        marker = '--file-sizes--'
+        cmd = ('mkdir -p {dir} && cd {dir} && {{ cat {list_file} 2>/dev/null; echo {marker}; ' +
+               'stat -c "%s %n" * 2>/dev/null; true; }}').format(
+            dir=shlex.quote(self.dir_on_device), list_file=self.build_id_list_file,
+            marker=marker)
+        result, output = self.adb.run_and_return_output(['shell', cmd])
+        if not result or marker not in output:
+            return False
+        build_id_list, file_sizes = output.split(marker, 1)
+        for line in file_sizes.splitlines():
+            items = line.strip().split(' ', 1)
+            if len(items) == 2 and items[0].isdigit():
+                self.device_file_size_map[items[1]] = int(items[0])
+        for line in build_id_list.splitlines():
+            items = line.strip().split('=')
+            if len(items) == 2:
+                build_id, filename = items
+                if filename in self.device_file_size_map:
+                    self.device_build_id_map[build_id] = filename
+        return True
+
+    def create_archive(self, archive_path: str, files: Dict[str, str]):
+        """ Create a tar archive containing files and the new build_id_list.
+            files: map from filename on device to path on host.
+        """
+        with tarfile.open(archive_path, 'w') as tar:
+            for name, path in files.items():
+                tar.add(path, arcname=name)
+            data = ''.join('%s=%s\n' % (build_id, entry.name)
+                           for build_id, entry in self.host_build_id_map.items())
+            data = str_to_bytes(data)
+            info = tarfile.TarInfo(self.build_id_list_file)
+            info.size = len(data)
+            info.mode = 0o644
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(data))
+
 
 class ProfilerBase(object):
     """Base class of all Profilers."""
@@ -229,8 +337,10 @@ class ProfilerBase(object):
     def download_libs(self):
         downloader = NativeLibDownloader(self.args.ndk_path, self.device_arch, self.adb)
         downloader.collect_native_libs_on_host(self.args.native_lib_dir)
-        downloader.collect_native_libs_on_device()
-        downloader.sync_native_libs_on_device()
+        if not downloader.sync_native_libs_in_batch():
+            logging.info('failed to sync native libs in batch, sync them one by one')
+            downloader.collect_native_libs_on_device()
+            downloader.sync_native_libs_on_device()
 
     def start(self):
         raise NotImplementedError
@@ -20,18 +20,26 @@
 """
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import ctypes
+import ctypes.util
+import hashlib
+import json
 import logging
 import os
 import os.path
 from pathlib import Path
+import shlex
 import shutil
+import stat
 import sys
-from typing import Dict, List, Optional, Tuple, Union
+import tarfile
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 
 from simpleperf_report_lib import ReportLib
 from simpleperf_utils import (
-    AdbHelper, BaseArgumentParser, extant_dir, extant_file, flatten_arg_list,
-    ReadElf, str_to_bytes)
+    AdbHelper, BaseArgumentParser, BuildIdList, extant_dir, extant_file, flatten_arg_list,
+    get_platform, log_exit, ReadElf, str_to_bytes)
 
 
 def is_jit_symfile(dso_name):
@@ -41,6 +49,13 @@ def is_jit_symfile(dso_name):
 class BinaryCache:
     def __init__(self, binary_dir: Path):
         self.binary_dir = binary_dir
+        # Updated when binaries are added to the cache.
+        self.build_id_list = BuildIdList(binary_dir)
+
+    def add_binary(self, path: Path, build_id: str):
+        """ Record a binary copied or pulled to the cache. """
+        if build_id:
+            self.build_id_list.add(build_id, path)
 
     def get_path_in_cache(self, device_path: str, build_id: str) -> Path:
         """ Given a binary path in perf.data, return its corresponding path in the cache.
@@ -61,6 +76,262 @@ class BinaryCache:
         return Path(os.path.join(self.binary_dir, device_path))
 
 
+class BinaryIndex:
+    """ A persistent index of binary files, mapping (path, size, mtime) to build id, arch and
+        stripped level. It also keeps the file list of each dir, keyed by the dir mtime. It is
+        stored in binary_cache, so later runs don't need to walk unchanged dirs or read build ids
+        of unchanged files in lib dirs again.
+    """
+    FILE_NAME = 'binary_index.json'
+    VERSION = 2
+    # Fields of a file entry.
+    SIZE, MTIME, BUILD_ID, ARCH, STRIPPED_LEVEL, CONTENT_HASH = range(6)
+
+    def __init__(self, index_path: Path, readelf: ReadElf, jobs: int = os.cpu_count()):
+        self.index_path = index_path
+        self.readelf = readelf
+        self.jobs = jobs
+        # Map from file path to [size, mtime, build_id, arch, stripped_level, content_hash].
+        # Fields not read yet are None.
+        self.files: Dict[str, list] = {}
+        # Map from dir path to [mtime, subdir names, file names].
+        self.dirs: Dict[str, list] = {}
+        self.changed = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_path, 'r') as fh:
+                data = json.load(fh)
+            if data.get('version') == self.VERSION:
+                self.files = data['files']
+                self.dirs = data['dirs']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def save(self):
+        if not self.changed:
+            return
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        data = {'version': self.VERSION, 'files': self.files, 'dirs': self.dirs}
+        tmp_path = self.index_path.with_name(self.index_path.name + '.tmp')
+        with open(tmp_path, 'w') as fh:
+            json.dump(data, fh, separators=(',', ':'))
+        os.replace(tmp_path, self.index_path)
+        self.changed = False
+
+    def _get_entry(self, path: Union[Path, str]) -> Optional[list]:
+        key = str(path)
+        try:
+            st = os.stat(key)
+        except OSError:
+            self.files.pop(key, None)
+            return None
+        entry = self.files.get(key)
+        if (entry is None or entry[self.SIZE] != st.st_size or
+                entry[self.MTIME] != st.st_mtime_ns):
+            entry = self.files[key] = [st.st_size, st.st_mtime_ns, None, None, None, None]
+            self.changed = True
+        return entry
+
+    def get_build_id(self, path: Union[Path, str]) -> str:
+        entry = self._get_entry(path)
+        if entry is None:
+            return ''
+        if entry[self.BUILD_ID] is None:
+            entry[self.BUILD_ID] = self.readelf.get_build_id(path)
+            self.changed = True
+        return entry[self.BUILD_ID]
+
+    def get_arch(self, path: Union[Path, str]) -> str:
+        entry = self._get_entry(path)
+        if entry is None:
+            return 'unknown'
+        if entry[self.ARCH] is None:
+            entry[self.ARCH] = self.readelf.get_arch(path)
+            self.changed = True
+        return entry[self.ARCH]
+
+    def get_stripped_level(self, path: Union[Path, str]) -> int:
+        """Return stripped level of an ELF file. Larger value means more stripped."""
+        entry = self._get_entry(path)
+        if entry is None:
+            return 2
+        if entry[self.STRIPPED_LEVEL] is None:
+            sections = self.readelf.get_sections(path)
+            if '.debug_line' in sections:
+                level = 0
+            elif '.symtab' in sections:
+                level = 1
+            else:
+                level = 2
+            entry[self.STRIPPED_LEVEL] = level
+            self.changed = True
+        return entry[self.STRIPPED_LEVEL]
+
+    def get_content_hash(self, path: Union[Path, str]) -> str:
+        """ Return sha256 of the file content. """
+        entry = self._get_entry(path)
+        if entry is None:
+            return ''
+        if entry[self.CONTENT_HASH] is None:
+            sha256 = hashlib.sha256()
+            with open(path, 'rb') as fh:
+                while True:
+                    data = fh.read(1024 * 1024)
+                    if not data:
+                        break
+                    sha256.update(data)
+            entry[self.CONTENT_HASH] = sha256.hexdigest()
+            self.changed = True
+        return entry[self.CONTENT_HASH]
+
+    def add_copied_file(self, from_path: Path, to_path: Path):
+        """ A copied file has the same info as the source file. """
+        from_entry = self._get_entry(from_path)
+        to_entry = self._get_entry(to_path)
+        if from_entry is not None and to_entry is not None:
+            to_entry[self.BUILD_ID:] = from_entry[self.BUILD_ID:]
+
+    def read_build_ids(self, paths: Iterable[Path]):
+        """ Read build ids of files not in the index in parallel. """
+        paths = [path for path in paths if self._need_build_id(path)]
+        if len(paths) > 1 and self.jobs > 1:
+            with ThreadPoolExecutor(self.jobs) as executor:
+                for future in [executor.submit(self.get_build_id, path) for path in paths]:
+                    future.result()
+        else:
+            for path in paths:
+                self.get_build_id(path)
+
+    def _need_build_id(self, path: Path) -> bool:
+        entry = self._get_entry(path)
+        return entry is not None and entry[self.BUILD_ID] is None
+
+    def _list_dir(self, dir_path: str) -> Tuple[List[str], List[str]]:
+        try:
+            mtime = os.stat(dir_path).st_mtime_ns
+        except OSError:
+            return [], []
+        entry = self.dirs.get(dir_path)
+        if entry is None or entry[0] != mtime:
+            subdirs = []
+            files = []
+            try:
+                with os.scandir(dir_path) as it:
+                    for dir_entry in it:
+                        try:
+                            is_dir = dir_entry.is_dir()
+                        except OSError:
+                            is_dir = False
+                        if not is_dir:
+                            files.append(dir_entry.name)
+                        elif not dir_entry.is_symlink():
+                            subdirs.append(dir_entry.name)
+            except OSError:
+                pass
+            entry = self.dirs[dir_path] = [mtime, subdirs, files]
+            self.changed = True
+        return entry[1], entry[2]
+
+    def walk(self, top: Path) -> Iterator[Tuple[str, List[str]]]:
+        """ Like os.walk(), yield (dir path, file names). Dir listings are taken from the index
+            if the dir hasn't changed.
+        """
+        stack = [str(top)]
+        while stack:
+            dir_path = stack.pop()
+            subdirs, files = self._list_dir(dir_path)
+            yield dir_path, files
+            for name in reversed(subdirs):
+                stack.append(os.path.join(dir_path, name))
+
+
+class FileLinker:
+    """ Put a file at another path, by trying below methods in order:
+        1. reflink: a copy-on-write copy, only supported by some file systems (like btrfs, xfs
+           and apfs).
+        2. hardlink and 3. symlink: only used when links are allowed. Because the linked file
+           changes when the original file is modified in place.
+        4. copy.
+    """
+
+    FICLONE = 0x40049409
+
+    def __init__(self, allow_links: bool):
+        self.allow_links = allow_links
+
+    def link_or_copy(
+            self, from_path: Path, to_path: Path, allow_links: Optional[bool] = None) -> str:
+        """ Return the method used. """
+        if allow_links is None:
+            allow_links = self.allow_links
+        # Never write into an existing file, which may be a link to another file.
+        if to_path.is_file() or to_path.is_symlink():
+            to_path.unlink()
+        if self._reflink(from_path, to_path):
+            return 'reflink'
+        if allow_links:
+            try:
+                os.link(from_path, to_path)
+                return 'hardlink'
+            except OSError:
+                pass
+            try:
+                os.symlink(os.path.abspath(from_path), to_path)
+                return 'symlink'
+            except OSError:
+                pass
+        shutil.copy(from_path, to_path)
+        return 'copy'
+
+    def _reflink(self, from_path: Path, to_path: Path) -> bool:
+        platform = get_platform()
+        try:
+            if platform == 'linux':
+                import fcntl
+                with open(from_path, 'rb') as src, open(to_path, 'wb') as dst:
+                    fcntl.ioctl(dst.fileno(), self.FICLONE, src.fileno())
+            elif platform == 'darwin':
+                libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+                if libc.clonefile(str_to_bytes(str(from_path)), str_to_bytes(str(to_path)), 0):
+                    return False
+            else:
+                return False
+            shutil.copymode(from_path, to_path)
+            return True
+        except (OSError, AttributeError):
+            if to_path.is_file():
+                to_path.unlink()
+            return False
+
+
+class SharedBinaryStore:
+    """ A content-addressed store of binaries, which can be shared by binary_cache dirs of
+        multiple profiles. Files are stored as <root>/<sha256[:2]>/<sha256>, and made read-only.
+        So they can be safely linked into binary_cache dirs.
+    """
+
+    def __init__(self, root: Path, linker: FileLinker, binary_index: BinaryIndex):
+        self.root = root
+        self.linker = linker
+        self.binary_index = binary_index
+
+    def add(self, path: Path) -> Path:
+        """ Add a file to the store if not there, and return its path in the store. """
+        content_hash = self.binary_index.get_content_hash(path)
+        store_path = self.root / content_hash[:2] / content_hash
+        if not store_path.is_file():
+            store_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = store_path.with_name(content_hash + '.tmp%d' % os.getpid())
+            # Links from lib dirs are not allowed, because the source files may be modified.
+            self.linker.link_or_copy(path, tmp_path, allow_links=False)
+            os.chmod(tmp_path, stat.S_IMODE(os.stat(tmp_path).st_mode) & ~0o222)
+            os.replace(tmp_path, store_path)
+            self.binary_index.add_copied_file(path, store_path)
+        return store_path
+
+
 class BinarySource:
     """ Source to find debug binaries. """
 
@@ -79,40 +350,128 @@ class BinarySource:
 
 class BinarySourceFromDevice(BinarySource):
     """ Pull binaries from device. """
+    # Limit the length of a shell command sent to the device.
+    MAX_CMD_LENGTH = 32 * 1024
+    # Limit concurrent adb pull processes.
+    MAX_PULL_JOBS = 8
 
-    def __init__(self, readelf: ReadElf, disable_adb_root: bool):
+    def __init__(self, readelf: ReadElf, disable_adb_root: bool, jobs: int = os.cpu_count()):
         super().__init__(readelf)
         self.adb = AdbHelper(enable_switch_to_root=not disable_adb_root)
+        self.jobs = jobs
 
     def collect_binaries(self, binaries: Dict[str, str], binary_cache: BinaryCache):
         if not self.adb.is_device_available():
             return
-        for path, build_id in binaries.items():
-            self.collect_binary(path, build_id, binary_cache)
+        # Map from device path to path in binary_cache.
+        files_to_pull: Dict[str, Path] = {}
+        binary_index = BinaryIndex(
+            binary_cache.binary_dir / BinaryIndex.FILE_NAME, self.readelf, self.jobs)
+        cache_files = {path: binary_cache.get_path_in_cache(path, build_id)
+                       for path, build_id in binaries.items() if self.is_device_file(path)}
+        binary_index.read_build_ids(
+            cache_files[path] for path in cache_files if binaries[path] and
+            cache_files[path].is_file())
+        for path, binary_cache_file in cache_files.items():
+            build_id = binaries[path]
+            if binary_cache_file.is_file() and (
+                    not build_id or build_id == binary_index.get_build_id(binary_cache_file)):
+                logging.info('use current file in binary_cache: %s', binary_cache_file)
+                binary_cache.add_binary(binary_cache_file, build_id)
+            else:
+                files_to_pull[path] = binary_cache_file
+
+        if files_to_pull:
+            readable_files, unreadable_files = self.check_device_files(list(files_to_pull))
+            for path in list(files_to_pull):
+                if path not in readable_files and path not in unreadable_files:
+                    logging.warning("can't find %s on device", path)
+                    del files_to_pull[path]
+            for path in files_to_pull:
+                binary_cache_file = files_to_pull[path]
+                try:
+                    binary_cache_file.parent.mkdir(parents=True, exist_ok=True)
+                    if binary_cache_file.is_file():
+                        binary_cache_file.unlink()
+                except OSError:
+                    pass
+            pulled_files = self.pull_files_by_tar(
+                {path: files_to_pull[path] for path in readable_files})
+            self.pull_files_in_parallel(
+                {path: files_to_pull[path] for path in files_to_pull if path not in pulled_files})
+            for binary_cache_file in files_to_pull.values():
+                if binary_cache_file.is_file():
+                    binary_cache.add_binary(
+                        binary_cache_file, binary_index.get_build_id(binary_cache_file))
+        binary_index.save()
         self.pull_kernel_symbols(binary_cache.binary_dir / 'kallsyms')
 
-    def collect_binary(self, path: str, build_id: str, binary_cache: BinaryCache):
-        if not path.startswith('/') or path == "//anon" or path.startswith("/dev/"):
-            # [kernel.kallsyms] or unknown, or something we can't find binary.
-            return
-        binary_cache_file = binary_cache.get_path_in_cache(path, build_id)
-        self.check_and_pull_binary(path, build_id, binary_cache_file)
-
-    def check_and_pull_binary(self, path: str, expected_build_id: str, binary_cache_file: Path):
-        """If the binary_cache_file exists and has the expected_build_id, there
-           is no need to pull the binary from device. Otherwise, pull it.
+    @staticmethod
+    def is_device_file(path: str) -> bool:
+        # Skip [kernel.kallsyms] or unknown, or something we can't find binary.
+        return path.startswith('/') and path != "//anon" and not path.startswith("/dev/")
+
+    def split_paths(self, paths: List[str]) -> Iterator[List[str]]:
+        """ Split paths into groups, each can be passed to one shell command. """
+        group = []
+        length = 0
+        for path in paths:
+            if group and length + len(path) > self.MAX_CMD_LENGTH:
+                yield group
+                group = []
+                length = 0
+            group.append(path)
+            length += len(path) + 3
+        if group:
+            yield group
+
+    def check_device_files(self, paths: List[str]) -> Tuple[Set[str], Set[str]]:
+        """ Check files on device in one shell command (per MAX_CMD_LENGTH). Return
+            (readable files, existing but unreadable files).
         """
-        if binary_cache_file.is_file() and (
-                not expected_build_id or expected_build_id == self.read_build_id(binary_cache_file)
-        ):
-            logging.info('use current file in binary_cache: %s', binary_cache_file)
-        else:
+        readable_files = set()
+        unreadable_files = set()
+        for group in self.split_paths(paths):
+            cmd = ('for f in %s; do if [ -r "$f" ]; then echo "r $f"; ' % ' '.join(
+                shlex.quote(path) for path in group) +
+                'elif [ -e "$f" ]; then echo "e $f"; fi; done')
+            result, output = self.adb.run_and_return_output(['shell', cmd])
+            if not result:
+                # Let adb pull check the files one by one.
+                unreadable_files.update(group)
+                continue
+            for line in output.splitlines():
+                if line.startswith('r '):
+                    readable_files.add(line[2:])
+                elif line.startswith('e '):
+                    unreadable_files.add(line[2:])
+        return readable_files, unreadable_files
+
+    def pull_files_by_tar(self, files: Dict[str, Path]) -> Set[str]:
+        """ Stream files from device through `adb exec-out tar`. Return pulled device paths. """
+        pulled_files = set()
+        for group in self.split_paths(sorted(files)):
+            cmd = 'tar -chf - -C / %s 2>/dev/null' % ' '.join(
+                shlex.quote(path.lstrip('/')) for path in group)
+            logging.info('pull %d files to binary_cache through tar', len(group))
+            try:
+                for path, fh in self.adb.read_tar_stream(['exec-out', cmd]):
+                    path = '/' + path.lstrip('/')
+                    binary_cache_file = files.get(path)
+                    if binary_cache_file is None or path in pulled_files:
+                        continue
+                    with open(binary_cache_file, 'wb') as out_fh:
+                        shutil.copyfileobj(fh, out_fh)
+                    pulled_files.add(path)
+            except (OSError, tarfile.TarError) as e:
+                logging.info('failed to pull files through tar: %s', e)
+        return pulled_files
+
+    def pull_files_in_parallel(self, files: Dict[str, Path]):
+        """ Pull files through a bounded pool of adb pull processes. """
+        def pull(path: str, binary_cache_file: Path):
             logging.info('pull file to binary_cache: %s to %s', path, binary_cache_file)
-            target_dir = binary_cache_file.parent
             try:
-                os.makedirs(target_dir, exist_ok=True)
-                if binary_cache_file.is_file():
-                    binary_cache_file.unlink()
                 success = self.pull_file_from_device(path, binary_cache_file)
             except FileNotFoundError:
                 # It happens on windows when the filename or extension is too long.
@@ -120,6 +479,16 @@ class BinarySourceFromDevice(BinarySource):
             if not success:
                 logging.warning('failed to pull %s from device', path)
 
+        jobs = min(self.jobs, self.MAX_PULL_JOBS, len(files))
+        if jobs > 1:
+            with ThreadPoolExecutor(jobs) as executor:
+                for future in [executor.submit(pull, path, binary_cache_file)
+                               for path, binary_cache_file in files.items()]:
+                    future.result()
+        else:
+            for path, binary_cache_file in files.items():
+                pull(path, binary_cache_file)
+
     def pull_file_from_device(self, device_path: str, host_path: Path) -> bool:
         if self.adb.run(['pull', device_path, str(host_path)]):
             return True
@@ -143,17 +512,28 @@ class BinarySourceFromDevice(BinarySource):
 class BinarySourceFromLibDirs(BinarySource):
     """ Collect binaries from lib dirs. """
 
-    def __init__(self, readelf: ReadElf, lib_dirs: List[Path]):
+    def __init__(self, readelf: ReadElf, lib_dirs: List[Path], jobs: int = os.cpu_count(),
+                 allow_links: bool = False, shared_store_dir: Optional[Path] = None):
         super().__init__(readelf)
         self.lib_dirs = lib_dirs
+        self.jobs = jobs
+        self.linker = FileLinker(allow_links)
+        self.shared_store_dir = shared_store_dir
+        self.shared_store = None
         self.filename_map = None
         self.build_id_map = None
         self.binary_cache = None
+        self.binary_index = None
 
     def collect_binaries(self, binaries: Dict[str, str], binary_cache: BinaryCache):
         self.create_filename_map(binaries)
         self.create_build_id_map(binaries)
         self.binary_cache = binary_cache
+        self.binary_index = BinaryIndex(
+            binary_cache.binary_dir / BinaryIndex.FILE_NAME, self.readelf, self.jobs)
+        if self.shared_store_dir:
+            self.shared_store = SharedBinaryStore(
+                self.shared_store_dir, self.linker, self.binary_index)
 
         # Search all files in lib_dirs, and copy matching files to build_cache.
         for lib_dir in self.lib_dirs:
@@ -161,6 +541,10 @@ class BinarySourceFromLibDirs(BinarySource):
                 self.search_platform_symbols_dir(lib_dir)
             else:
                 self.search_dir(lib_dir)
+        self.binary_index.save()
+
+    def read_build_id(self, path: Path):
+        return self.binary_index.get_build_id(path)
 
     def create_filename_map(self, binaries: Dict[str, str]):
         """ Create a map mapping from filename to binaries having the name. """
@@ -187,16 +571,17 @@ class BinarySourceFromLibDirs(BinarySource):
             all of them takes a long time. So we only read build ids for binaries
             having names exist in filename_map.
         """
-        for root, _, files in os.walk(lib_dir):
+        file_paths = []
+        for root, files in self.binary_index.walk(lib_dir):
             for filename in files:
-                binaries = self.filename_map.get(filename)
-                if not binaries:
-                    continue
-                file_path = Path(os.path.join(root, filename))
-                build_id = self.read_build_id(file_path)
-                for path, expected_build_id in binaries:
-                    if expected_build_id == build_id:
-                        self.copy_to_binary_cache(file_path, build_id, path)
+                if filename in self.filename_map:
+                    file_paths.append(Path(os.path.join(root, filename)))
+        self.binary_index.read_build_ids(file_paths)
+        for file_path in file_paths:
+            build_id = self.read_build_id(file_path)
+            for path, expected_build_id in self.filename_map[file_path.name]:
+                if expected_build_id == build_id:
+                    self.copy_to_binary_cache(file_path, build_id, path)
 
     def search_dir(self, lib_dir: Path):
         """ For a normal lib dir, it's unlikely to contain many binaries. So we can read
@@ -204,33 +589,49 @@ class BinarySourceFromLibDirs(BinarySource):
             different from the one recorded in perf.data. So we should only rely on build id
             if it is available.
         """
-        for root, _, files in os.walk(lib_dir):
+        file_paths = []
+        for root, files in self.binary_index.walk(lib_dir):
             for filename in files:
-                file_path = Path(os.path.join(root, filename))
-                build_id = self.read_build_id(file_path)
-                if build_id:
-                    # For elf file with build id, use build id to match.
-                    device_path = self.build_id_map.get(build_id)
-                    if device_path:
-                        self.copy_to_binary_cache(file_path, build_id, device_path)
-                elif self.readelf.is_elf_file(file_path):
-                    # For elf file without build id, use filename to match.
-                    for path, expected_build_id in self.filename_map.get(filename, []):
-                        if not expected_build_id:
-                            self.copy_to_binary_cache(file_path, '', path)
-                            break
+                file_paths.append(Path(os.path.join(root, filename)))
+        self.binary_index.read_build_ids(file_paths)
+        for file_path in file_paths:
+            filename = file_path.name
+            build_id = self.read_build_id(file_path)
+            if build_id:
+                # For elf file with build id, use build id to match.
+                device_path = self.build_id_map.get(build_id)
+                if device_path:
+                    self.copy_to_binary_cache(file_path, build_id, device_path)
+            elif self.readelf.is_elf_file(file_path):
+                # For elf file without build id, use filename to match.
+                for path, expected_build_id in self.filename_map.get(filename, []):
+                    if not expected_build_id:
+                        self.copy_to_binary_cache(file_path, '', path)
+                        break
 
     def copy_to_binary_cache(
             self, from_path: Path, expected_build_id: str, device_path: str):
         to_path = self.binary_cache.get_path_in_cache(device_path, expected_build_id)
         if not self.need_to_copy(from_path, to_path, expected_build_id):
             # The existing file in binary_cache can provide more information, so no need to copy.
+            self.binary_cache.add_binary(to_path, expected_build_id)
             return
         to_dir = to_path.parent
         if not to_dir.is_dir():
             os.makedirs(to_dir)
-        logging.info('copy to binary_cache: %s to %s', from_path, to_path)
-        shutil.copy(from_path, to_path)
+        if self.shared_store:
+            store_path = self.shared_store.add(from_path)
+            # Files in the shared store are read-only, so they are always allowed to be linked.
+            method = self.linker.link_or_copy(store_path, to_path, allow_links=True)
+            self.binary_index.add_copied_file(from_path, to_path)
+            self.binary_cache.add_binary(to_path, expected_build_id)
+            logging.info('%s to binary_cache: %s (%s) to %s', method, from_path, store_path,
+                         to_path)
+        else:
+            method = self.linker.link_or_copy(from_path, to_path)
+            self.binary_index.add_copied_file(from_path, to_path)
+            self.binary_cache.add_binary(to_path, expected_build_id)
+            logging.info('%s to binary_cache: %s to %s', method, from_path, to_path)
 
     def need_to_copy(self, from_path: Path, to_path: Path, expected_build_id: str):
         if not to_path.is_file() or self.read_build_id(to_path) != expected_build_id:
@@ -239,20 +640,20 @@ class BinarySourceFromLibDirs(BinarySource):
 
     def get_file_stripped_level(self, path: Path) -> int:
         """Return stripped level of an ELF file. Larger value means more stripped."""
-        sections = self.readelf.get_sections(path)
-        if '.debug_line' in sections:
-            return 0
-        if '.symtab' in sections:
-            return 1
-        return 2
+        return self.binary_index.get_stripped_level(path)
 
 
 class BinaryCacheBuilder:
     """Collect all binaries needed by perf.data in binary_cache."""
 
-    def __init__(self, ndk_path: Optional[str], disable_adb_root: bool):
+    def __init__(self, ndk_path: Optional[str], disable_adb_root: bool,
+                 jobs: int = os.cpu_count(), allow_links: bool = False,
+                 shared_store_dir: Optional[Union[Path, str]] = None):
         self.readelf = ReadElf(ndk_path)
-        self.device_source = BinarySourceFromDevice(self.readelf, disable_adb_root)
+        self.jobs = jobs
+        self.allow_links = allow_links
+        self.shared_store_dir = Path(shared_store_dir) if shared_store_dir else None
+        self.device_source = BinarySourceFromDevice(self.readelf, disable_adb_root, jobs)
         self.binary_cache_dir = Path('binary_cache')
         self.binary_cache = BinaryCache(self.binary_cache_dir)
         self.binaries = {}
@@ -273,23 +674,12 @@ class BinaryCacheBuilder:
         lib = ReportLib()
         lib.SetRecordFile(perf_data_path)
         lib.SetLogSeverity('error')
-        while True:
-            sample = lib.GetNextSample()
-            if sample is None:
-                lib.Close()
-                break
-            symbols = [lib.GetSymbolOfCurrentSample()]
-            callchain = lib.GetCallChainOfCurrentSample()
-            for i in range(callchain.nr):
-                symbols.append(callchain.entries[i].symbol)
-
-            for symbol in symbols:
-                dso_name = symbol.dso_name
-                if dso_name not in binaries:
-                    if is_jit_symfile(dso_name):
-                        continue
-                    name = 'vmlinux' if dso_name == '[kernel.kallsyms]' else dso_name
-                    binaries[name] = lib.GetBuildIdForPath(dso_name)
+        for dso in lib.GetDsoList():
+            if is_jit_symfile(dso.path):
+                continue
+            name = 'vmlinux' if dso.path == '[kernel.kallsyms]' else dso.path
+            binaries[name] = dso.build_id
+        lib.Close()
         self.binaries = binaries
 
     def copy_binaries_from_symfs_dirs(self, symfs_dirs: List[Union[str, Path]]) -> bool:
@@ -302,7 +692,8 @@ class BinaryCacheBuilder:
                     logging.error("can't find dir %s", symfs_dir)
                     return False
                 lib_dirs.append(symfs_dir)
-            lib_dir_source = BinarySourceFromLibDirs(self.readelf, lib_dirs)
+            lib_dir_source = BinarySourceFromLibDirs(
+                self.readelf, lib_dirs, self.jobs, self.allow_links, self.shared_store_dir)
             lib_dir_source.collect_binaries(self.binaries, self.binary_cache)
         return True
 
@@ -311,19 +702,26 @@ class BinaryCacheBuilder:
 
     def create_build_id_list(self):
         """ Create build_id_list. So report scripts can find a binary by its build_id instead of
-            path.
+            path. All files in binary_cache are scanned through a BinaryIndex, so files added or
+            replaced by hand are also indexed, while build ids are only read for new or changed
+            files.
         """
-        build_id_list_path = self.binary_cache_dir / 'build_id_list'
-        # Write in binary mode to avoid "\r\n" problem on windows, which can confuse simpleperf.
-        with open(build_id_list_path, 'wb') as fh:
-            for root, _, files in os.walk(self.binary_cache_dir):
-                for filename in files:
-                    path = Path(os.path.join(root, filename))
-                    build_id = self.readelf.get_build_id(path)
-                    if build_id:
-                        relative_path = path.relative_to(self.binary_cache_dir)
-                        line = f'{build_id}={relative_path}\n'
-                        fh.write(str_to_bytes(line))
+        build_id_list = self.binary_cache.build_id_list
+        binary_index = BinaryIndex(
+            self.binary_cache_dir / BinaryIndex.FILE_NAME, self.readelf, self.jobs)
+        paths = []
+        for root, files in binary_index.walk(self.binary_cache_dir):
+            paths += [Path(os.path.join(root, filename)) for filename in files]
+        binary_index.read_build_ids(paths)
+        for path in paths:
+            build_id = binary_index.get_build_id(path)
+            if build_id:
+                build_id_list.add(build_id, path)
+            else:
+                build_id_list.remove_path(path)
+        binary_index.save()
+        build_id_list.remove_missing_files()
+        build_id_list.save()
 
     def find_path_in_cache(self, device_path: str) -> Optional[Path]:
         build_id = self.binaries.get(device_path)
@@ -340,9 +738,22 @@ def main() -> bool:
     parser.add_argument('--disable_adb_root', action='store_true', help="""
         Force adb to run in non root mode.""")
     parser.add_argument('--ndk_path', nargs=1, help='Find tools in the ndk path.')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help="""
+        Use multiple threads to read build ids of binaries in lib dirs.""")
+    parser.add_argument('--link', action='store_true', help="""
+        Put binaries from lib dirs in binary_cache by hardlinks or symlinks when reflinks aren't
+        supported, instead of copying them. It saves time and space for big binaries. But
+        binary_cache changes if the binaries in lib dirs are modified in place.""")
+    parser.add_argument('--shared_store', metavar='dir', help="""
+        Store binaries from lib dirs in a content-addressed dir, which can be shared by
+        binary_cache dirs of multiple profiles. Files in binary_cache are linked to the shared
+        store when possible.""")
     args = parser.parse_args()
+    if args.jobs < 1:
+        log_exit('Invalid --jobs option.')
     ndk_path = None if not args.ndk_path else args.ndk_path[0]
-    builder = BinaryCacheBuilder(ndk_path, args.disable_adb_root)
+    builder = BinaryCacheBuilder(ndk_path, args.disable_adb_root, args.jobs, args.link,
+                                 args.shared_store)
     symfs_dirs = flatten_arg_list(args.native_lib_dir)
     return builder.build_binary_cache(args.perf_data_path, symfs_dirs)
 
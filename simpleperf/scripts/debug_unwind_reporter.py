@@ -35,11 +35,20 @@ Below is an example using debug_unwind_reporter.py:
     ...
 """
 
+from __future__ import annotations
 import argparse
 from collections import Counter, defaultdict
-from simpleperf_utils import BaseArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+import json
+import logging
+import os
+from simpleperf_utils import BaseArgumentParser, log_exit
 from texttable import Texttable
-from typing import Dict, Iterator, List
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+# Split the report into chunks of at least this size when processing in parallel.
+MIN_CHUNK_SIZE = 4 * 1024 * 1024
+INDEX_VERSION = 1
 
 
 class CallChainNode:
@@ -78,6 +87,140 @@ class Sample:
             self.callchain.append(CallChainNode())
         return self.callchain[callchain_id]
 
+    @property
+    def end_dso(self) -> str:
+        return self.callchain[-1].dso if self.callchain else ''
+
+    @property
+    def end_symbol(self) -> str:
+        return self.callchain[-1].symbol if self.callchain else ''
+
+    @property
+    def fixed_by_joiner(self) -> bool:
+        """ Return true if the callchain is completed by callchain joiner. """
+        for node in self.callchain:
+            if node.dso.endswith('libc.so') and (node.symbol in ('__libc_init', '__start_thread')):
+                return True
+        return False
+
+
+class IndexEntry(NamedTuple):
+    """ A sample in the sidecar index. It has the same attributes as Sample used by filters, and
+        the position of the sample in the report file.
+    """
+    sample_time: int
+    offset: int
+    size: int
+    error_code: int
+    fixed_by_joiner: bool
+    end_dso: str
+    end_symbol: str
+
+
+def read_sample_lines(
+        input_file: str, start: int = 0, end: Optional[int] = None) -> Iterator[
+        Tuple[int, int, List[str]]]:
+    """ Stream samples starting in [start, end) of a report file.
+        Yield (offset, size, raw_lines) for each sample.
+    """
+    with open(input_file, 'rb') as fh:
+        offset = start
+        if start > 0:
+            # Skip the line containing start - 1, so we begin at a line start >= start.
+            fh.seek(start - 1)
+            offset = start - 1 + len(fh.readline())
+        sample_lines: List[str] = []
+        sample_offset = 0
+        in_sample = False
+        for data in fh:
+            line_offset = offset
+            offset += len(data)
+            line = data.decode('utf-8', errors='replace').rstrip()
+            if line.startswith('sample_time:'):
+                if end is not None and line_offset >= end:
+                    break
+                in_sample = True
+                sample_offset = line_offset
+            elif not line:
+                if in_sample:
+                    in_sample = False
+                    yield sample_offset, line_offset - sample_offset, sample_lines
+                    sample_lines = []
+            if in_sample:
+                sample_lines.append(line)
+
+
+def split_file(input_file: str, jobs: int) -> List[Tuple[int, int]]:
+    """ Split a file into [start, end) chunks for parallel processing. """
+    file_size = os.path.getsize(input_file)
+    chunk_count = max(1, min(jobs, file_size // MIN_CHUNK_SIZE))
+    chunk_size = file_size // chunk_count + 1
+    return [(start, min(start + chunk_size, file_size))
+            for start in range(0, file_size, chunk_size)] or [(0, 0)]
+
+
+def _build_index_for_chunk(input_file: str, start: int, end: int) -> List[IndexEntry]:
+    entries = []
+    for offset, size, lines in read_sample_lines(input_file, start, end):
+        sample = Sample(lines)
+        entries.append(IndexEntry(sample.sample_time, offset, size, sample.error_code,
+                                  sample.fixed_by_joiner, sample.end_dso, sample.end_symbol))
+    return entries
+
+
+class SampleIndex:
+    """ A sidecar index of a report file, stored in <report_file>.index. It maps each sample to
+        its byte offset, error code, end dso and end symbol. So filters and summaries don't need
+        to parse the report again.
+    """
+
+    def __init__(self, input_file: str):
+        self.input_file = input_file
+        self.index_file = input_file + '.index'
+        self.entries: List[IndexEntry] = []
+
+    def _get_file_key(self) -> List[int]:
+        stat = os.stat(self.input_file)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def load(self) -> bool:
+        """ Load the index file. Return false if it doesn't exist or is out of date. """
+        try:
+            with open(self.index_file, 'r') as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            return False
+        if data.get('version') != INDEX_VERSION or data.get('file_key') != self._get_file_key():
+            return False
+        self.entries = [IndexEntry(*entry) for entry in data['samples']]
+        return True
+
+    def build(self, jobs: int):
+        chunks = split_file(self.input_file, jobs)
+        if len(chunks) == 1:
+            self.entries = _build_index_for_chunk(self.input_file, *chunks[0])
+        else:
+            with ProcessPoolExecutor(len(chunks)) as executor:
+                futures = [executor.submit(_build_index_for_chunk, self.input_file, start, end)
+                           for start, end in chunks]
+                self.entries = []
+                for future in futures:
+                    self.entries += future.result()
+        data = {'version': INDEX_VERSION, 'file_key': self._get_file_key(),
+                'samples': [list(entry) for entry in self.entries]}
+        with open(self.index_file, 'w') as fh:
+            json.dump(data, fh, separators=(',', ':'))
+        logging.info('build index file %s' % self.index_file)
+
+    def load_or_build(self, jobs: int):
+        if not self.load():
+            self.build(jobs)
+
+    def read_sample(self, fh, entry: IndexEntry) -> Sample:
+        fh.seek(entry.offset)
+        data = fh.read(entry.size).decode('utf-8', errors='replace')
+        return Sample([line.rstrip() for line in data.splitlines()])
+
 
 class SampleFilter:
     def match(self, sample: Sample) -> bool:
@@ -86,10 +229,7 @@ class SampleFilter:
 
 class CompleteCallChainFilter(SampleFilter):
     def match(self, sample: Sample) -> bool:
-        for node in sample.callchain:
-            if node.dso.endswith('libc.so') and (node.symbol in ('__libc_init', '__start_thread')):
-                return True
-        return False
+        return sample.fixed_by_joiner
 
 
 class ErrorCodeFilter(SampleFilter):
@@ -105,7 +245,7 @@ class EndDsoFilter(SampleFilter):
         self.end_dso = set(end_dso)
 
     def match(self, sample: Sample) -> bool:
-        return sample.callchain[-1].dso in self.end_dso
+        return sample.end_dso in self.end_dso
 
 
 class EndSymbolFilter(SampleFilter):
@@ -113,7 +253,7 @@ class EndSymbolFilter(SampleFilter):
         self.end_symbol = set(end_symbol)
 
     def match(self, sample: Sample) -> bool:
-        return sample.callchain[-1].symbol in self.end_symbol
+        return sample.end_symbol in self.end_symbol
 
 
 class SampleTimeFilter(SampleFilter):
@@ -150,23 +290,19 @@ class ReportInput:
         if args.include_sample_time:
             self.include_filters.append(SampleTimeFilter(args.include_sample_time))
 
-    def get_samples(self, input_file: str) -> Iterator[Sample]:
-        sample_lines: List[str] = []
-        in_sample = False
-        with open(input_file, 'r') as fh:
-            for line in fh.readlines():
-                line = line.rstrip()
-                if line.startswith('sample_time:'):
-                    in_sample = True
-                elif not line:
-                    if in_sample:
-                        in_sample = False
-                        sample = Sample(sample_lines)
-                        sample_lines = []
-                        if self.filter_sample(sample):
-                            yield sample
-                if in_sample:
-                    sample_lines.append(line)
+    def get_samples(self, input_file: str, start: int = 0,
+                    end: Optional[int] = None) -> Iterator[Sample]:
+        for _, _, lines in read_sample_lines(input_file, start, end):
+            sample = Sample(lines)
+            if self.filter_sample(sample):
+                yield sample
+
+    def get_samples_from_index(self, index: SampleIndex) -> Iterator[Sample]:
+        """ Only read and parse samples matching filters. """
+        with open(index.input_file, 'rb') as fh:
+            for entry in index.entries:
+                if self.filter_sample(entry):
+                    yield index.read_sample(fh, entry)
 
     def filter_sample(self, sample: Sample) -> bool:
         """ Return true if the input sample passes filters. """
@@ -200,10 +336,15 @@ class ReportOutputSummary(ReportOutput):
         self.symbol_counters: Dict[int, Counter] = defaultdict(Counter)
 
     def report(self, sample: Sample):
-        symbol_key = (sample.callchain[-1].dso, sample.callchain[-1].symbol)
+        symbol_key = (sample.end_dso, sample.end_symbol)
         self.symbol_counters[sample.error_code][symbol_key] += 1
         self.error_code_counter[sample.error_code] += 1
 
+    def merge(self, other: ReportOutputSummary):
+        self.error_code_counter.update(other.error_code_counter)
+        for error_code, symbol_counter in other.symbol_counters.items():
+            self.symbol_counters[error_code].update(symbol_counter)
+
     def end_report(self):
         self.draw_error_code_table()
         self.draw_symbol_table()
@@ -228,6 +369,29 @@ class ReportOutputSummary(ReportOutput):
         print(table.draw())
 
 
+def _summarize_chunk(
+        report_input: ReportInput, input_file: str, start: int, end: int) -> ReportOutputSummary:
+    summary = ReportOutputSummary()
+    for sample in report_input.get_samples(input_file, start, end):
+        summary.report(sample)
+    return summary
+
+
+def summarize_in_parallel(
+        report_input: ReportInput, input_file: str, jobs: int) -> ReportOutputSummary:
+    """ Count samples in file chunks in parallel, and merge the counters in file order. """
+    chunks = split_file(input_file, jobs)
+    if len(chunks) == 1:
+        return _summarize_chunk(report_input, input_file, *chunks[0])
+    summary = ReportOutputSummary()
+    with ProcessPoolExecutor(len(chunks)) as executor:
+        futures = [executor.submit(_summarize_chunk, report_input, input_file, start, end)
+                   for start, end in chunks]
+        for future in futures:
+            summary.merge(future.result())
+    return summary
+
+
 def get_args() -> argparse.Namespace:
     parser = BaseArgumentParser(description=__doc__)
     parser.add_argument('-i', '--input-file', required=True,
@@ -254,6 +418,12 @@ def get_args() -> argparse.Namespace:
                         help='include cases ending at selected symbol')
     parser.add_argument('--include-sample-time', metavar='time', type=int,
                         nargs='+', help='include cases with selected sample time')
+    parser.add_argument('--use-index', action='store_true', help="""
+        Use a sidecar index file <input-file>.index to find samples matching filters without
+        parsing the whole report. The index file is built if it doesn't exist or is out of
+        date.""")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help="""
+        Use multiple processes to parse large reports.""")
     return parser.parse_args()
 
 
@@ -261,8 +431,23 @@ def main():
     args = get_args()
     report_input = ReportInput()
     report_input.set_filters(args)
+    if args.jobs < 1:
+        log_exit('Invalid --jobs option.')
+    if args.use_index:
+        index = SampleIndex(args.input_file)
+        index.load_or_build(args.jobs)
+        if args.summary:
+            # The index has all fields needed by the summary.
+            samples = filter(report_input.filter_sample, index.entries)
+        else:
+            samples = report_input.get_samples_from_index(index)
+    elif args.summary:
+        summarize_in_parallel(report_input, args.input_file, args.jobs).end_report()
+        return
+    else:
+        samples = report_input.get_samples(args.input_file)
     report_output = ReportOutputSummary() if args.summary else ReportOutputDetails()
-    for sample in report_input.get_samples(args.input_file):
+    for sample in samples:
         report_output.report(sample)
     report_output.end_report()
 
@@ -33,7 +33,7 @@ import sys
 from typing import List, Dict, Optional, NamedTuple, Tuple
 
 from simpleperf_report_lib import GetReportLib
-from simpleperf_utils import BaseArgumentParser, ReportLibOptions
+from simpleperf_utils import BaseArgumentParser, ReportLibOptions, StageProfiler
 
 
 StringID = int
@@ -418,6 +418,7 @@ def _gecko_profile(
     while True:
         sample = lib.GetNextSample()
         if sample is None:
+            downsampling_info = lib.GetDownsamplingInfo()
             lib.Close()
             break
         symbol = lib.GetSymbolOfCurrentSample()
@@ -499,6 +500,8 @@ def _gecko_profile(
         "oscpu": meta_info.get("android_build_fingerprint"),
         "appBuildID": meta_info.get("app_versioncode"),
     }
+    if downsampling_info:
+        gecko_profile_meta["simpleperfDownsampling"] = downsampling_info
 
     # Schema:
     # https://github.com/firefox-devtools/profiler/blob/53970305b51b9b472e26d7457fee1d66cd4e2737/src/types/gecko-profile.js#L377
@@ -532,16 +535,18 @@ def main() -> None:
         help='show samples based on cpus instead of threads')
     parser.add_report_lib_options()
     args = parser.parse_args()
-    profile = _gecko_profile(
-        record_file=args.record_file,
-        symfs_dir=args.symfs,
-        kallsyms_file=args.kallsyms,
-        report_lib_options=args.report_lib_options,
-        max_remove_gap_length=args.max_remove_gap_length,
-        percpu_samples=args.percpu_samples,
-    )
-
-    json.dump(profile, sys.stdout, sort_keys=True)
+    with StageProfiler.stage('load samples'):
+        profile = _gecko_profile(
+            record_file=args.record_file,
+            symfs_dir=args.symfs,
+            kallsyms_file=args.kallsyms,
+            report_lib_options=args.report_lib_options,
+            max_remove_gap_length=args.max_remove_gap_length,
+            percpu_samples=args.percpu_samples,
+        )
+
+    with StageProfiler.stage('write json'):
+        json.dump(profile, sys.stdout, sort_keys=True)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,247 @@
+/*
+ * Copyright (C) 2024 The Android Open Source Project
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *      http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+'use strict';
+
+// Draw flamegraphs stored in infernoData (generated by canvas_renderer.py) on canvas elements.
+// Each node takes NODE_FIELD_COUNT numbers: [depth, offset, weight, method_id, dso_id].
+const NODE_FIELD_COUNT = 5;
+const NODE_HEIGHT = 17;
+const RECT_HEIGHT = 15;
+const FONT_SIZE = 12;
+// Nodes narrower than MIN_NODE_WIDTH pixels are not drawn.
+const MIN_NODE_WIDTH = 0.5;
+
+function canvasFlamegraphInit() {
+    let canvases = document.getElementsByClassName('flamegraph_canvas');
+    let flamegraphs = [];
+    for (let i = 0; i < canvases.length; ++i) {
+        let thread = infernoData.threads[parseInt(canvases[i].getAttribute('thread_index'))];
+        flamegraphs.push(new CanvasFlamegraph(canvases[i], thread.flamegraph));
+    }
+
+    let running = false;
+    window.addEventListener('resize', function() {
+        if (!running) {
+            running = true;
+            window.requestAnimationFrame(function() {
+                flamegraphs.forEach((f) => f.draw());
+                running = false;
+            });
+        }
+    });
+}
+
+function hashToFloat(s) {
+    let hash = 0;
+    for (let i = 0; i < s.length; i++) {
+        hash = (hash * 31 + s.charCodeAt(i)) | 0;
+    }
+    return (hash >>> 0) / 4294967296;
+}
+
+function reverseString(s) {
+    return s.split('').reverse().join('');
+}
+
+function getProperScaledTimeString(value) {
+    if (value >= 1e9) {
+        return (value / 1e9).toFixed(3) + ' s';
+    }
+    if (value >= 1e6) {
+        return (value / 1e6).toFixed(3) + ' ms';
+    }
+    if (value >= 1e3) {
+        return (value / 1e3).toFixed(3) + ' us';
+    }
+    return value.toFixed(0) + ' ns';
+}
+
+class CanvasFlamegraph {
+    constructor(canvas, flamegraph) {
+        this.canvas = canvas;
+        this.nodes = flamegraph.nodes;
+        this.totalWeight = flamegraph.totalWeight;
+        this.maxDepth = flamegraph.maxDepth;
+        // Node indexes of zoomed nodes.
+        this.zoomStack = [];
+        this.selected = -1;
+        this.searchTerm = '';
+
+        canvas.addEventListener('mousemove', (e) => this.onMouseMove(e));
+        canvas.addEventListener('click', (e) => this.onClick(e));
+        canvas.addEventListener('contextmenu', (e) => {
+            e.preventDefault();
+            this.unzoom();
+        });
+        canvas.addEventListener('dblclick', (e) => {
+            e.preventDefault();
+            this.search();
+        });
+        this.draw();
+    }
+
+    method(i) {
+        return infernoData.strings[this.nodes[i + 3]];
+    }
+
+    dso(i) {
+        return infernoData.strings[this.nodes[i + 4]];
+    }
+
+    // Return [start_offset, weight, base_depth] of the displayed range.
+    getRange() {
+        if (this.zoomStack.length == 0) {
+            return [0, this.totalWeight, 0];
+        }
+        let i = this.zoomStack[this.zoomStack.length - 1];
+        return [this.nodes[i + 1], this.nodes[i + 2], this.nodes[i]];
+    }
+
+    getColor(i) {
+        let scheme = infernoData.colorScheme;
+        if (scheme == 'dso') {
+            let dso = this.dso(i);
+            return [170 + Math.floor(80 * hashToFloat(reverseString(dso))),
+                    180 + Math.floor(70 * hashToFloat(dso)),
+                    170 + Math.floor(80 * hashToFloat(reverseString(dso)))];
+        }
+        if (scheme == 'legacy') {
+            let method = this.method(i);
+            return [175 + Math.floor(50 * hashToFloat(reverseString(method))),
+                    60 + Math.floor(180 * hashToFloat(method)),
+                    60 + Math.floor(55 * hashToFloat(reverseString(method)))];
+        }
+        let ratio = 1 - this.nodes[i + 2] / this.totalWeight;
+        return [Math.floor(245 + 10 * ratio), Math.floor(110 + 105 * ratio), 100];
+    }
+
+    getTitle(i) {
+        let weight = this.nodes[i + 2];
+        let weightStr;
+        if (infernoData.traceOffcpu) {
+            weightStr = getProperScaledTimeString(weight);
+        } else {
+            weightStr = weight.toLocaleString('en-US') + ' events';
+        }
+        let percent = (weight / this.totalWeight * 100).toFixed(2);
+        return this.method(i) + ' | ' + this.dso(i) + ' (' + weightStr + ': ' + percent + '%)';
+    }
+
+    draw() {
+        let canvas = this.canvas;
+        let width = canvas.clientWidth;
+        let height = canvas.clientHeight;
+        let ratio = window.devicePixelRatio || 1;
+        canvas.width = width * ratio;
+        canvas.height = height * ratio;
+        let ctx = canvas.getContext('2d');
+        ctx.setTransform(ratio, 0, 0, ratio, 0, 0);
+        ctx.fillStyle = '#eeeeee';
+        ctx.fillRect(0, 0, width, height);
+        ctx.font = FONT_SIZE + 'px Monospace';
+        ctx.textBaseline = 'alphabetic';
+
+        let [rangeStart, rangeWeight, baseDepth] = this.getRange();
+        let scale = width / rangeWeight;
+        let nodes = this.nodes;
+        for (let i = 0; i < nodes.length; i += NODE_FIELD_COUNT) {
+            let depth = nodes[i];
+            if (depth < baseDepth) {
+                continue;
+            }
+            let x = (nodes[i + 1] - rangeStart) * scale;
+            let w = nodes[i + 2] * scale;
+            if (w < MIN_NODE_WIDTH || x + w <= 0 || x >= width) {
+                continue;
+            }
+            let y = height - (depth - baseDepth + 1) * NODE_HEIGHT;
+            let [r, g, b] = this.getColor(i);
+            if (this.searchTerm && this.getTitle(i).indexOf(this.searchTerm) != -1) {
+                [r, g, b] = [230, 100, 230];
+            }
+            ctx.fillStyle = 'rgb(' + r + ',' + g + ',' + b + ')';
+            ctx.fillRect(x, y, w, RECT_HEIGHT);
+            ctx.strokeStyle = (i == this.selected) ? 'black' :
+                'rgb(' + Math.max(0, r - 50) + ',' + Math.max(0, g - 50) + ',' +
+                Math.max(0, b - 50) + ')';
+            ctx.lineWidth = (i == this.selected) ? 1 : 0.5;
+            ctx.strokeRect(x, y, w, RECT_HEIGHT);
+            this.drawText(ctx, i, x, y, w);
+        }
+    }
+
+    drawText(ctx, i, x, y, w) {
+        // Don't even bother trying to find a best fit. The area is too small.
+        if (w < 28) {
+            return;
+        }
+        let methodName = this.method(i);
+        let numCharacters = Math.max(4, Math.min(methodName.length, Math.floor(w / 7.5)));
+        let text = methodName;
+        if (numCharacters < methodName.length) {
+            text = methodName.substring(0, numCharacters - 2) + '..';
+        }
+        ctx.fillStyle = 'black';
+        ctx.fillText(text, Math.max(x, 0) + 2, y + FONT_SIZE);
+    }
+
+    // Return the node index at a position, or -1 if there is no node.
+    findNode(e) {
+        let rect = this.canvas.getBoundingClientRect();
+        let px = e.clientX - rect.left;
+        let py = e.clientY - rect.top;
+        let [rangeStart, rangeWeight, baseDepth] = this.getRange();
+        let depth = baseDepth + Math.ceil((rect.height - py) / NODE_HEIGHT) - 1;
+        let offset = rangeStart + px / rect.width * rangeWeight;
+        let nodes = this.nodes;
+        for (let i = 0; i < nodes.length; i += NODE_FIELD_COUNT) {
+            if (nodes[i] == depth && nodes[i + 1] <= offset &&
+                offset < nodes[i + 1] + nodes[i + 2]) {
+                return i;
+            }
+        }
+        return -1;
+    }
+
+    onMouseMove(e) {
+        let i = this.findNode(e);
+        this.canvas.title = (i == -1) ? '' : this.getTitle(i);
+        this.canvas.style.cursor = (i == -1) ? 'default' : 'pointer';
+    }
+
+    onClick(e) {
+        let i = this.findNode(e);
+        if (i == -1) {
+            return;
+        }
+        this.selected = i;
+        this.zoomStack.push(i);
+        this.draw();
+    }
+
+    unzoom() {
+        if (this.zoomStack.length > 0) {
+            this.selected = this.zoomStack.pop();
+            this.draw();
+        }
+    }
+
+    search() {
+        let term = prompt('Search for:', '');
+        this.searchTerm = term ? term : '';
+        this.draw();
+    }
+}
@@ -0,0 +1,107 @@
+#
+# Copyright (C) 2024 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+    Render flamegraphs as JSON data. The data can be written to a JSON file, or embedded in the
+    HTML report and drawn by canvas.js, which avoids creating one DOM element per call site.
+
+    Each flamegraph is stored as a flat array of nodes in pre-order. Each node takes
+    NODE_FIELD_COUNT numbers: [depth, offset, weight, method_id, dso_id]. Method and dso names
+    are interned in a string table shared by all threads.
+"""
+
+import json
+
+from svg_renderer import SVG_NODE_HEIGHT
+
+NODE_FIELD_COUNT = 5
+
+
+class StringTable(object):
+
+    def __init__(self):
+        self.strings = []
+        self.string_to_id = {}
+
+    def get_id(self, string):
+        string_id = self.string_to_id.get(string)
+        if string_id is None:
+            string_id = self.string_to_id[string] = len(self.strings)
+            self.strings.append(string)
+        return string_id
+
+
+def get_flamegraph_data(flamegraph, string_table):
+    nodes = []
+    max_depth = 0
+    stack = [(child, 0) for child in reversed(flamegraph.children)]
+    while stack:
+        node, depth = stack.pop()
+        if node.num_events <= 0:
+            continue
+        max_depth = max(max_depth, depth + 1)
+        nodes += [depth, node.offset, node.num_events, string_table.get_id(node.method),
+                  string_table.get_id(node.dso)]
+        for child in reversed(node.children):
+            stack.append((child, depth + 1))
+    return {'totalWeight': flamegraph.num_events, 'maxDepth': max_depth, 'nodes': nodes}
+
+
+def get_report_data(process, threads):
+    """ Return the flamegraphs of threads as a dict which can be dumped to JSON. """
+    string_table = StringTable()
+    thread_data = []
+    for thread in threads:
+        thread_data.append({
+            'tid': thread.tid,
+            'pid': thread.pid,
+            'name': thread.name,
+            'numSamples': thread.num_samples,
+            'numEvents': thread.num_events,
+            'flamegraph': get_flamegraph_data(thread.flamegraph, string_table),
+        })
+    data = {
+        'processName': process.name,
+        'pid': process.pid,
+        'numSamples': process.num_samples,
+        'numEvents': process.num_events,
+        'traceOffcpu': process.props['trace_offcpu'],
+        'strings': string_table.strings,
+        'threads': thread_data,
+    }
+    if process.props.get('downsampling'):
+        data['downsampling'] = process.props['downsampling']
+    return data
+
+
+def render_json(process, threads, f):
+    json.dump(get_report_data(process, threads), f, separators=(',', ':'))
+
+
+def render_canvas_data(process, threads, f, color_scheme):
+    data = get_report_data(process, threads)
+    data['colorScheme'] = color_scheme
+    # Avoid closing the script element by a '</' in method names.
+    data_str = json.dumps(data, separators=(',', ':')).replace('</', '<\\/')
+    f.write("<script>let infernoData = %s;</script>\n" % data_str)
+
+
+def render_canvas(thread_index, flamegraph, f):
+    height = (flamegraph.get_max_depth() + 2) * SVG_NODE_HEIGHT
+    f.write("""<div class="flamegraph_block" style="width:100%%; height:%dpx;">
+            <canvas class="flamegraph_canvas" thread_index="%d"
+            style="width:100%%; height:100%%; border: 1px solid black;"></canvas>
+            </div><br/>\n\n""" % (height, thread_index))
@@ -15,13 +15,6 @@
 #
 
 
-class CallSite(object):
-
-    def __init__(self, method, dso):
-        self.method = method
-        self.dso = dso
-
-
 class Thread(object):
 
     def __init__(self, tid, pid):
@@ -37,15 +30,19 @@ class Thread(object):
         self.name = sample.thread_comm
         self.num_samples += 1
         self.num_events += sample.period
-        chain = []
-        for j in range(callchain.nr):
-            entry = callchain.entries[callchain.nr - j - 1]
+        # Walk down the flamegraph while reading the callchain, so no intermediate objects are
+        # created for each frame.
+        period = sample.period
+        current = self.flamegraph
+        current.num_events += period
+        for j in range(callchain.nr - 1, -1, -1):
+            entry = callchain.entries[j]
             if entry.ip == 0:
                 continue
-            chain.append(CallSite(entry.symbol.symbol_name, entry.symbol.dso_name))
-
-        chain.append(CallSite(symbol.symbol_name, symbol.dso_name))
-        self.flamegraph.add_callchain(chain, sample.period)
+            current = current.get_child(entry.symbol.symbol_name, entry.symbol.dso_name)
+            current.num_events += period
+        current = current.get_child(symbol.symbol_name, symbol.dso_name)
+        current.num_events += period
 
 
 class Process(object):
@@ -78,6 +75,11 @@ class Process(object):
 
 
 class FlameGraphCallSite(object):
+    """ A node in the flamegraph. Flamegraphs of huge profiles can contain millions of nodes, so
+        nodes use __slots__, and the tree is always traversed iteratively instead of recursively.
+    """
+
+    __slots__ = ['child_dict', 'children', 'method', 'dso', 'num_events', 'offset', 'id']
 
     callsite_counter = 0
     @classmethod
@@ -86,7 +88,7 @@ class FlameGraphCallSite(object):
         return cls.callsite_counter
 
     def __init__(self, method, dso, callsite_id):
-        # map from (dso, method) to FlameGraphCallSite. Used to speed up add_callchain().
+        # map from (dso, method) to FlameGraphCallSite. Used to speed up get_child().
         self.child_dict = {}
         self.children = []
         self.method = method
@@ -98,40 +100,64 @@ class FlameGraphCallSite(object):
     def weight(self):
         return float(self.num_events)
 
-    def add_callchain(self, chain, num_events):
-        self.num_events += num_events
-        current = self
-        for callsite in chain:
-            current = current.get_child(callsite)
-            current.num_events += num_events
-
-    def get_child(self, callsite):
-        key = (callsite.dso, callsite.method)
+    def get_child(self, method, dso):
+        key = (dso, method)
         child = self.child_dict.get(key)
         if child is None:
-            child = self.child_dict[key] = FlameGraphCallSite(callsite.method, callsite.dso,
+            child = self.child_dict[key] = FlameGraphCallSite(method, dso,
                                                               self._get_next_callsite_id())
         return child
 
-    def trim_callchain(self, min_num_events, max_depth, depth=0):
+    def trim_callchain(self, min_num_events, max_depth, min_lod_num_events=0):
         """ Remove call sites with num_events < min_num_events in the subtree.
-            Remaining children are collected in a list.
+            Remaining children are collected in a list. Sibling call sites with
+            num_events < min_lod_num_events are too narrow to be seen in the report, so they are
+            merged into one "[other]" call site without children.
         """
-        if depth <= max_depth:
-            for key in self.child_dict:
-                child = self.child_dict[key]
-                if child.num_events >= min_num_events:
-                    child.trim_callchain(min_num_events, max_depth, depth + 1)
-                    self.children.append(child)
-        # Relese child_dict since it will not be used.
-        self.child_dict = None
+        stack = [(self, 0)]
+        while stack:
+            node, depth = stack.pop()
+            if depth <= max_depth:
+                other_num_events = 0
+                other_count = 0
+                for child in node.child_dict.values():
+                    if child.num_events < min_num_events:
+                        continue
+                    if child.num_events < min_lod_num_events:
+                        other_num_events += child.num_events
+                        other_count += 1
+                        continue
+                    node.children.append(child)
+                    stack.append((child, depth + 1))
+                if other_count:
+                    other = FlameGraphCallSite(
+                        '[other]', '%d merged call sites' % other_count,
+                        self._get_next_callsite_id())
+                    other.num_events = other_num_events
+                    other.child_dict = None
+                    node.children.append(other)
+            # Relese child_dict since it will not be used.
+            node.child_dict = None
 
     def get_max_depth(self):
-        return max([c.get_max_depth() for c in self.children]) + 1 if self.children else 1
+        max_depth = 0
+        stack = [(self, 1)]
+        while stack:
+            node, depth = stack.pop()
+            if depth > max_depth:
+                max_depth = depth
+            for child in node.children:
+                stack.append((child, depth + 1))
+        return max_depth
 
     def generate_offset(self, start_offset):
         self.offset = start_offset
-        child_offset = start_offset
-        for child in self.children:
-            child_offset = child.generate_offset(child_offset)
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            child_offset = node.offset
+            for child in node.children:
+                child.offset = child_offset
+                child_offset += child.num_events
+                stack.append(child)
         return self.offset + self.num_events
@@ -42,9 +42,10 @@ import sys
 SCRIPTS_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 sys.path.append(SCRIPTS_PATH)
 from simpleperf_report_lib import ReportLib
-from simpleperf_utils import (log_exit, log_fatal, AdbHelper, open_report_in_browser,
-                              BaseArgumentParser)
+from simpleperf_utils import (log_exit, AdbHelper, open_report_in_browser,
+                              BaseArgumentParser, StageProfiler)
 
+from canvas_renderer import render_canvas, render_canvas_data, render_json
 from data_types import Process
 from svg_renderer import get_proper_scaled_time_string, render_svg
 # fmt: on
@@ -130,6 +131,7 @@ def parse_samples(process, args, sample_filter_fn):
     while True:
         sample = lib.GetNextSample()
         if sample is None:
+            process.props['downsampling'] = lib.GetDownsamplingInfo()
             lib.Close()
             break
         symbol = lib.GetSymbolOfCurrentSample()
@@ -146,7 +148,9 @@ def parse_samples(process, args, sample_filter_fn):
 
     for thread in process.threads.values():
         min_event_count = thread.num_events * args.min_callchain_percentage * 0.01
-        thread.flamegraph.trim_callchain(min_event_count, args.max_callchain_depth)
+        min_lod_event_count = thread.num_events * args.min_node_width * 0.01
+        thread.flamegraph.trim_callchain(min_event_count, args.max_callchain_depth,
+                                         min_lod_event_count)
 
     logging.info("Parsed %s callchains." % process.num_samples)
 
@@ -211,20 +215,37 @@ def output_report(process, args):
              process.props["ro.product.manufacturer"]))
     if process.cmd:
         f.write("Capture : %s<br/><br/>" % process.cmd)
+    downsampling_info = process.props.get('downsampling')
+    if downsampling_info:
+        f.write("Downsampling : kept %d of %d samples, event counts are scaled up by about %.2f"
+                "<br/><br/>" % (downsampling_info['samples_kept'],
+                                downsampling_info['samples_read'],
+                                downsampling_info['sampling_factor']))
     f.write("</div>")
     f.write("""<br/><br/>
             <div>Navigate with WASD, zoom in with SPACE, zoom out with BACKSPACE.</div>""")
-    f.write("<script>%s</script>" % get_local_asset_content("script.js"))
+    # Sort threads by the event count in a thread.
+    threads = sorted(process.threads.values(), key=lambda x: x.num_events, reverse=True)
+    if args.output_format == 'canvas':
+        f.write("<script>%s</script>" % get_local_asset_content("canvas.js"))
+        render_canvas_data(process, threads, f, args.color)
+        init_function = 'canvasFlamegraphInit'
+    else:
+        f.write("<script>%s</script>" % get_local_asset_content("script.js"))
+        init_function = 'flamegraphInit'
     if not args.embedded_flamegraph:
-        f.write("<script>document.addEventListener('DOMContentLoaded', flamegraphInit);</script>")
+        f.write("<script>document.addEventListener('DOMContentLoaded', %s);</script>" %
+                init_function)
 
-    # Sort threads by the event count in a thread.
-    for thread in sorted(process.threads.values(), key=lambda x: x.num_events, reverse=True):
+    for i, thread in enumerate(threads):
         thread_name = 'One flamegraph' if args.one_flamegraph else ('Thread %d (%s)' %
                                                                     (thread.tid, thread.name))
         f.write("<br/><br/><b>%s (%d samples):</b><br/>\n\n\n\n" %
                 (thread_name, thread.num_samples))
-        render_svg(process, thread.flamegraph, f, args.color)
+        if args.output_format == 'canvas':
+            render_canvas(i, thread.flamegraph, f)
+        else:
+            render_svg(process, thread.flamegraph, f, args.color)
 
     f.write("</div>")
     if not args.embedded_flamegraph:
@@ -233,6 +254,18 @@ def output_report(process, args):
     return "file://" + filepath
 
 
+def output_json_report(process, args):
+    """
+    Writes flamegraphs of all threads in JSON format
+    :param process: Process object
+    :return: str, absolute path to the file
+    """
+    threads = sorted(process.threads.values(), key=lambda x: x.num_events, reverse=True)
+    with open(args.report_path, 'w') as f:
+        render_json(process, threads, f)
+    return os.path.realpath(args.report_path)
+
+
 def generate_threads_offsets(process):
     for thread in process.threads.values():
         thread.flamegraph.generate_offset(0)
@@ -247,8 +280,6 @@ def collect_machine_info(process):
 
 
 def main():
-    # Allow deep callchain with length >1000.
-    sys.setrecursionlimit(1500)
     parser = BaseArgumentParser(description="""Report samples in perf.data. Default option
                                                is: "-np surfaceflinger -f 6000 -t 10".""")
     record_group = parser.add_argument_group('Record options')
@@ -297,10 +328,21 @@ def main():
                               to limit the nodes shown in the flamegraph and avoid processing
                               limits. For example, when set to 10, callstacks will be cut after
                               the tenth frame.""")
+    report_group.add_argument('--min_node_width', default=0.05, type=float, help="""
+                              Set min width of call sites drawn separately, in percentage of
+                              the flamegraph width. Sibling call sites narrower than it can't be
+                              seen, so they are merged into one [other] call site. It limits
+                              the report size for huge profiles. The default value is about
+                              one pixel on a 1920px wide screen. Use 0 to disable merging.""")
     report_group.add_argument('--no_browser', action='store_true', help="""Don't open report
                               in browser.""")
     report_group.add_argument('-o', '--report_path', default='report.html', help="""Set report
                               path.""")
+    report_group.add_argument('--output_format', default='svg', choices=['svg', 'canvas', 'json'],
+                              help="""svg=html report drawing flamegraphs with svg elements,
+                                      canvas=html report drawing flamegraphs on canvas from
+                                      embedded json data, which is faster for huge profiles,
+                                      json=flamegraph data in json format""")
     report_group.add_argument('--one-flamegraph', action='store_true', help="""Generate one
                               flamegraph instead of one for each thread.""")
     report_group.add_argument('--symfs', help="""Set the path to find binaries with symbols and
@@ -351,16 +393,17 @@ def main():
             args.title = ''
         args.title += '(One Flamegraph)'
 
-    try:
+    with StageProfiler.stage('load samples'):
         parse_samples(process, args, sample_filter_fn)
+    with StageProfiler.stage('generate flamegraphs'):
         generate_threads_offsets(process)
-        report_path = output_report(process, args)
-        if not args.no_browser:
-            open_report_in_browser(report_path)
-    except RuntimeError as r:
-        if 'maximum recursion depth' in r.__str__():
-            log_fatal("Recursion limit exceeded (%s), try --max_callchain_depth." % r)
-        raise r
+    with StageProfiler.stage('write report'):
+        if args.output_format == 'json':
+            report_path = output_json_report(process, args)
+        else:
+            report_path = output_report(process, args)
+    if args.output_format != 'json' and not args.no_browser:
+        open_report_in_browser(report_path)
 
     logging.info("Flamegraph generated at '%s'." % report_path)
 
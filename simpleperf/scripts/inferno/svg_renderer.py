@@ -120,27 +120,33 @@ def create_svg_node(process, callsite, depth, f, total_weight, height, color_sch
 
 
 def render_svg_nodes(process, flamegraph, depth, f, total_weight, height, color_scheme):
-    for i, child in enumerate(flamegraph.children):
+    # Use a stack instead of recursion to support deep callchains. Nodes are written in the
+    # same pre-order as a recursive traversal.
+    stack = [(flamegraph, i, depth) for i in reversed(range(len(flamegraph.children)))]
+    while stack:
+        parent, i, depth = stack.pop()
+        child = parent.children[i]
         # Prebuild navigation target for wasd
 
         if i == 0:
             left_index = 0
         else:
-            left_index = flamegraph.children[i - 1].id
+            left_index = parent.children[i - 1].id
 
-        if i == len(flamegraph.children) - 1:
+        if i == len(parent.children) - 1:
             right_index = 0
         else:
-            right_index = flamegraph.children[i + 1].id
+            right_index = parent.children[i + 1].id
 
         up_index = max(child.children, key=lambda x: x.weight()).id if child.children else 0
 
         # up, left, down, right
-        nav = [up_index, left_index, flamegraph.id, right_index]
+        nav = [up_index, left_index, parent.id, right_index]
 
         create_svg_node(process, child, depth, f, total_weight, height, color_scheme, nav)
-        # Recurse down
-        render_svg_nodes(process, child, depth + 1, f, total_weight, height, color_scheme)
+        # Visit children next.
+        for j in reversed(range(len(child.children))):
+            stack.append((child, j, depth + 1))
 
 
 def render_search_node(f):
@@ -24,6 +24,7 @@
     pprof -text pprof.profile
 """
 
+import json
 import logging
 import os
 import os.path
@@ -32,12 +33,7 @@ import sys
 
 from simpleperf_report_lib import GetReportLib
 from simpleperf_utils import (Addr2Nearestline, BaseArgumentParser, BinaryFinder, extant_dir,
-                              flatten_arg_list, log_exit, ReadElf, ToolFinder)
-try:
-    import profile_pb2
-except ImportError as e:
-    log_exit(f'{e}\nprotobuf package is missing or too old. Please install it like ' +
-             '`pip install protobuf==4.21`.')
+                              flatten_arg_list, log_exit, ReadElf, StageProfiler, ToolFinder)
 
 
 # Some units of common event names
@@ -49,8 +45,18 @@ EVENT_UNITS = {
 }
 
 
+def get_profile_pb2():
+    # Importing protobuf is slow. So only import it when generating or reading a profile.
+    try:
+        import profile_pb2
+        return profile_pb2
+    except ImportError as e:
+        log_exit(f'{e}\nprotobuf package is missing or too old. Please install it like ' +
+                 '`pip install protobuf==4.21`.')
+
+
 def load_pprof_profile(filename):
-    profile = profile_pb2.Profile()
+    profile = get_profile_pb2().Profile()
     with open(filename, "rb") as f:
         profile.ParseFromString(f.read())
     return profile
@@ -273,7 +279,7 @@ class PprofProfileGenerator(object):
             config['binary_cache_dir'] = None
         self.dso_filter = set(config['dso_filters']) if config.get('dso_filters') else None
         self.max_chain_length = config['max_chain_length']
-        self.profile = profile_pb2.Profile()
+        self.profile = get_profile_pb2().Profile()
         self.profile.string_table.append('')
         self.string_table = {}
         self.sample_types = {}
@@ -323,6 +329,10 @@ class PprofProfileGenerator(object):
         while True:
             report_sample = self.lib.GetNextSample()
             if report_sample is None:
+                downsampling_info = self.lib.GetDownsamplingInfo()
+                if downsampling_info:
+                    self.profile.comment.append(self.get_string_id(
+                        "Downsampling:\n" + json.dumps(downsampling_info)))
                 self.lib.Close()
                 self.lib = None
                 break
@@ -647,10 +657,13 @@ def main():
     config['max_chain_length'] = args.max_chain_length
     config['report_lib_options'] = args.report_lib_options
     generator = PprofProfileGenerator(config)
-    for record_file in args.record_file:
-        generator.load_record_file(record_file)
-    profile = generator.gen(args.jobs)
-    store_pprof_profile(config['output_file'], profile)
+    with StageProfiler.stage('load samples'):
+        for record_file in args.record_file:
+            generator.load_record_file(record_file)
+    with StageProfiler.stage('generate profile'):
+        profile = generator.gen(args.jobs)
+    with StageProfiler.stage('write profile'):
+        store_pprof_profile(config['output_file'], profile)
     logging.info("Report is generated at '%s' successfully." % config['output_file'])
     logging.info('Before uploading to the continuous PProf UI, use gzip to compress the file.')
 
@@ -16,46 +16,69 @@
 #
 
 import argparse
-import bisect
-import jinja2
+from array import array
+from collections import Counter
 import io
 import math
 import os
-import pandas as pd
 from pathlib import Path
 import re
 import sys
-
-from bokeh.embed import components
-from bokeh.io import output_file, show
-from bokeh.layouts import layout, Spacer
-from bokeh.models import ColumnDataSource, CustomJS, WheelZoomTool, HoverTool, FuncTickFormatter
-from bokeh.models.widgets import DataTable, DateFormatter, TableColumn
-from bokeh.models.ranges import FactorRange
-from bokeh.palettes import Category20b
-from bokeh.plotting import figure
-from bokeh.resources import INLINE
-from bokeh.transform import jitter
-from bokeh.util.browser import view
 from functools import cmp_to_key
+from typing import Dict, List, Optional, Tuple
 
 # fmt: off
 simpleperf_path = Path(__file__).absolute().parents[1]
 sys.path.insert(0, str(simpleperf_path))
 import simpleperf_report_lib as sp
-from simpleperf_utils import BaseArgumentParser
+from simpleperf_utils import BaseArgumentParser, log_exit, StageProfiler
 # fmt: on
 
+# When --time_resolution isn't set, use a resolution that puts at most this many points on the
+# graph for each thread.
+MAX_POINTS_PER_THREAD = 2000
+
+# The tooltip shows the most common callchain of the hovered point. Callchain strings are looked
+# up in the callchains data source when hovering, instead of being stored for each point.
+TOOLTIPS = """
+<div><b>thread:</b> @thread</div>
+<div><b>samples:</b> @count</div>
+<div style="white-space: pre; font-size: 10px;">@callchain_ids{custom}</div>
+"""
+
+
+def check_plotting_modules():
+    # Bokeh, pandas and jinja2 are slow to import. So they are imported only in functions
+    # generating the report, and checked here before reading the record file.
+    try:
+        import bokeh
+        import jinja2
+        import pandas
+    except ImportError as e:
+        log_exit(f'{e}\nPlease install them like `pip3 install jinja2 bokeh pandas`.')
+
+
+def create_graph(args, source, data_range, callchain_source):
+    from bokeh.models import CustomJSHover, FuncTickFormatter, HoverTool
+    from bokeh.plotting import figure
 
-def create_graph(args, source, data_range):
     graph = figure(
         sizing_mode='stretch_both', x_range=data_range,
         tools=['pan', 'wheel_zoom', 'ywheel_zoom', 'xwheel_zoom', 'reset', 'tap', 'box_select'],
         active_drag='box_select', active_scroll='wheel_zoom',
-        tooltips=[('thread', '@thread'),
-                  ('callchain', '@callchain{safe}')],
+        output_backend='canvas' if args.no_webgl else 'webgl',
         title=args.title, name='graph')
 
+    callchain_formatter = CustomJSHover(args={'callchains': callchain_source}, code="""
+    // value is the callchain ids of the point, sorted by sample count.
+    var text = callchains.data.callchain[value[0]]
+    if (value.length > 1) {
+      text += '\\n(' + (value.length - 1) + ' more callchains)'
+    }
+    return text """)
+    graph.add_tools(HoverTool(tooltips=TOOLTIPS,
+                              formatters={'@callchain_ids': callchain_formatter}))
+
     # a crude way to avoid process name cluttering at some zoom levels.
     # TODO: remove processes from the ticker base on the number of samples currently visualized.
     # The process with most samples visualized should always be visible on the ticker
@@ -93,7 +116,11 @@ def create_graph(args, source, data_range):
     return graph
 
 
-def create_table(graph):
+def create_table(graph, callchain_source):
+    from bokeh.models import ColumnDataSource, CustomJS
+    from bokeh.models.widgets import DataTable, TableColumn
+    import pandas as pd
+
     # Empty dataframe, will be filled up in js land
     empty_data = {'thread': [], 'count': []}
     table_source = ColumnDataSource(pd.DataFrame(
@@ -115,7 +142,9 @@ def create_table(graph):
         index_position=None,
         name='table')
 
-    graph_selection_cb = CustomJS(code='update_selections()')
+    # Pass callchain_source to make it available to main.js.
+    graph_selection_cb = CustomJS(args={'callchains': callchain_source},
+                                  code='update_selections()')
 
     graph_source.selected.js_on_change('indices', graph_selection_cb)
     table_source.selected.js_on_change('indices', CustomJS(args={}, code='update_flamegraph()'))
@@ -124,6 +153,8 @@ def create_table(graph):
 
 
 def generate_template(template_file='index.html.jinja2'):
+    import jinja2
+
     loader = jinja2.FileSystemLoader(
         searchpath=os.path.dirname(os.path.realpath(__file__)) + '/templates/')
 
@@ -132,6 +163,9 @@ def generate_template(template_file='index.html.jinja2'):
 
 
 def generate_html(args, components_dict, title):
+    from bokeh.embed import components
+    from bokeh.resources import INLINE
+
     resources = INLINE.render()
     script, div = components(components_dict)
     return generate_template().render(
@@ -157,7 +191,74 @@ class ThreadDescriptor:
         return str(self.pid) + ':' + str(self.tid) + ' ' + self.name
 
 
+class SampleColumns:
+    """ Store samples in columns. Threads and callchain strings are interned, and samples refer
+        to them by index.
+    """
+
+    def __init__(self):
+        self.times = array('d')
+        self.thread_ids = array('I')
+        self.callchain_ids = array('I')
+        self.threads: List[ThreadDescriptor] = []
+        self.thread_map: Dict[Tuple[int, int, str], int] = {}
+        self.callchains: List[str] = []
+        self.callchain_map: Dict[str, int] = {}
+
+    def add_sample(self, time: float, pid: int, tid: int, thread_name: str, callchain: str):
+        thread_key = (pid, tid, thread_name)
+        thread_id = self.thread_map.get(thread_key)
+        if thread_id is None:
+            thread_id = self.thread_map[thread_key] = len(self.threads)
+            self.threads.append(ThreadDescriptor(pid, tid, thread_name))
+        callchain_id = self.callchain_map.get(callchain)
+        if callchain_id is None:
+            callchain_id = self.callchain_map[callchain] = len(self.callchains)
+            self.callchains.append(callchain)
+        self.times.append(time)
+        self.thread_ids.append(thread_id)
+        self.callchain_ids.append(callchain_id)
+
+    def get_auto_time_resolution(self) -> float:
+        if not self.times:
+            return 1
+        return max(self.times) / MAX_POINTS_PER_THREAD or 1
+
+    def downsample(self, time_resolution: float) -> Dict[str, list]:
+        """ Merge samples of each thread in each time bucket into one point. Each point has the
+            average time, the sample count and callchain counts of merged samples.
+            If time_resolution is 0, each sample becomes a point.
+        """
+        # (thread_id, bucket) -> [time sum, Counter of callchain ids]
+        buckets: Dict[Tuple[int, int], list] = {}
+        for i in range(len(self.times)):
+            time = self.times[i]
+            bucket = int(time // time_resolution) if time_resolution > 0 else i
+            key = (self.thread_ids[i], bucket)
+            value = buckets.get(key)
+            if value is None:
+                value = buckets[key] = [0.0, Counter()]
+            value[0] += time
+            value[1][self.callchain_ids[i]] += 1
+
+        thread_strs = [str(thread) for thread in self.threads]
+        data = {'time': [], 'thread': [], 'count': [], 'callchain_ids': [], 'callchain_counts': []}
+        for (thread_id, _), (time_sum, callchain_counter) in buckets.items():
+            count = sum(callchain_counter.values())
+            most_common = callchain_counter.most_common()
+            data['time'].append(time_sum / count)
+            data['thread'].append(thread_strs[thread_id])
+            data['count'].append(count)
+            data['callchain_ids'].append([callchain_id for callchain_id, _ in most_common])
+            data['callchain_counts'].append([n for _, n in most_common])
+        return data
+
+
 def generate_datasource(args):
+    from bokeh.models import ColumnDataSource
+    from bokeh.models.ranges import FactorRange
+    from bokeh.palettes import Category20b
+
     lib = sp.ReportLib()
     lib.ShowIpForUnknownSymbol()
 
@@ -178,12 +279,7 @@ def generate_datasource(args):
         manufacturer, model, name = product.split(':')
 
     start_time = -1
-    end_time = -1
-
-    times = []
-    threads = []
-    thread_descs = []
-    callchains = []
+    columns = SampleColumns()
 
     while True:
         sample = lib.GetNextSample()
@@ -192,7 +288,6 @@ def generate_datasource(args):
             lib.Close()
             break
 
-        symbol = lib.GetSymbolOfCurrentSample()
         callchain = lib.GetCallChainOfCurrentSample()
 
         if start_time == -1:
@@ -200,21 +295,10 @@ def generate_datasource(args):
 
         sample_time = (sample.time - start_time) / 1e6  # convert to ms
 
-        times.append(sample_time)
-
-        if sample_time > end_time:
-            end_time = sample_time
-
-        thread_desc = ThreadDescriptor(sample.pid, sample.tid, sample.thread_comm)
-
-        threads.append(str(thread_desc))
+        entry_lines = []
 
-        if thread_desc not in thread_descs:
-            bisect.insort(thread_descs, thread_desc)
-
-        callchain_str = ''
-
-        for i in range(callchain.nr):
+        # The last entry is skipped, as the thread is shown as the root of callchains.
+        for i in range(callchain.nr - 1):
             symbol = callchain.entries[i].symbol  # SymbolStruct
             entry_line = ''
 
@@ -226,10 +310,17 @@ def generate_datasource(args):
             if args.include_symbols_addr:
                 entry_line += ':' + hex(symbol.symbol_addr)
 
-            if i < callchain.nr - 1:
-                callchain_str += entry_line + '<br>'
+            entry_lines.append(entry_line)
+
+        columns.add_sample(sample_time, sample.pid, sample.tid, sample.thread_comm,
+                           '\n'.join(entry_lines))
 
-        callchains.append(callchain_str)
+    time_resolution = args.time_resolution
+    if time_resolution is None:
+        time_resolution = columns.get_auto_time_resolution()
+    data = columns.downsample(time_resolution)
+
+    thread_descs = sorted(columns.threads)
 
     # define colors per-process
     palette = Category20b[20]
@@ -246,22 +337,15 @@ def generate_datasource(args):
 
             color_map[str(thread_desc.pid)] = palette[palette_index]
 
-    colors = []
-    for sample_thread in threads:
-        pid = str(sample_thread.split(':')[0])
-        colors.append(color_map[pid])
+    data['color'] = [color_map[sample_thread.split(':')[0]] for sample_thread in data['thread']]
 
     threads_range = [str(thread_desc) for thread_desc in thread_descs]
     data_range = FactorRange(factors=threads_range, bounds='auto')
 
-    data = {'time': times,
-            'thread': threads,
-            'callchain': callchains,
-            'color': colors}
-
     source = ColumnDataSource(data)
+    callchain_source = ColumnDataSource({'callchain': columns.callchains}, name='callchains')
 
-    return source, data_range
+    return source, data_range, callchain_source
 
 
 def main():
@@ -276,15 +360,26 @@ def main():
                         help='Include dso names in backtraces')
     parser.add_argument('--include_symbols_addr', '-s', action='store_true',
                         help='Include addresses of symbols in backtraces')
+    parser.add_argument('--time_resolution', type=float, help="""
+        Merge samples of a thread in each time bucket of this many milliseconds into one point
+        on the graph, to keep the report size bounded. 0 means one point for each sample.
+        Default is to use at most %d points for each thread.""" % MAX_POINTS_PER_THREAD)
+    parser.add_argument('--no_webgl', action='store_true',
+                        help='Draw the graph on canvas instead of WebGL')
     parser.add_report_lib_options(default_show_art_frames=True)
 
     args = parser.parse_args()
+    if args.time_resolution is not None and args.time_resolution < 0:
+        log_exit('Invalid --time_resolution option.')
+    check_plotting_modules()
 
     # TODO test hierarchical ranges too
-    source, data_range = generate_datasource(args)
+    with StageProfiler.stage('load samples'):
+        source, data_range, callchain_source = generate_datasource(args)
 
-    graph = create_graph(args, source, data_range)
-    table = create_table(graph)
+    with StageProfiler.stage('create graph'):
+        graph = create_graph(args, source, data_range, callchain_source)
+        table = create_table(graph, callchain_source)
 
     output_filename = args.output
 
@@ -293,12 +388,13 @@ def main():
 
     title = os.path.splitext(os.path.basename(output_filename))[0]
 
-    html = generate_html(args, {'graph': graph, 'table': table}, title)
-
-    with io.open(output_filename, mode='w', encoding='utf-8') as fout:
-        fout.write(html)
+    with StageProfiler.stage('write report'):
+        html = generate_html(args, {'graph': graph, 'table': table}, title)
+        with io.open(output_filename, mode='w', encoding='utf-8') as fout:
+            fout.write(html)
 
     if not args.dont_open:
+        from bokeh.util.browser import view
         view(output_filename)
 
 
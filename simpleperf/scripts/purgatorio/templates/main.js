@@ -73,15 +73,24 @@ var flame = flamegraph()
   .setColorMapper(offCpuColorMapper);
 
 
+// Points on the graph may merge several samples. Each point refers to callchains by index in the
+// 'callchains' data source, with the sample count of each callchain.
+function get_callchain_table() {
+  return Bokeh.documents[0].get_model_by_name('callchains').data.callchain
+}
+
+
 function update_table() {
   let inverted = document.getElementById("inverted_checkbox").checked
   let regex
   let graph_source = Bokeh.documents[0].get_model_by_name('graph').renderers[0].data_source
   let table_source = Bokeh.documents[0].get_model_by_name('table').source
+  let callchain_table = get_callchain_table()
 
   let graph_selection = graph_source.selected.indices
   let threads = graph_source.data.thread
-  let callchains = graph_source.data.callchain
+  let callchain_ids = graph_source.data.callchain_ids
+  let callchain_counts = graph_source.data.callchain_counts
 
   let selection_len = graph_selection.length;
 
@@ -94,33 +103,39 @@ function update_table() {
   table_source.data.index = []
 
   for (let i = 0; i < selection_len; i ++) {
-    let entry = "<no callchain>"
+    let ids = callchain_ids[graph_selection[i]]
+    let counts = callchain_counts[graph_selection[i]]
 
-    if (regex !== undefined && !regex.test(callchains[graph_selection[i]])) {
-      continue;
-    }
+    for (let c = 0; c < ids.length; c ++) {
+      let callchain_str = callchain_table[ids[c]]
+      let entry = "<no callchain>"
 
-    if (inverted) {
-      let callchain = callchains[graph_selection[i]].split("<br>")
+      if (regex !== undefined && !regex.test(callchain_str)) {
+        continue;
+      }
+
+      if (inverted) {
+        let callchain = callchain_str.split("\n")
 
-      for (let e = 0; e < callchain.length; e ++) {
-        if (callchain[e] != "") { // last entry is apparently always an empty string
-          entry = callchain[e]
-          break
+        for (let e = 0; e < callchain.length; e ++) {
+          if (callchain[e] != "") {
+            entry = callchain[e]
+            break
+          }
         }
+      } else {
+        entry = threads[graph_selection[i]]
       }
-    } else {
-      entry = threads[graph_selection[i]]
-    }
 
-    let pos = table_source.data.thread.indexOf(entry)
+      let pos = table_source.data.thread.indexOf(entry)
 
-    if(pos == -1) {
-      table_source.data.thread.push(entry)
-      table_source.data.count.push(1)
-      table_source.data.index.push(table_source.data.thread.length)
-    } else {
-      table_source.data.count[pos] ++
+      if(pos == -1) {
+        table_source.data.thread.push(entry)
+        table_source.data.count.push(counts[c])
+        table_source.data.index.push(table_source.data.thread.length)
+      } else {
+        table_source.data.count[pos] += counts[c]
+      }
     }
   }
 
@@ -144,11 +159,11 @@ function should_insert_callchain(callchain, items, filter_index, inverted) {
 }
 
 
-function insert_callchain(root, callchain, inverted) {
+function insert_callchain(root, callchain, count) {
   let root_pos = -1
   let node = root
 
-  node.value ++
+  node.value += count
 
   for (let e = 0; e < callchain.length; e ++) {
     let entry = callchain[e].replace(/^\s+|\s+$/g, '')
@@ -167,7 +182,7 @@ function insert_callchain(root, callchain, inverted) {
     }
 
     node = node.children[entry_pos]
-    node.value ++
+    node.value += count
   }
 }
 
@@ -178,8 +193,10 @@ function update_flamegraph() {
 
   let graph_source = Bokeh.documents[0].get_model_by_name('graph').renderers[0].data_source
   let graph_selection = graph_source.selected.indices
-  let callchains = graph_source.data.callchain
+  let callchain_ids = graph_source.data.callchain_ids
+  let callchain_counts = graph_source.data.callchain_counts
   let graph_threads = graph_source.data.thread
+  let callchain_table = get_callchain_table()
 
   let table_source = Bokeh.documents[0].get_model_by_name('table').source
   let table_selection = table_source.selected.indices
@@ -192,25 +209,31 @@ function update_flamegraph() {
 
   for (let i = 0; i < graph_selection.length; i ++) {
     let thread = graph_threads[graph_selection[i]]
-    let callchain = callchains[graph_selection[i]].split("<br>")
-    callchain = callchain.filter(function(e){return e != ""})
+    let ids = callchain_ids[graph_selection[i]]
+    let counts = callchain_counts[graph_selection[i]]
 
-    if (regex !== undefined && !regex.test(callchains[graph_selection[i]])) {
-      continue;
-    }
+    for (let c = 0; c < ids.length; c ++) {
+      let callchain_str = callchain_table[ids[c]]
+      let callchain = callchain_str.split("\n")
+      callchain = callchain.filter(function(e){return e != ""})
 
-    if (callchain.length == 0) {
-      callchain.push("<no callchain>")
-    }
+      if (regex !== undefined && !regex.test(callchain_str)) {
+        continue;
+      }
+
+      if (callchain.length == 0) {
+        callchain.push("<no callchain>")
+      }
 
-    callchain.push(thread)
+      callchain.push(thread)
 
-    if (!inverted){
-      callchain = callchain.reverse()
-    }
+      if (!inverted){
+        callchain = callchain.reverse()
+      }
 
-    if (should_insert_callchain(callchain, table_threads, table_selection)) {
-      insert_callchain(root, callchain)
+      if (should_insert_callchain(callchain, table_threads, table_selection)) {
+        insert_callchain(root, callchain, counts[c])
+      }
     }
   }
 
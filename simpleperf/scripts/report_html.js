@@ -343,6 +343,13 @@ class RecordFileView {
             rows.push(['Record cmdline', gRecordInfo.recordCmdline]);
         }
         rows.push(['Total Samples', '' + gRecordInfo.totalSamples]);
+        if (gRecordInfo.downsampling) {
+            for (let info of gRecordInfo.downsampling) {
+                rows.push(['Downsampling', `${info.mode}, kept ${info.samples_kept} of ` +
+                           `${info.samples_read} samples, event counts are scaled up ` +
+                           `by about ${info.sampling_factor.toFixed(2)}`]);
+            }
+        }
 
         let data = new google.visualization.DataTable();
         data.addColumn('string', '');
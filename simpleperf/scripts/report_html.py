@@ -31,7 +31,8 @@ from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple, Un
 from simpleperf_report_lib import GetReportLib, SymbolStruct
 from simpleperf_utils import (
     Addr2Nearestline, AddrRange, BaseArgumentParser, BinaryFinder, Disassembly, get_script_dir,
-    log_exit, Objdump, open_report_in_browser, ReadElf, ReportLibOptions, SourceFileSearcher)
+    log_exit, Objdump, open_report_in_browser, ReadElf, ReportLibOptions, SourceFileSearcher,
+    StageProfiler)
 
 MAX_CALLSTACK_LENGTH = 750
 
@@ -634,6 +635,8 @@ class RecordData(object):
         self.libs = LibSet()
         self.functions = FunctionSet()
         self.total_samples = 0
+        # downsampling info of record files reported with --sample-rate or --max-samples
+        self.downsampling_infos: List[Dict[str, Any]] = []
         self.source_files = SourceFileSet()
         self.gen_addr_hit_map_in_record_info = False
         self.binary_finder = BinaryFinder(binary_cache_path, ReadElf(ndk_path))
@@ -652,6 +655,9 @@ class RecordData(object):
         while True:
             raw_sample = lib.GetNextSample()
             if not raw_sample:
+                downsampling_info = lib.GetDownsamplingInfo()
+                if downsampling_info:
+                    self.downsampling_infos.append(downsampling_info)
                 lib.Close()
                 break
             raw_event = lib.GetEventOfCurrentSample()
@@ -886,6 +892,8 @@ class RecordData(object):
         record_info['kernelVersion'] = self.meta_info.get('kernel_version', '')
         record_info['recordCmdline'] = self.cmdline
         record_info['totalSamples'] = self.total_samples
+        if self.downsampling_infos:
+            record_info['downsampling'] = self.downsampling_infos
         record_info['processNames'] = self._gen_process_names()
         record_info['threadNames'] = self._gen_thread_names()
         record_info['libList'] = self._gen_lib_list()
@@ -1067,12 +1075,14 @@ def main():
 
     # 2. Produce record data.
     record_data = RecordData(binary_cache_path, ndk_path, build_addr_hit_map)
-    for record_file in args.record_file:
-        record_data.load_record_file(record_file, args.report_lib_options)
-    if args.aggregate_by_thread_name:
-        record_data.aggregate_by_thread_name()
-    record_data.limit_percents(args.min_func_percent, args.min_callchain_percent)
-    record_data.sort_call_graph_by_function_name()
+    with StageProfiler.stage('load samples'):
+        for record_file in args.record_file:
+            record_data.load_record_file(record_file, args.report_lib_options)
+    with StageProfiler.stage('process call graphs'):
+        if args.aggregate_by_thread_name:
+            record_data.aggregate_by_thread_name()
+        record_data.limit_percents(args.min_func_percent, args.min_callchain_percent)
+        record_data.sort_call_graph_by_function_name()
 
     def filter_lib(lib_name: str) -> bool:
         if not args.binary_filter:
@@ -1082,16 +1092,19 @@ def main():
                 return True
         return False
     if args.add_source_code:
-        record_data.add_source_code(args.source_dirs, filter_lib, args.jobs)
+        with StageProfiler.stage('add source code'):
+            record_data.add_source_code(args.source_dirs, filter_lib, args.jobs)
     if args.add_disassembly:
-        record_data.add_disassembly(filter_lib, args.jobs, args.disassemble_job_size)
+        with StageProfiler.stage('add disassembly'):
+            record_data.add_disassembly(filter_lib, args.jobs, args.disassemble_job_size)
 
     # 3. Generate report html.
-    report_generator = ReportGenerator(args.report_path)
-    report_generator.write_script()
-    report_generator.write_content_div()
-    report_generator.write_record_data(record_data.gen_record_info())
-    report_generator.finish()
+    with StageProfiler.stage('write report'):
+        report_generator = ReportGenerator(args.report_path)
+        report_generator.write_script()
+        report_generator.write_content_div()
+        report_generator.write_record_data(record_data.gen_record_info())
+        report_generator.finish()
 
     if not args.no_browser:
         open_report_in_browser(args.report_path)
@@ -18,10 +18,219 @@
 """report_sample.py: report samples in the same format as `perf script`.
 """
 
+from concurrent.futures import ProcessPoolExecutor
+import dataclasses
+import json
+import os
+from pathlib import Path
+import shutil
+import struct
 import sys
-from simpleperf_report_lib import GetReportLib
-from simpleperf_utils import BaseArgumentParser, flatten_arg_list, ReportLibOptions
-from typing import List, Set, Optional
+import tempfile
+from simpleperf_report_lib import GetReportLib, GetSampleRateOfRecordFile
+from simpleperf_utils import (BaseArgumentParser, flatten_arg_list, log_exit, ReportLibOptions,
+                              StageProfiler)
+from typing import Any, BinaryIO, Dict, Iterator, List, Set, Optional, TextIO, Union
+
+# Binary format written by BinarySampleWriter. All integers are little endian.
+#   file header: BINARY_MAGIC, uint16 version
+#   records: uint8 record type, followed by record data:
+#     BINARY_RECORD_STRING: uint32 length, utf-8 bytes. Strings get ids 0, 1, 2, ... in order.
+#     BINARY_RECORD_RESET_STRINGS: no data. Clear the string table.
+#     BINARY_RECORD_SAMPLE: BINARY_SAMPLE_STRUCT fields, then BINARY_FRAME_STRUCT for each frame.
+#       Frames start from the sample ip, followed by callchain entries.
+BINARY_MAGIC = b'SPSAMPLE'
+BINARY_VERSION = 1
+BINARY_RECORD_STRING = 1
+BINARY_RECORD_RESET_STRINGS = 2
+BINARY_RECORD_SAMPLE = 3
+# pid, tid, cpu, time, period, thread_comm string id, event name string id, frame count
+BINARY_SAMPLE_STRUCT = struct.Struct('<IIIQQIII')
+# ip, symbol name string id, dso name string id
+BINARY_FRAME_STRUCT = struct.Struct('<QII')
+
+OUTPUT_FORMATS = ['text', 'tsv', 'jsonl', 'binary']
+
+
+class SampleWriter:
+    """ Format samples and write them to a file. Output is buffered to avoid writing to the
+        file for each line.
+    """
+    BUFFER_SIZE = 4096
+
+    def __init__(self, out: Union[TextIO, BinaryIO], show_tracing_data: bool):
+        self.out = out
+        self.show_tracing_data = show_tracing_data
+        self.buffer: List[Any] = []
+
+    def write_header(self, lib):
+        pass
+
+    def write_sample(self, sample, event, symbol, callchain, tracing_data: Optional[Dict]):
+        raise NotImplementedError
+
+    def _write(self, data):
+        self.buffer.append(data)
+        if len(self.buffer) >= self.BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.out.write(self._join(self.buffer))
+            self.buffer.clear()
+        self.out.flush()
+
+    def _join(self, data: List[Any]):
+        return ''.join(data)
+
+
+class TextSampleWriter(SampleWriter):
+    """ Write samples in the same format as `perf script`. """
+
+    def write_header(self, lib):
+        lines = ['# ========',
+                 '# cmdline : %s' % lib.GetRecordCmd(),
+                 '# arch : %s' % lib.GetArch()]
+        for k, v in lib.MetaInfo().items():
+            lines.append('# %s : %s' % (k, v.replace('\n', ' ')))
+        lines += ['# ========', '#', '']
+        self._write('\n'.join(lines))
+
+    def write_sample(self, sample, event, symbol, callchain, tracing_data: Optional[Dict]):
+        sec = sample.time // 1000000000
+        usec = (sample.time - sec * 1000000000) // 1000
+        lines = ['%s\t%d/%d [%03d] %d.%06d: %d %s:' % (sample.thread_comm,
+                                                       sample.pid, sample.tid, sample.cpu, sec,
+                                                       usec, sample.period, event.name),
+                 '\t%16x %s (%s)' % (sample.ip, symbol.symbol_name, symbol.dso_name)]
+        for i in range(callchain.nr):
+            entry = callchain.entries[i]
+            lines.append('\t%16x %s (%s)' % (entry.ip, entry.symbol.symbol_name,
+                                             entry.symbol.dso_name))
+        if tracing_data:
+            lines.append('\ttracing data:')
+            for key, value in tracing_data.items():
+                lines.append('\t\t%s : %s' % (key, value))
+        lines += ['', '']
+        self._write('\n'.join(lines))
+
+
+class TsvSampleWriter(SampleWriter):
+    """ Write one line for each sample. Frames in the callchain column are separated by ';',
+        starting from the sample ip.
+    """
+    COLUMNS = ['thread_comm', 'pid', 'tid', 'cpu', 'time', 'period', 'event', 'callchain']
+
+    def write_header(self, lib):
+        self._write('\t'.join(self.COLUMNS) + '\n')
+
+    @staticmethod
+    def _escape(s: str) -> str:
+        return s.replace('\t', ' ').replace('\n', ' ')
+
+    def write_sample(self, sample, event, symbol, callchain, tracing_data: Optional[Dict]):
+        frames = ['%s (%s)' % (symbol.symbol_name, symbol.dso_name)]
+        for i in range(callchain.nr):
+            entry_symbol = callchain.entries[i].symbol
+            frames.append('%s (%s)' % (entry_symbol.symbol_name, entry_symbol.dso_name))
+        self._write('%s\t%d\t%d\t%d\t%d\t%d\t%s\t%s\n' % (
+            self._escape(sample.thread_comm), sample.pid, sample.tid, sample.cpu, sample.time,
+            sample.period, event.name, self._escape(';'.join(frames))))
+
+
+class JsonLinesSampleWriter(SampleWriter):
+    """ Write one json object for each sample. """
+
+    def write_sample(self, sample, event, symbol, callchain, tracing_data: Optional[Dict]):
+        frames = [{'ip': sample.ip, 'symbol': symbol.symbol_name, 'dso': symbol.dso_name}]
+        for i in range(callchain.nr):
+            entry = callchain.entries[i]
+            frames.append({'ip': entry.ip, 'symbol': entry.symbol.symbol_name,
+                           'dso': entry.symbol.dso_name})
+        data = {'thread_comm': sample.thread_comm, 'pid': sample.pid, 'tid': sample.tid,
+                'cpu': sample.cpu, 'time': sample.time, 'period': sample.period,
+                'event': event.name, 'callchain': frames}
+        if tracing_data:
+            data['tracing_data'] = {key: str(value) for key, value in tracing_data.items()}
+        self._write(json.dumps(data, separators=(',', ':')) + '\n')
+
+
+class BinarySampleWriter(SampleWriter):
+    """ Write samples in the binary format described by BINARY_MAGIC. """
+
+    def __init__(self, out: BinaryIO, show_tracing_data: bool):
+        super().__init__(out, show_tracing_data)
+        self.string_ids: Dict[str, int] = {}
+        self._write(bytes([BINARY_RECORD_RESET_STRINGS]))
+
+    def write_header(self, lib):
+        self.buffer.insert(0, BINARY_MAGIC + struct.pack('<H', BINARY_VERSION))
+
+    def _get_string_id(self, s: str) -> int:
+        string_id = self.string_ids.get(s)
+        if string_id is None:
+            string_id = self.string_ids[s] = len(self.string_ids)
+            data = s.encode('utf-8')
+            self._write(struct.pack('<BI', BINARY_RECORD_STRING, len(data)) + data)
+        return string_id
+
+    def write_sample(self, sample, event, symbol, callchain, tracing_data: Optional[Dict]):
+        frames = [BINARY_FRAME_STRUCT.pack(sample.ip, self._get_string_id(symbol.symbol_name),
+                                           self._get_string_id(symbol.dso_name))]
+        for i in range(callchain.nr):
+            entry = callchain.entries[i]
+            frames.append(BINARY_FRAME_STRUCT.pack(
+                entry.ip, self._get_string_id(entry.symbol.symbol_name),
+                self._get_string_id(entry.symbol.dso_name)))
+        comm_id = self._get_string_id(sample.thread_comm)
+        event_id = self._get_string_id(event.name)
+        self._write(bytes([BINARY_RECORD_SAMPLE]) + BINARY_SAMPLE_STRUCT.pack(
+            sample.pid, sample.tid, sample.cpu, sample.time, sample.period, comm_id, event_id,
+            len(frames)) + b''.join(frames))
+
+    def _join(self, data: List[Any]):
+        return b''.join(data)
+
+
+SAMPLE_WRITERS = {
+    'text': TextSampleWriter,
+    'tsv': TsvSampleWriter,
+    'jsonl': JsonLinesSampleWriter,
+    'binary': BinarySampleWriter,
+}
+
+
+def read_binary_samples(fh: BinaryIO) -> Iterator[Dict[str, Any]]:
+    """ Read samples written in the binary format. Each sample is returned as a dict in the same
+        layout as the jsonl format.
+    """
+    header = fh.read(len(BINARY_MAGIC) + 2)
+    if header[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+        raise ValueError('magic number mismatch')
+    strings: List[str] = []
+    while True:
+        record_type = fh.read(1)
+        if not record_type:
+            break
+        record_type = record_type[0]
+        if record_type == BINARY_RECORD_STRING:
+            size = struct.unpack('<I', fh.read(4))[0]
+            strings.append(fh.read(size).decode('utf-8'))
+        elif record_type == BINARY_RECORD_RESET_STRINGS:
+            strings = []
+        elif record_type == BINARY_RECORD_SAMPLE:
+            (pid, tid, cpu, time, period, comm_id, event_id,
+             frame_count) = BINARY_SAMPLE_STRUCT.unpack(fh.read(BINARY_SAMPLE_STRUCT.size))
+            frames = []
+            for _ in range(frame_count):
+                ip, symbol_id, dso_id = BINARY_FRAME_STRUCT.unpack(
+                    fh.read(BINARY_FRAME_STRUCT.size))
+                frames.append({'ip': ip, 'symbol': strings[symbol_id], 'dso': strings[dso_id]})
+            yield {'thread_comm': strings[comm_id], 'pid': pid, 'tid': tid, 'cpu': cpu,
+                   'time': time, 'period': period, 'event': strings[event_id],
+                   'callchain': frames}
+        else:
+            raise ValueError('unknown record type %d' % record_type)
 
 
 def report_sample(
@@ -30,8 +239,16 @@ def report_sample(
         kallsyms_file: str,
         show_tracing_data: bool,
         header: bool,
-        report_lib_options: ReportLibOptions):
-    """ read record_file, and print each sample"""
+        report_lib_options: ReportLibOptions,
+        output_format: str = 'text',
+        out: Optional[Union[TextIO, BinaryIO]] = None,
+        write_format_header: bool = True):
+    """ read record_file, and print each sample.
+        header: show metadata header in text format.
+        out: the file to write samples. Default is sys.stdout.
+        write_format_header: write the header of the output format, like column names in tsv
+                             format. It is False when writing a part of the output.
+    """
     lib = GetReportLib(record_file)
 
     lib.ShowIpForUnknownSymbol()
@@ -41,14 +258,13 @@ def report_sample(
         lib.SetKallsymsFile(kallsyms_file)
     lib.SetReportOptions(report_lib_options)
 
-    if header:
-        print("# ========")
-        print("# cmdline : %s" % lib.GetRecordCmd())
-        print("# arch : %s" % lib.GetArch())
-        for k, v in lib.MetaInfo().items():
-            print('# %s : %s' % (k, v.replace('\n', ' ')))
-        print("# ========")
-        print("#")
+    if out is None:
+        out = sys.stdout.buffer if output_format == 'binary' else sys.stdout
+    writer = SAMPLE_WRITERS[output_format](out, show_tracing_data)
+    if StageProfiler.enabled:
+        writer.write_sample = StageProfiler.timed('write samples', writer.write_sample)
+    if write_format_header and (header or output_format != 'text'):
+        writer.write_header(lib)
 
     while True:
         sample = lib.GetNextSample()
@@ -58,23 +274,67 @@ def report_sample(
         event = lib.GetEventOfCurrentSample()
         symbol = lib.GetSymbolOfCurrentSample()
         callchain = lib.GetCallChainOfCurrentSample()
+        tracing_data = lib.GetTracingDataOfCurrentSample() if show_tracing_data else None
+        writer.write_sample(sample, event, symbol, callchain, tracing_data)
+    writer.flush()
 
-        sec = sample.time // 1000000000
-        usec = (sample.time - sec * 1000000000) // 1000
-        print('%s\t%d/%d [%03d] %d.%06d: %d %s:' % (sample.thread_comm,
-                                                    sample.pid, sample.tid, sample.cpu, sec,
-                                                    usec, sample.period, event.name))
-        print('\t%16x %s (%s)' % (sample.ip, symbol.symbol_name, symbol.dso_name))
-        for i in range(callchain.nr):
-            entry = callchain.entries[i]
-            print('\t%16x %s (%s)' % (entry.ip, entry.symbol.symbol_name, entry.symbol.dso_name))
-        if show_tracing_data:
-            data = lib.GetTracingDataOfCurrentSample()
-            if data:
-                print('\ttracing data:')
-                for key, value in data.items():
-                    print('\t\t%s : %s' % (key, value))
-        print('')
+
+def _report_sample_part(output_path: str, output_format: str, **kwargs):
+    """ Write samples in a time shard to output_path. It runs in a worker process. """
+    with open(output_path, 'wb' if output_format == 'binary' else 'w') as out:
+        report_sample(output_format=output_format, out=out, **kwargs)
+
+
+def report_sample_in_parallel(
+        record_file: str,
+        symfs_dir: str,
+        kallsyms_file: str,
+        show_tracing_data: bool,
+        header: bool,
+        report_lib_options: ReportLibOptions,
+        output_format: str,
+        out: BinaryIO,
+        jobs: int):
+    """ Split samples into time shards, format each shard in a worker process, and concatenate
+        outputs of shards in time order.
+    """
+    from sample_filter import RecordFileReader
+    with StageProfiler.stage('get time range'):
+        min_timestamp, max_timestamp = RecordFileReader(record_file).get_time_range()
+    if report_lib_options.max_samples is not None:
+        # Each shard only sees its own samples. So compute the sample rate once for the whole
+        # record file, and use it in all shards.
+        with StageProfiler.stage('compute sample rate'):
+            sample_rate = GetSampleRateOfRecordFile(record_file, report_lib_options)
+        report_lib_options = dataclasses.replace(
+            report_lib_options, sample_rate=sample_rate, max_samples=None)
+    end_timestamp = max_timestamp + 1
+    step = (end_timestamp - min_timestamp) / jobs
+    boundaries = [min_timestamp + int(step * i) for i in range(jobs)] + [end_timestamp]
+    with tempfile.TemporaryDirectory() as tmpdir, ProcessPoolExecutor(jobs) as executor:
+        futures = []
+        output_paths = []
+        for i in range(jobs):
+            filter_file = Path(tmpdir) / ('filter_part%d' % i)
+            filter_file.write_text('GLOBAL_BEGIN %d\nGLOBAL_END %d\n' %
+                                   (boundaries[i], boundaries[i + 1]))
+            output_path = str(Path(tmpdir) / ('output_part%d' % i))
+            output_paths.append(output_path)
+            options = dataclasses.replace(
+                report_lib_options,
+                sample_filters=report_lib_options.sample_filters +
+                ['--filter-file', str(filter_file)])
+            futures.append(executor.submit(
+                _report_sample_part, output_path, output_format, record_file=record_file,
+                symfs_dir=symfs_dir, kallsyms_file=kallsyms_file,
+                show_tracing_data=show_tracing_data, header=header,
+                report_lib_options=options, write_format_header=(i == 0)))
+        with StageProfiler.stage('format shards in parallel'):
+            for future, output_path in zip(futures, output_paths):
+                future.result()
+                with open(output_path, 'rb') as fh:
+                    shutil.copyfileobj(fh, out)
+    out.flush()
 
 
 def main():
@@ -89,18 +349,45 @@ def main():
                         help='Show metadata header, like perf script --header')
     parser.add_argument('-o', '--output_file', default='', help="""
         The path of the generated report.  Default is stdout.""")
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='text', help="""
+        Output format. text: the same format as `perf script`. tsv: one line for each sample.
+        jsonl: one json object for each sample. binary: a compact binary format, which can be
+        read by read_binary_samples() in report_sample.py.""")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="""
+        Split samples into time shards, and format them in parallel. Outputs of shards are
+        concatenated in time order.""")
     parser.add_report_lib_options()
     args = parser.parse_args()
-    # If the output file has been set, redirect stdout.
-    if args.output_file != '' and args.output_file != '-':
-        sys.stdout = open(file=args.output_file, mode='w')
-    report_sample(
+    if args.jobs < 1:
+        log_exit('Invalid --jobs option.')
+    if args.jobs > 1 and args.filter_file:
+        log_exit("--jobs can't be used with --filter-file.")
+
+    report_args = dict(
         record_file=args.record_file,
         symfs_dir=args.symfs,
         kallsyms_file=args.kallsyms,
         show_tracing_data=args.show_tracing_data,
         header=args.header,
-        report_lib_options=args.report_lib_options)
+        report_lib_options=args.report_lib_options,
+        output_format=args.format)
+    to_stdout = args.output_file == '' or args.output_file == '-'
+    if args.jobs > 1:
+        if to_stdout:
+            report_sample_in_parallel(out=sys.stdout.buffer, jobs=args.jobs, **report_args)
+        else:
+            with open(args.output_file, 'wb') as out:
+                report_sample_in_parallel(out=out, jobs=args.jobs, **report_args)
+        return
+
+    # If the output file has been set, redirect stdout.
+    if not to_stdout:
+        if args.format == 'binary':
+            sys.stdout = open(file=args.output_file, mode='wb')
+        else:
+            sys.stdout = open(file=args.output_file, mode='w')
+        report_args['out'] = sys.stdout
+    report_sample(**report_args)
 
 
 if __name__ == '__main__':
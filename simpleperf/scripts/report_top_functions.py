@@ -0,0 +1,469 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2024 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""report_top_functions.py: report top self and children functions of each event (and process)
+    in bounded memory, over many recording files.
+
+    Instead of keeping all functions, the period of functions is counted by Space-Saving sketches
+    with a fixed number of counters. Sample counts and event counts of each event are exact.
+    Each reported function has an error bound: its true period is in [period - error, period].
+    Sketches can be saved and merged, to report over recording files collected in many runs.
+
+  Example:
+    ./report_top_functions.py -i perf1.data perf2.data --top 20 --per-process
+    ./report_top_functions.py -i perf.data --sketch-output day1.json
+    ./report_top_functions.py --sketch-input day1.json day2.json
+"""
+
+from concurrent.futures import as_completed, ProcessPoolExecutor
+import heapq
+import itertools
+import json
+import os
+import sys
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Set, TextIO, Tuple
+
+from simpleperf_report_lib import GetReportLib
+from simpleperf_utils import (BaseArgumentParser, flatten_arg_list, log_exit, ReportLibOptions,
+                              StageProfiler)
+
+# The group of processes not fitting in --max-processes.
+OTHER_PROCESSES = '[other processes]'
+
+
+class SpaceSavingSketch:
+    """ A weighted Space-Saving sketch (Metwally et al.), keeping at most `capacity` counters.
+        For a key in the sketch, its true weight is in [count - error, count]. For a key not in
+        the sketch, its true weight is at most absent_bound(). Sketches are mergeable
+        (Agarwal et al.), so sketches built in parallel can be combined with the same guarantees.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        # key -> [count, error]
+        self.counters: Dict[Hashable, List[int]] = {}
+        # Upper bound of weights of keys not in the sketch, used when the sketch isn't full.
+        self.base = 0
+        self.total = 0
+        # A min heap of (count, key), with one entry per key. A count in the heap can be less than
+        # the current count of the key, and is updated lazily when popped.
+        self.heap: List[Tuple[int, Hashable]] = []
+
+    def add(self, key: Hashable, weight: int):
+        self.total += weight
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter[0] += weight
+            return
+        if len(self.counters) < self.capacity:
+            count, error = self.base + weight, self.base
+        else:
+            min_count = self._pop_min()
+            count, error = min_count + weight, min_count
+        self.counters[key] = [count, error]
+        heapq.heappush(self.heap, (count, key))
+
+    def _pop_min(self) -> int:
+        """ Remove the key with the min count, and return its count. """
+        while True:
+            count, key = heapq.heappop(self.heap)
+            current = self.counters[key][0]
+            if current == count:
+                del self.counters[key]
+                return count
+            heapq.heappush(self.heap, (current, key))
+
+    def absent_bound(self) -> int:
+        """ Return an upper bound of the weight of any key not in the sketch. """
+        if len(self.counters) < self.capacity:
+            return self.base
+        return min(counter[0] for counter in self.counters.values())
+
+    def top(self, n: int) -> List[Tuple[Hashable, int, int]]:
+        """ Return [(key, count, error)] of n keys with the largest counts. """
+        items = heapq.nlargest(n, self.counters.items(), key=lambda item: item[1][0])
+        return [(key, count, error) for key, (count, error) in items]
+
+    def keys(self) -> Iterable[Hashable]:
+        return self.counters.keys()
+
+    def merge(self, other: 'SpaceSavingSketch'):
+        base1, base2 = self.absent_bound(), other.absent_bound()
+        counters = {}
+        for key in self.counters.keys() | other.counters.keys():
+            count1, error1 = self.counters.get(key, (base1, base1))
+            count2, error2 = other.counters.get(key, (base2, base2))
+            counters[key] = [count1 + count2, error1 + error2]
+        if len(counters) > self.capacity:
+            counters = dict(heapq.nlargest(self.capacity, counters.items(),
+                                           key=lambda item: item[1][0]))
+        self.counters = counters
+        self.base = base1 + base2
+        self.total += other.total
+        self._rebuild_heap()
+
+    def _rebuild_heap(self):
+        self.heap = [(counter[0], key) for key, counter in self.counters.items()]
+        heapq.heapify(self.heap)
+
+    def to_dict(self, key_to_json) -> Dict[str, Any]:
+        return {
+            'capacity': self.capacity,
+            'base': self.base,
+            'total': self.total,
+            'counters': [[key_to_json(key), count, error]
+                         for key, (count, error) in self.counters.items()],
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], key_from_json) -> 'SpaceSavingSketch':
+        sketch = cls(data['capacity'])
+        sketch.base = data['base']
+        sketch.total = data['total']
+        for key, count, error in data['counters']:
+            sketch.counters[key_from_json(key)] = [count, error]
+        sketch._rebuild_heap()
+        return sketch
+
+
+class FunctionInterner:
+    """ Map (dso, symbol) pairs to int ids. Unused ids are removed by compact(), to keep memory
+        bounded by the number of counters in sketches.
+    """
+
+    def __init__(self):
+        self.ids: Dict[Tuple[str, str], int] = {}
+        self.functions: Dict[int, Tuple[str, str]] = {}
+        self.next_id = 0
+
+    def intern(self, dso_name: str, symbol_name: str) -> int:
+        function = (dso_name, symbol_name)
+        function_id = self.ids.get(function)
+        if function_id is None:
+            function_id = self.ids[function] = self.next_id
+            self.functions[function_id] = function
+            self.next_id += 1
+        return function_id
+
+    def get_function(self, function_id: int) -> Tuple[str, str]:
+        return self.functions[function_id]
+
+    def compact(self, used_ids: Set[int]):
+        for function_id in list(self.functions.keys()):
+            if function_id not in used_ids:
+                del self.ids[self.functions.pop(function_id)]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+
+class FunctionStats:
+    """ Exact totals and sketches of top functions of an event in a process. """
+
+    def __init__(self, capacity: int):
+        self.sample_count = 0
+        self.event_count = 0
+        self.self_sketch = SpaceSavingSketch(capacity)
+        # For each sample, its period is added to every function in its callchain once.
+        self.children_sketch = SpaceSavingSketch(capacity)
+
+
+class TopFunctionsReporter:
+    """ Read samples and keep top functions of each (event, process) group. """
+
+    def __init__(self, capacity: int, per_process: bool, max_processes: int):
+        self.capacity = capacity
+        self.per_process = per_process
+        self.max_processes = max_processes
+        self.interner = FunctionInterner()
+        # Compact the interner when it has more functions than this.
+        self.compact_threshold = 4 * capacity
+        # (event name, process name) -> FunctionStats
+        self.groups: Dict[Tuple[str, str], FunctionStats] = {}
+        # (event name, pid) -> FunctionStats, only kept for the current recording file.
+        self.pid_groups: Dict[Tuple[str, Optional[int]], FunctionStats] = {}
+        self.process_names: Set[str] = set()
+        self.record_file_count = 0
+
+    def read_record_file(self, record_file: str, symfs_dir: Optional[str],
+                         kallsyms_file: Optional[str], report_lib_options: ReportLibOptions):
+        lib = GetReportLib(record_file)
+        if symfs_dir:
+            lib.SetSymfs(symfs_dir)
+        if kallsyms_file:
+            lib.SetKallsymsFile(kallsyms_file)
+        lib.SetReportOptions(report_lib_options)
+        # With --per-process, samples are first grouped by pid. The groups are merged by process
+        # name at the end of the recording file, when names of main threads are known. Pids seen
+        # after the first max_processes pids are grouped as other processes (pid None), so the
+        # number of groups is bounded.
+        # pid -> process name, only kept for the current recording file.
+        pid_names: Dict[int, str] = {}
+        intern = self.interner.intern
+        while True:
+            sample = lib.GetNextSample()
+            if sample is None:
+                break
+            event_name = lib.GetEventOfCurrentSample().name
+            if self.per_process:
+                pid = sample.pid
+                if pid in pid_names:
+                    if pid == sample.tid:
+                        pid_names[pid] = sample.thread_comm
+                elif len(pid_names) < self.max_processes:
+                    pid_names[pid] = sample.thread_comm
+                else:
+                    pid = None
+                stats = self.pid_groups.get((event_name, pid))
+                if stats is None:
+                    stats = self.pid_groups[(event_name, pid)] = FunctionStats(self.capacity)
+            else:
+                stats = self._get_group(event_name, '')
+            symbol = lib.GetSymbolOfCurrentSample()
+            callchain = lib.GetCallChainOfCurrentSample()
+            period = sample.period
+            stats.sample_count += 1
+            stats.event_count += period
+
+            self_id = intern(symbol.dso_name, symbol.symbol_name)
+            stats.self_sketch.add(self_id, period)
+            function_ids = {self_id}
+            for i in range(callchain.nr):
+                entry_symbol = callchain.entries[i].symbol
+                function_ids.add(intern(entry_symbol.dso_name, entry_symbol.symbol_name))
+            for function_id in function_ids:
+                stats.children_sketch.add(function_id, period)
+            if len(self.interner) > self.compact_threshold:
+                self._compact_interner()
+        lib.Close()
+        for (event_name, pid), stats in self.pid_groups.items():
+            process_name = OTHER_PROCESSES if pid is None else pid_names[pid]
+            self._merge_stats(self._get_group(event_name, process_name), stats)
+        self.pid_groups.clear()
+        self.record_file_count += 1
+
+    def _get_group(self, event_name: str, process_name: str) -> FunctionStats:
+        key = (event_name, process_name)
+        stats = self.groups.get(key)
+        if stats is None:
+            if process_name not in self.process_names:
+                if (len(self.process_names) >= self.max_processes and
+                        process_name != OTHER_PROCESSES):
+                    return self._get_group(event_name, OTHER_PROCESSES)
+                self.process_names.add(process_name)
+            stats = self.groups[key] = FunctionStats(self.capacity)
+        return stats
+
+    def _merge_stats(self, stats: FunctionStats, other: FunctionStats):
+        stats.sample_count += other.sample_count
+        stats.event_count += other.event_count
+        stats.self_sketch.merge(other.self_sketch)
+        stats.children_sketch.merge(other.children_sketch)
+
+    def _compact_interner(self):
+        used_ids = set()
+        for stats in itertools.chain(self.groups.values(), self.pid_groups.values()):
+            used_ids.update(stats.self_sketch.keys())
+            used_ids.update(stats.children_sketch.keys())
+        self.interner.compact(used_ids)
+        self.compact_threshold = max(4 * self.capacity, 2 * len(self.interner))
+
+    def to_dict(self) -> Dict[str, Any]:
+        """ Return the state in a json serializable format, which can be merged later. """
+        def key_to_json(function_id: int) -> Tuple[str, str]:
+            return self.interner.get_function(function_id)
+
+        groups = []
+        for (event_name, process_name), stats in self.groups.items():
+            groups.append({
+                'event_name': event_name,
+                'process_name': process_name,
+                'sample_count': stats.sample_count,
+                'event_count': stats.event_count,
+                'self': stats.self_sketch.to_dict(key_to_json),
+                'children': stats.children_sketch.to_dict(key_to_json),
+            })
+        return {'record_file_count': self.record_file_count, 'groups': groups}
+
+    def merge_dict(self, data: Dict[str, Any]):
+        """ Merge the state returned by to_dict() of another reporter. """
+        def key_from_json(function: List[str]) -> int:
+            return self.interner.intern(function[0], function[1])
+
+        for group in data['groups']:
+            process_name = group['process_name'] if self.per_process else ''
+            stats = self._get_group(group['event_name'], process_name)
+            stats.sample_count += group['sample_count']
+            stats.event_count += group['event_count']
+            for name in ('self', 'children'):
+                sketch = SpaceSavingSketch.from_dict(group[name], key_from_json)
+                sketch.capacity = self.capacity
+                getattr(stats, name + '_sketch').merge(sketch)
+        self.record_file_count += data['record_file_count']
+        self._compact_interner()
+
+    def get_report(self, top_n: int) -> List[Dict[str, Any]]:
+        report = []
+        for (event_name, process_name), stats in sorted(
+                self.groups.items(), key=lambda item: (item[0][0], -item[1].event_count)):
+            group = {'event_name': event_name}
+            if self.per_process:
+                group['process_name'] = process_name
+            group['sample_count'] = stats.sample_count
+            group['event_count'] = stats.event_count
+            for name in ('self', 'children'):
+                group[name] = self._get_top_functions(
+                    getattr(stats, name + '_sketch'), top_n, stats.event_count)
+            report.append(group)
+        return report
+
+    def _get_top_functions(self, sketch: SpaceSavingSketch, top_n: int,
+                           event_count: int) -> Dict[str, Any]:
+        top = sketch.top(top_n + 1)
+        functions = []
+        # Functions not reported are either in the sketch after top n, with periods <= the period
+        # of the function after top n, or not in the sketch, with periods <= absent_bound().
+        absent_bound = sketch.absent_bound()
+        next_bound = max(top[top_n][1], absent_bound) if len(top) > top_n else absent_bound
+        for function_id, count, error in top[:top_n]:
+            dso_name, symbol_name = self.interner.get_function(function_id)
+            functions.append({
+                'symbol': symbol_name,
+                'dso': dso_name,
+                'period': count,
+                'error': error,
+                'percent': 100.0 * count / event_count if event_count else 0,
+                # Whether the function is sure to be in top n.
+                'guaranteed': count - error >= next_bound,
+            })
+        return {
+            'functions': functions,
+            # Any function not reported has a period <= unlisted_bound.
+            'unlisted_bound': next_bound,
+        }
+
+
+def write_text_report(report: List[Dict[str, Any]], fh: TextIO):
+    for group in report:
+        fh.write('Event: %s\n' % group['event_name'])
+        if 'process_name' in group:
+            fh.write('Process: %s\n' % group['process_name'])
+        fh.write('Samples: %d\n' % group['sample_count'])
+        fh.write('Event count: %d\n' % group['event_count'])
+        for name in ('self', 'children'):
+            top = group[name]
+            fh.write('\nTop %s functions (unlisted functions have period <= %d):\n' %
+                     (name, top['unlisted_bound']))
+            fh.write('%10s  %14s  %14s  %s\n' % ('Percent', 'Period', 'Error', 'Symbol'))
+            for function in top['functions']:
+                fh.write('%9.2f%%  %14d  %14d  %s [%s]%s\n' % (
+                    function['percent'], function['period'], function['error'],
+                    function['symbol'], function['dso'],
+                    '' if function['guaranteed'] else ' (may not be in top)'))
+        fh.write('\n')
+
+
+def read_record_file(record_file: str, config: Dict[str, Any]) -> Dict[str, Any]:
+    """ Read a recording file in a worker process, and return the state of its reporter. """
+    reporter = TopFunctionsReporter(config['capacity'], config['per_process'],
+                                    config['max_processes'])
+    reporter.read_record_file(record_file, config['symfs_dir'], config['kallsyms_file'],
+                              config['report_lib_options'])
+    return reporter.to_dict()
+
+
+def main():
+    parser = BaseArgumentParser(description=__doc__)
+    parser.add_argument('-i', '--record_file', nargs='+', action='append', help="""
+        Recording files. Default is perf.data when --sketch-input isn't used.""")
+    parser.add_argument('--sketch-input', nargs='+', action='append', help="""
+        Merge sketches saved by --sketch-output in previous runs.""")
+    parser.add_argument('--sketch-output', help='Save merged sketches to a json file.')
+    parser.add_argument('--symfs',
+                        help='Set the path to find binaries with symbols and debug info.')
+    parser.add_argument('--kallsyms', help='Set the path to find kernel symbols.')
+    parser.add_argument('-o', '--output', help='Report file. Default is stdout.')
+    parser.add_argument('--json', action='store_true', help='Write report in json format.')
+    parser.add_argument('--top', type=int, default=10, help='Report top n functions.')
+    parser.add_argument('--capacity', type=int, default=1000, help="""
+        Number of counters in each sketch. Errors of periods are less than
+        total / capacity, where total is the event count for self functions, and about the event
+        count times the callchain depth for children functions.""")
+    parser.add_argument('--per-process', action='store_true', help="""
+        Report top functions of each process, grouped by process name.""")
+    parser.add_argument('--max-processes', type=int, default=100, help="""
+        Max processes reported with --per-process. Other processes are counted as
+        "%s".""" % OTHER_PROCESSES)
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help="""
+        Use multiprocessing to read multiple recording files in parallel.""")
+    parser.add_report_lib_options()
+    args = parser.parse_args()
+    if args.jobs < 1:
+        log_exit('Invalid --jobs option.')
+    if args.top < 1 or args.capacity < args.top:
+        log_exit('--capacity should be at least --top, which should be positive.')
+    if args.max_processes < 1:
+        log_exit('Invalid --max-processes option.')
+
+    record_files = flatten_arg_list(args.record_file)
+    sketch_files = flatten_arg_list(args.sketch_input)
+    if not record_files and not sketch_files:
+        record_files.append('perf.data')
+
+    reporter = TopFunctionsReporter(args.capacity, args.per_process, args.max_processes)
+    with StageProfiler.stage('merge sketches'):
+        for sketch_file in sketch_files:
+            with open(sketch_file, 'r') as fh:
+                reporter.merge_dict(json.load(fh))
+    jobs = min(args.jobs, len(record_files))
+    if jobs > 1:
+        config = {
+            'capacity': args.capacity,
+            'per_process': args.per_process,
+            'max_processes': args.max_processes,
+            'symfs_dir': args.symfs,
+            'kallsyms_file': args.kallsyms,
+            'report_lib_options': args.report_lib_options,
+        }
+        with ProcessPoolExecutor(jobs) as executor:
+            futures = [executor.submit(read_record_file, record_file, config)
+                       for record_file in record_files]
+            # Merge results as soon as they are ready, to avoid keeping them in memory.
+            for future in as_completed(futures):
+                with StageProfiler.stage('merge sketches'):
+                    reporter.merge_dict(future.result())
+    else:
+        for record_file in record_files:
+            reporter.read_record_file(record_file, args.symfs, args.kallsyms,
+                                      args.report_lib_options)
+
+    with StageProfiler.stage('write report'):
+        if args.sketch_output:
+            with open(args.sketch_output, 'w') as fh:
+                json.dump(reporter.to_dict(), fh)
+        report = reporter.get_report(args.top)
+        fh = open(args.output, 'w') if args.output else sys.stdout
+        if args.json:
+            json.dump(report, fh, indent=2)
+        else:
+            write_text_report(report, fh)
+        if args.output:
+            fh.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -24,34 +24,44 @@ Example:
     | gzip >profile-part1.json.gz
   ./gecko_profile_generator.py -i perf.data --filter-file sample_filter_part2 \
     | gzip >profile-part2.json.gz
+
+  With --build-time-index, a time index file (perf.data.time_index) is saved next to the
+  recording file. Later runs of sample_filter.py read time ranges from the index instead of
+  reading samples. For recording files in report_sample proto format, reports with a filter file
+  only read samples in the time range of the filter file.
 """
 
 import logging
-from simpleperf_report_lib import ReportLib
+from simpleperf_report_lib import RecordTimeIndex
 from simpleperf_utils import BaseArgumentParser
-from typing import Tuple
+from typing import List, Optional, Tuple
 
 
 class RecordFileReader:
     def __init__(self, record_file: str):
         self.record_file = record_file
+        self.time_index: Optional[RecordTimeIndex] = None
+
+    def get_time_index(self) -> RecordTimeIndex:
+        """ Return the time index saved next to the recording file, or build it by reading
+            samples.
+        """
+        if not self.time_index:
+            self.time_index = RecordTimeIndex.load(self.record_file)
+            if not self.time_index:
+                self.time_index = RecordTimeIndex.build(self.record_file)
+        return self.time_index
 
     def get_time_range(self) -> Tuple[int, int]:
         """ Return a tuple of (min_timestamp, max_timestamp). """
-        min_timestamp = 0
-        max_timestamp = 0
-        lib = ReportLib()
-        lib.SetRecordFile(self.record_file)
-        while True:
-            sample = lib.GetNextSample()
-            if not sample:
-                break
-            if not min_timestamp or sample.time < min_timestamp:
-                min_timestamp = sample.time
-            if not max_timestamp or sample.time > max_timestamp:
-                max_timestamp = sample.time
-        lib.Close()
-        return (min_timestamp, max_timestamp)
+        time_index = self.get_time_index()
+        return (time_index.min_timestamp, time_index.max_timestamp)
+
+
+def build_time_index(record_file: str) -> None:
+    time_index = RecordTimeIndex.build(record_file)
+    time_index.save(record_file)
+    print('Generate time index file: %s' % RecordTimeIndex.get_index_path(record_file))
 
 
 def show_time_range(record_file: str) -> None:
@@ -60,9 +70,40 @@ def show_time_range(record_file: str) -> None:
     print('time range of samples is %.3f s' % ((time_range[1] - time_range[0]) / 1e9))
 
 
+def get_balanced_boundaries(time_index: RecordTimeIndex, begin: int, end: int, parts: int,
+                            split_by: str) -> List[int]:
+    """ Split time range [begin, end) into parts with about the same number of samples
+        (split_by == 'samples'), or the same cost (split_by == 'cost'). The cost of a sample is
+        its callchain depth. Samples are assumed to be evenly distributed in each bucket of the
+        time histogram. Return boundaries of the parts, starting with begin and ending with end.
+    """
+    field = 0 if split_by == 'samples' else 1
+    # [(piece begin, piece end, weight)] for parts of histogram buckets in [begin, end)
+    pieces = []
+    for bucket_begin, bucket_end, bucket in time_index.histogram.get_buckets(begin, end):
+        piece_begin, piece_end = max(bucket_begin, begin), min(bucket_end, end)
+        weight = bucket[field] * (piece_end - piece_begin) / (bucket_end - bucket_begin)
+        pieces.append((piece_begin, piece_end, weight))
+    total = sum(piece[2] for piece in pieces)
+    if not total:
+        step = (end - begin) / parts
+        return [begin + int(step * i) for i in range(parts)] + [end]
+
+    boundaries = [begin]
+    weight_before = 0
+    for piece_begin, piece_end, weight in pieces:
+        while len(boundaries) < parts and weight_before + weight >= total * len(boundaries) / parts:
+            target = total * len(boundaries) / parts - weight_before
+            timestamp = piece_begin + int(target / weight * (piece_end - piece_begin))
+            boundaries.append(min(max(timestamp, boundaries[-1] + 1), end))
+        weight_before += weight
+    boundaries += [end] * (parts + 1 - len(boundaries))
+    return boundaries
+
+
 def filter_samples(
         record_file: str, split_time_range: int, exclude_first_seconds: int,
-        exclude_last_seconds: int, output_file_prefix: str) -> None:
+        exclude_last_seconds: int, output_file_prefix: str, split_by: str = 'time') -> None:
     reader = RecordFileReader(record_file)
     min_timestamp, max_timestamp = reader.get_time_range()
     comment = 'total time range: %d seconds' % ((max_timestamp - min_timestamp) // 1e9)
@@ -82,6 +123,19 @@ def filter_samples(
             fh.write('GLOBAL_BEGIN %d\n' % min_timestamp)
             fh.write('GLOBAL_END %d\n' % max_timestamp)
         print('Generate sample filter file: %s' % output_file)
+    elif split_by != 'time':
+        boundaries = get_balanced_boundaries(reader.get_time_index(), min_timestamp,
+                                             max_timestamp + 1, split_time_range, split_by)
+        for i in range(split_time_range):
+            output_file = output_file_prefix + '_part%s' % (i + 1)
+            with open(output_file, 'w') as fh:
+                time_range_comment = 'current range: %d to %d seconds, split by %s' % (
+                    (boundaries[i] - min_timestamp) // 1e9,
+                    (boundaries[i + 1] - min_timestamp) // 1e9, split_by)
+                fh.write('// %s, %s\n' % (comment, time_range_comment))
+                fh.write('GLOBAL_BEGIN %d\n' % boundaries[i])
+                fh.write('GLOBAL_END %d\n' % boundaries[i + 1])
+            print('Generate sample filter file: %s' % output_file)
     else:
         step = (max_timestamp - min_timestamp) // split_time_range
         cur_timestamp = min_timestamp
@@ -106,9 +160,16 @@ def main():
     parser = BaseArgumentParser(description=__doc__)
     parser.add_argument('-i', '--record-file', nargs='?', default='perf.data',
                         help='Default is perf.data.')
+    parser.add_argument('--build-time-index', action='store_true', help="""
+                        save a time index file next to the recording file, used to show and
+                        split time ranges without reading samples""")
     parser.add_argument('--show-time-range', action='store_true', help='show time range of samples')
     parser.add_argument('--split-time-range', type=int,
                         help='split time ranges of samples into several parts')
+    parser.add_argument('--split-by', choices=['time', 'samples', 'cost'], default='time', help="""
+                        how to split time ranges: parts with the same duration, with about the
+                        same number of samples, or with about the same cost (samples weighted by
+                        callchain depth) to balance processing parts in parallel""")
     parser.add_argument('--exclude-first-seconds', type=int,
                         help='exclude samples recorded in the first seconds')
     parser.add_argument('--exclude-last-seconds', type=int,
@@ -118,12 +179,15 @@ def main():
         help='prefix for the generated sample filter files')
     args = parser.parse_args()
 
+    if args.build_time_index:
+        build_time_index(args.record_file)
+
     if args.show_time_range:
         show_time_range(args.record_file)
 
     if args.split_time_range or args.exclude_first_seconds or args.exclude_last_seconds:
         filter_samples(args.record_file, args.split_time_range, args.exclude_first_seconds,
-                       args.exclude_last_seconds, args.output_file_prefix)
+                       args.exclude_last_seconds, args.output_file_prefix, args.split_by)
 
 
 if __name__ == '__main__':
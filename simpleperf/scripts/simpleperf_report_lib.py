@@ -20,15 +20,22 @@
 
 """
 
+import bisect
 import collections
 from collections import namedtuple
 import ctypes as ct
+import dataclasses
+import itertools
+import json
+import logging
+import math
 from pathlib import Path
+import re
 import struct
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Set, Tuple, Union
 
 from simpleperf_utils import (bytes_to_str, get_host_binary_path, is_windows, log_exit,
-                              str_to_bytes, ReportLibOptions)
+                              str_to_bytes, ReportLibOptions, StageProfiler)
 
 
 def _is_null(p: Optional[ct._Pointer]) -> bool:
@@ -234,6 +241,108 @@ class FeatureSectionStructure(ct.Structure):
                 ('data_size', ct.c_uint32)]
 
 
+# A dso referenced by a recording file.
+#   path: dso path recorded on device, like /system/lib64/libc.so or [kernel.kallsyms].
+#   build_id: build id string like '0x...', or '' if not available.
+#   hit_count: number of samples hitting the dso, or None if not counted.
+DsoInfo = namedtuple('DsoInfo', ['path', 'build_id', 'hit_count'])
+
+# Dso types stored in the file feature section, as defined in dso.h.
+DSO_DEX_FILE = 3
+BUILD_ID_SIZE = 20
+
+
+def _read_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        _check(pos < len(data), 'data format error')
+        b = data[pos]
+        pos += 1
+        value |= (b & 0x7f) << shift
+        if b < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _parse_file_v2_msg(data: bytes) -> Tuple[str, int, int]:
+    """ Return (path, type, symbol_count) of a FileFeature message in record_file.proto. """
+    path = ''
+    dso_type = 0
+    symbol_count = 0
+    pos = 0
+    while pos < len(data):
+        key, pos = _read_varint(data, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = _read_varint(data, pos)
+            if field == 2:
+                dso_type = value
+        elif wire_type == 1:
+            pos += 8
+        elif wire_type == 2:
+            size, pos = _read_varint(data, pos)
+            if field == 1:
+                path = bytes_to_str(data[pos: pos + size])
+            elif field == 4:
+                symbol_count += 1
+            pos += size
+        elif wire_type == 5:
+            pos += 4
+        else:
+            raise RuntimeError('data format error')
+    return path, dso_type, symbol_count
+
+
+def parse_file_feature(data: bytes, is_v2: bool, skip_dex_files_without_symbols: bool = True
+                       ) -> List[str]:
+    """ Return dso paths stored in the file (is_v2 = False) or file2 (is_v2 = True) feature
+        section. If skip_dex_files_without_symbols is True, dex files without hit symbols are
+        skipped, because they are dumped even when not used by samples. It should be False when
+        symbols aren't dumped (`simpleperf record --no-dump-symbols`), because then no file has
+        symbols.
+    """
+    paths = []
+    pos = 0
+    while pos + 4 <= len(data):
+        size = struct.unpack_from('<I', data, pos)[0]
+        pos += 4
+        _check(pos + size <= len(data), 'data format error')
+        msg = data[pos: pos + size]
+        pos += size
+        if is_v2:
+            path, dso_type, symbol_count = _parse_file_v2_msg(msg)
+        else:
+            path_end = msg.index(b'\0')
+            path = bytes_to_str(msg[:path_end])
+            dso_type, _, symbol_count = struct.unpack_from('<IQI', msg, path_end + 1)
+        if skip_dex_files_without_symbols and dso_type == DSO_DEX_FILE and symbol_count == 0:
+            continue
+        paths.append(path)
+    return paths
+
+
+def parse_build_id_feature(data: bytes) -> Dict[str, str]:
+    """ Return a map from dso path to build id stored in the build_id feature section. Each
+        entry is a BuildIdRecord: perf_event_header, pid, build_id aligned to 8, and a
+        filename aligned to 64.
+    """
+    build_id_map = {}
+    pos = 0
+    while pos + 8 <= len(data):
+        size = struct.unpack_from('<IHH', data, pos)[2]
+        _check(size > 0 and pos + size <= len(data), 'data format error')
+        build_id_start = pos + 8 + 4
+        build_id = data[build_id_start: build_id_start + BUILD_ID_SIZE]
+        filename_start = build_id_start + 24
+        filename_end = data.index(b'\0', filename_start, pos + size)
+        path = bytes_to_str(data[filename_start: filename_end])
+        if any(build_id):
+            build_id_map[path] = '0x' + build_id.hex()
+        pos += size
+    return build_id_map
+
+
 class ReportLibStructure(ct.Structure):
     _fields_ = []
 
@@ -253,6 +362,147 @@ def SetReportOptionsForReportLib(report_lib, options: ReportLibOptions):
         report_lib.SetSampleFilter(options.sample_filters)
     if options.aggregate_threads:
         report_lib.AggregateThreads(options.aggregate_threads)
+    if options.sample_rate is not None or options.max_samples is not None:
+        report_lib.downsampler = SampleDownsampler(
+            options.sample_rate, options.max_samples, options.sampling_mode,
+            lambda: _read_sample_keys(type(report_lib), report_lib.record_file, options))
+
+
+def _read_sample_keys(report_lib_class, record_file: str,
+                      options: ReportLibOptions) -> Iterator[Tuple[int, int]]:
+    """ Yield (tid, time) of samples in a record file, without downsampling. """
+    lib = report_lib_class()
+    lib.SetRecordFile(record_file)
+    lib.SetReportOptions(dataclasses.replace(options, sample_rate=None, max_samples=None))
+    while True:
+        sample = lib.GetNextSample()
+        if sample is None:
+            break
+        yield sample.tid, sample.time
+    lib.Close()
+
+
+def _hash_to_unit_interval(tid: int, time: int) -> float:
+    """ Map (tid, time) to a number in [0, 1), using the splitmix64 finalizer. """
+    mask = (1 << 64) - 1
+    x = (time * 0x9E3779B97F4A7C15 + tid) & mask
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & mask
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & mask
+    x ^= x >> 31
+    return x / (1 << 64)
+
+
+class SampleDownsampler:
+    """ Select a deterministic subset of samples, used by --sample-rate and --max-samples.
+        A sample is kept with probability p, decided by a hash of its tid and time. The period of
+        a kept sample is divided by p, so event counts are unbiased estimates of the full profile.
+        In stratified mode, samples are grouped by thread and time bucket, and each group keeps
+        at least one sample on average.
+    """
+    TIME_BUCKET_NS = 100_000_000
+    TOP_FUNCTION_COUNT = 10
+    # z value of the 95% confidence interval
+    CONFIDENCE_Z = 1.96
+
+    def __init__(self, sample_rate: Optional[float], max_samples: Optional[int], mode: str,
+                 read_sample_keys: Callable[[], Iterator[Tuple[int, int]]]):
+        self.sample_rate = 1.0 if sample_rate is None else sample_rate
+        self.max_samples = max_samples
+        self.mode = mode
+        self.read_sample_keys = read_sample_keys
+        self.prepared = False
+        # (tid, time bucket) -> sample rate, used in stratified mode
+        self.stratum_rates: Optional[Dict[Tuple[int, int], float]] = None
+        self.samples_read = 0
+        self.samples_kept = 0
+        # fraction of scaled periods not reported yet, to keep the sum of periods unbiased
+        self.period_carry = 0.0
+        # function name -> [estimated period, variance of the estimate]
+        self.function_stats: Dict[str, List[float]] = collections.defaultdict(lambda: [0, 0])
+
+    def _prepare(self):
+        self.prepared = True
+        if self.max_samples is None and self.mode == 'uniform':
+            return
+        stratum_counts: Dict[Tuple[int, int], int] = collections.Counter()
+        for tid, time in self.read_sample_keys():
+            stratum_counts[(tid, time // self.TIME_BUCKET_NS)] += 1
+        total = sum(stratum_counts.values())
+        if self.max_samples is not None and total > self.max_samples:
+            self.sample_rate = min(self.sample_rate, self.max_samples / total)
+        if self.mode == 'stratified':
+            self.stratum_rates = {key: min(1.0, max(self.sample_rate, 1 / count))
+                                  for key, count in stratum_counts.items()}
+
+    def select(self, tid: int, time: int, period: int) -> Optional[Tuple[int, float]]:
+        """ Return (scaled period, sample rate) for a kept sample, or None to drop it. """
+        if not self.prepared:
+            self._prepare()
+        self.samples_read += 1
+        rate = self.sample_rate
+        if self.stratum_rates is not None:
+            rate = self.stratum_rates.get((tid, time // self.TIME_BUCKET_NS), rate)
+        if rate < 1 and _hash_to_unit_interval(tid, time) >= rate:
+            return None
+        self.samples_kept += 1
+        scaled_period = period / rate + self.period_carry
+        new_period = int(scaled_period)
+        self.period_carry = scaled_period - new_period
+        return new_period, rate
+
+    def add_function_period(self, function_name: str, period: int, rate: float):
+        """ Add the scaled period of a kept sample to the function it hits. """
+        stats = self.function_stats[function_name]
+        stats[0] += period
+        # Variance of the Horvitz-Thompson estimator for Bernoulli sampling.
+        stats[1] += (1 - rate) * period * period
+
+    def get_info(self) -> Dict[str, Any]:
+        """ Return the effective sampling factor and 95% confidence intervals of estimated
+            periods of top functions.
+        """
+        top_functions = []
+        for name, (period, variance) in sorted(
+                self.function_stats.items(), key=lambda item: item[1][0],
+                reverse=True)[:self.TOP_FUNCTION_COUNT]:
+            margin = self.CONFIDENCE_Z * math.sqrt(variance)
+            top_functions.append({'name': name, 'period': period,
+                                  'lower': max(0, period - margin), 'upper': period + margin})
+        return {
+            'mode': self.mode,
+            'sample_rate': self.sample_rate,
+            'sampling_factor': (self.samples_read / self.samples_kept
+                                if self.samples_kept else 0),
+            'samples_read': self.samples_read,
+            'samples_kept': self.samples_kept,
+            'confidence_level': 0.95,
+            'top_functions': top_functions,
+        }
+
+
+def ProfileReportLib(report_lib):
+    """ Used with --profile-stages. Add time spent in report lib methods to stages, and count
+        samples, frames and unique callchains.
+    """
+    report_lib.SetRecordFile = StageProfiler.timed('open record file', report_lib.SetRecordFile)
+    report_lib.GetNextSample = StageProfiler.timed(
+        'read samples', report_lib.GetNextSample, 'samples')
+    for name in ['GetEventOfCurrentSample', 'GetSymbolOfCurrentSample',
+                 'GetTracingDataOfCurrentSample']:
+        if hasattr(report_lib, name):
+            setattr(report_lib, name,
+                    StageProfiler.timed('read samples', getattr(report_lib, name)))
+    get_callchain = StageProfiler.timed('read samples', report_lib.GetCallChainOfCurrentSample)
+
+    def GetCallChainOfCurrentSample():
+        callchain = get_callchain()
+        StageProfiler.add_count('frames', callchain.nr + 1)
+        ips = [report_lib.GetCurrentSample().ip]
+        ips += [callchain.entries[i].ip for i in range(callchain.nr)]
+        StageProfiler.add_unique('unique callchains', tuple(ips))
+        return callchain
+
+    report_lib.GetCallChainOfCurrentSample = GetCallChainOfCurrentSample
 
 
 # pylint: disable=invalid-name
@@ -307,6 +557,10 @@ class ReportLib(object):
         self.meta_info: Optional[Dict[str, str]] = None
         self.current_sample: Optional[SampleStruct] = None
         self.record_cmd: Optional[str] = None
+        self.record_file: Optional[str] = None
+        self.downsampler: Optional[SampleDownsampler] = None
+        if StageProfiler.enabled:
+            ProfileReportLib(self)
 
     def _get_native_lib(self) -> str:
         return get_host_binary_path('libsimpleperf_report.so')
@@ -339,6 +593,7 @@ class ReportLib(object):
         """ Set the path of record file, like perf.data."""
         cond: bool = self._SetRecordFileFunc(self.getInstance(), _char_pt(record_file))
         _check(cond, 'Failed to set record file')
+        self.record_file = record_file
 
     def ShowIpForUnknownSymbol(self):
         self._ShowIpForUnknownSymbolFunc(self.getInstance())
@@ -433,11 +688,21 @@ class ReportLib(object):
 
     def GetNextSample(self) -> Optional[SampleStruct]:
         """ Return the next sample. If no more samples, return None. """
-        psample = self._GetNextSampleFunc(self.getInstance())
-        if _is_null(psample):
-            self.current_sample = None
-        else:
+        while True:
+            psample = self._GetNextSampleFunc(self.getInstance())
+            if _is_null(psample):
+                self.current_sample = None
+                break
             self.current_sample = psample[0]
+            if not self.downsampler:
+                break
+            selected = self.downsampler.select(
+                self.current_sample.tid, self.current_sample.time, self.current_sample.period)
+            if selected:
+                self.current_sample.period = selected[0]
+                self.downsampler.add_function_period(
+                    self.GetSymbolOfCurrentSample().symbol_name, selected[0], selected[1])
+                break
         return self.current_sample
 
     def GetCurrentSample(self) -> Optional[SampleStruct]:
@@ -515,9 +780,61 @@ class ReportLib(object):
                 result += c
         return result
 
+    def _GetFeatureData(self, feature_name: str) -> Optional[bytes]:
+        feature_data = self._GetFeatureSection(self.getInstance(), _char_pt(feature_name))
+        if _is_null(feature_data):
+            return None
+        return ct.string_at(feature_data[0].data, feature_data[0].data_size)
+
     def GetArch(self) -> str:
         return self._GetFeatureString('arch')
 
+    def GetDsoList(self, with_hit_counts: bool = False) -> List[DsoInfo]:
+        """ Return dsos referenced by the recording file, read from the file and build_id
+            feature sections without iterating samples.
+            If with_hit_counts is True, or the recording file doesn't have these feature
+            sections, all samples are read to count how many samples hit each dso. Then
+            GetNextSample() can't be used on the same ReportLib instance.
+        """
+        paths = []
+        symbols_dumped = '--no-dump-symbols' not in self.GetRecordCmd().split()
+        data = self._GetFeatureData('file2')
+        if data is not None:
+            paths = parse_file_feature(data, True, symbols_dumped)
+        else:
+            data = self._GetFeatureData('file')
+            if data is not None:
+                paths = parse_file_feature(data, False, symbols_dumped)
+        data = self._GetFeatureData('build_id')
+        build_id_map = parse_build_id_feature(data) if data is not None else {}
+        for path in build_id_map:
+            if path not in paths:
+                paths.append(path)
+
+        hit_counts = None
+        if with_hit_counts or not paths:
+            hit_counts = collections.Counter()
+            while self.GetNextSample():
+                dso_names = {self.GetSymbolOfCurrentSample().dso_name}
+                callchain = self.GetCallChainOfCurrentSample()
+                for i in range(callchain.nr):
+                    dso_names.add(callchain.entries[i].symbol.dso_name)
+                hit_counts.update(dso_names)
+            for path in hit_counts:
+                if path not in paths:
+                    paths.append(path)
+                    build_id_map[path] = self.GetBuildIdForPath(path)
+            if not with_hit_counts:
+                hit_counts = None
+        return [DsoInfo(path, build_id_map.get(path, ''),
+                        None if hit_counts is None else hit_counts[path]) for path in paths]
+
+    def GetDownsamplingInfo(self) -> Optional[Dict[str, Any]]:
+        """ Return downsampling info set by --sample-rate or --max-samples, or None if samples
+            aren't downsampled. It is complete after reading all samples.
+        """
+        return self.downsampler.get_info() if self.downsampler else None
+
     def MetaInfo(self) -> Dict[str, str]:
         """ Return a string to string map stored in meta_info section in perf.data.
             It is used to pass some short meta information.
@@ -558,6 +875,213 @@ ProtoCallChain = namedtuple('ProtoCallChain', ['nr', 'entries'])
 ProtoCallChainEntry = namedtuple('ProtoCallChainEntry', ['ip', 'symbol'])
 
 
+class TimeRanges:
+    """ A sorted list of non-overlapping time ranges [begin, end). Like TimeRanges in
+        RecordFilter.cpp, a range is started by begin() and finished by end(). A range not
+        finished extends to the end of the recording.
+    """
+    MAX_TIMESTAMP = (1 << 64) - 1
+
+    def __init__(self):
+        self.ranges: List[Tuple[int, int]] = []
+        self.begins: List[int] = []
+        self.begin_time: Optional[int] = None
+
+    def begin(self, timestamp: int):
+        # A range already started isn't changed.
+        if self.begin_time is None:
+            self.begin_time = timestamp
+
+    def end(self, timestamp: int):
+        # An end without a begin is ignored.
+        if self.begin_time is not None:
+            _check(self.begin_time < timestamp,
+                   f'invalid time range in filter file: begin time {self.begin_time} >= ' +
+                   f'end time {timestamp}')
+            self.add(self.begin_time, timestamp)
+            self.begin_time = None
+
+    def add(self, begin: int, end: int):
+        self.ranges.append((begin, end))
+
+    def build(self):
+        """ Sort and merge ranges. It should be called after adding all ranges. """
+        if self.begin_time is not None:
+            self.add(self.begin_time, self.MAX_TIMESTAMP)
+            self.begin_time = None
+        merged: List[List[int]] = []
+        for begin, end in sorted(self.ranges):
+            if merged and begin <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([begin, end])
+        self.ranges = [(begin, end) for begin, end in merged]
+        self.begins = [begin for begin, _ in self.ranges]
+
+    def contains(self, timestamp: int) -> bool:
+        i = bisect.bisect_right(self.begins, timestamp) - 1
+        return i >= 0 and timestamp < self.ranges[i][1]
+
+
+class ProtoSampleFilter:
+    """ Sample filter options of ReportLib.SetSampleFilter(), compiled to filter samples in
+        ProtoFileReportLib: pids and tids are kept in sets, name regexes are compiled, and time
+        ranges in the filter file are kept in sorted lists.
+    """
+
+    def __init__(self, filters: List[str]):
+        self.exclude_pids: Set[int] = set()
+        self.exclude_tids: Set[int] = set()
+        self.include_pids: Set[int] = set()
+        self.include_tids: Set[int] = set()
+        self.exclude_process_names: List[re.Pattern] = []
+        self.exclude_thread_names: List[re.Pattern] = []
+        self.include_process_names: List[re.Pattern] = []
+        self.include_thread_names: List[re.Pattern] = []
+        self.global_ranges: Optional[TimeRanges] = None
+        self.process_ranges: Dict[int, TimeRanges] = {}
+        self.thread_ranges: Dict[int, TimeRanges] = {}
+        id_options = {
+            '--exclude-pid': self.exclude_pids,
+            '--exclude-tid': self.exclude_tids,
+            '--include-pid': self.include_pids,
+            '--include-tid': self.include_tids,
+        }
+        name_options = {
+            '--exclude-process-name': self.exclude_process_names,
+            '--exclude-thread-name': self.exclude_thread_names,
+            '--include-process-name': self.include_process_names,
+            '--include-thread-name': self.include_thread_names,
+        }
+        _check(len(filters) % 2 == 0, f'invalid sample filter: {filters}')
+        for i in range(0, len(filters), 2):
+            option, value = filters[i], filters[i + 1]
+            if option in id_options:
+                id_options[option].update(int(s) for s in value.split(','))
+            elif option in name_options:
+                name_options[option].append(re.compile(value))
+            elif option == '--cpu':
+                logging.warning('cpus of samples are not recorded in report_sample profiles, ' +
+                                'so --cpu is ignored')
+            elif option == '--filter-file':
+                self._read_filter_file(value)
+            else:
+                _check(False, f'unsupported sample filter option: {option}')
+
+    def _read_filter_file(self, filter_file: str):
+        """ Read time ranges in a filter file, in the same way as FilterFileReader in
+            RecordFilter.cpp.
+        """
+        global_ranges = self.global_ranges or TimeRanges()
+        with open(filter_file, 'r') as fh:
+            for line in fh:
+                items = line.split()
+                if not items or items[0].startswith('//'):
+                    continue
+                cmd, args = items[0], items[1:]
+                if cmd == 'CLOCK':
+                    # Timestamps of samples in report_sample profiles use the monotonic clock.
+                    _check(args == ['monotonic'],
+                           f'only the monotonic clock is supported for report_sample profiles: '
+                           f'{line}')
+                elif cmd == 'GLOBAL_BEGIN':
+                    global_ranges.begin(int(args[0]))
+                elif cmd == 'GLOBAL_END':
+                    global_ranges.end(int(args[0]))
+                elif cmd in ('PROCESS_BEGIN', 'PROCESS_END', 'THREAD_BEGIN', 'THREAD_END'):
+                    ranges_map = (self.process_ranges if cmd.startswith('PROCESS')
+                                  else self.thread_ranges)
+                    ranges = ranges_map.setdefault(int(args[0]), TimeRanges())
+                    if cmd.endswith('_BEGIN'):
+                        ranges.begin(int(args[1]))
+                    else:
+                        ranges.end(int(args[1]))
+                else:
+                    _check(False, f'unknown command in filter file: {line}')
+        for ranges in [global_ranges, *self.process_ranges.values(),
+                       *self.thread_ranges.values()]:
+            ranges.build()
+        # Without global ranges, samples aren't filtered by global time.
+        self.global_ranges = global_ranges if global_ranges.ranges else None
+
+    @property
+    def has_time_filter(self) -> bool:
+        return bool(self.global_ranges or self.process_ranges or self.thread_ranges)
+
+    def check_thread(self, pid: int, tid: int, process_name: str, thread_name: str) -> bool:
+        """ Return True if samples of a thread pass the filter, ignoring timestamps. """
+        if pid in self.exclude_pids or tid in self.exclude_tids:
+            return False
+        if self.include_pids and pid not in self.include_pids:
+            return False
+        if self.include_tids and tid not in self.include_tids:
+            return False
+        if any(r.search(process_name) for r in self.exclude_process_names):
+            return False
+        if any(r.search(thread_name) for r in self.exclude_thread_names):
+            return False
+        if self.include_process_names and not any(
+                r.search(process_name) for r in self.include_process_names):
+            return False
+        if self.include_thread_names and not any(
+                r.search(thread_name) for r in self.include_thread_names):
+            return False
+        return True
+
+    def check_time(self, pid: int, tid: int, timestamp: int) -> bool:
+        """ Return True if a sample passes time ranges in the filter file. """
+        if self.global_ranges and not self.global_ranges.contains(timestamp):
+            return False
+        if self.process_ranges:
+            ranges = self.process_ranges.get(pid)
+            if not ranges or not ranges.contains(timestamp):
+                return False
+        if self.thread_ranges:
+            ranges = self.thread_ranges.get(tid)
+            if not ranges or not ranges.contains(timestamp):
+                return False
+        return True
+
+
+def iter_proto_records(data: bytes, base_offset: int, record_class) -> Iterator[
+        Tuple[int, int, Any]]:
+    """ Parse size-prefixed records in data, which starts at base_offset of a recording file in
+        report_sample proto format. Yield (begin offset, end offset, record) for each record.
+    """
+    i = 0
+    while i < len(data):
+        _check(i + 4 <= len(data), 'data format error')
+        size = struct.unpack('<I', data[i:i + 4])[0]
+        if size == 0:
+            break
+        _check(i + 4 + size <= len(data), 'data format error')
+        record = record_class()
+        record.ParseFromString(data[i + 4: i + 4 + size])
+        yield base_offset + i, base_offset + i + 4 + size, record
+        i += 4 + size
+
+
+def iter_proto_records_in_file(fh: BinaryIO, record_class) -> Iterator[Tuple[int, int, Any]]:
+    """ Like iter_proto_records(), but read records one by one from the current position of a
+        file, so memory usage doesn't grow with the file size.
+    """
+    offset = fh.tell()
+    while True:
+        size_data = fh.read(4)
+        if not size_data:
+            break
+        _check(len(size_data) == 4, 'data format error')
+        size = struct.unpack('<I', size_data)[0]
+        if size == 0:
+            break
+        record_data = fh.read(size)
+        _check(len(record_data) == size, 'data format error')
+        record = record_class()
+        record.ParseFromString(record_data)
+        yield offset, offset + 4 + size, record
+        offset += 4 + size
+
+
 class ProtoFileReportLib:
     """ Read contents from profile in cmd_report_sample.proto format.
         It is generated by `simpleperf report-sample`.
@@ -581,16 +1105,34 @@ class ProtoFileReportLib:
     def __init__(self):
         self.record_file = None
         self.report_sample_pb2 = ProtoFileReportLib.get_report_sample_pb2()
-        self.records: List[self.report_sample_pb2.Record] = []
+        # None if sample records aren't read yet.
+        self.records: Optional[List[self.report_sample_pb2.Record]] = []
+        self.time_index: Optional[RecordTimeIndex] = None
         self.record_index = -1
         self.files: List[self.report_sample_pb2.File] = []
         self.thread_map: Dict[int, self.report_sample_pb2.Thread] = {}
         self.meta_info: Optional[self.report_sample_pb2.MetaInfo] = None
         self.fake_mapping_starts = []
+        # (file_id, symbol_id, vaddr_in_file) -> ProtoCallChainEntry
+        self.callchain_entries: Dict[Tuple[int, int, int], ProtoCallChainEntry] = {}
         self.sample_queue: List[self.report_sample_pb2.Sample] = collections.deque()
         self.trace_offcpu_mode = None
         # mapping from thread id to the last off-cpu sample in the thread
         self.offcpu_samples = {}
+        self.downsampler: Optional[SampleDownsampler] = None
+        self.sample_filter: Optional[ProtoSampleFilter] = None
+        # tid -> whether samples of the thread pass the sample filter, ignoring timestamps
+        self.thread_filter_results: Dict[int, bool] = {}
+        self.aggregate_thread_regexes: List[re.Pattern] = []
+        # regex index -> (pid, tid) of the first thread matching the regex
+        self.aggregate_thread_representatives: Dict[int, Tuple[int, int]] = {}
+        # tid -> (pid, tid, thread name) of the thread it is aggregated into
+        self.aggregated_threads: Dict[int, Tuple[int, int, str]] = {}
+        self.remove_method_regexes: List[re.Pattern] = []
+        # file id -> ids of symbols removed by RemoveMethod()
+        self.removed_symbols: Dict[int, Set[int]] = {}
+        if StageProfiler.enabled:
+            ProfileReportLib(self)
 
     def Close(self):
         pass
@@ -606,23 +1148,33 @@ class ProtoFileReportLib:
         pass
 
     def SetRecordFile(self, record_file: str):
+        """ Read the recording file. If it has a valid time index (built by
+            `sample_filter.py --build-time-index`), samples are read later, only in the time
+            ranges of the sample filter.
+        """
         self.record_file = record_file
+        self.time_index = RecordTimeIndex.load(record_file)
         with open(record_file, 'rb') as fh:
-            data = fh.read()
+            if self.time_index and self.time_index.sample_region:
+                region_begin, region_end = self.time_index.sample_region
+                data = fh.read(region_begin)
+                fh.seek(region_end)
+                data_after_samples = fh.read()
+            else:
+                data = fh.read()
+                data_after_samples = b''
         _check(data[:10] == b'SIMPLEPERF', f'magic number mismatch: {data[:10]}')
         version = struct.unpack('<H', data[10:12])[0]
         _check(version == 1, f'version mismatch: {version}')
-        i = 12
-        while i < len(data):
-            _check(i + 4 <= len(data), 'data format error')
-            size = struct.unpack('<I', data[i:i + 4])[0]
-            if size == 0:
-                break
-            i += 4
-            _check(i + size <= len(data), 'data format error')
-            record = self.report_sample_pb2.Record()
-            record.ParseFromString(data[i: i + size])
-            i += size
+        if self.time_index and self.time_index.sample_region:
+            # Sample records are read in _read_sample_records().
+            self.records = None
+            records = itertools.chain(
+                iter_proto_records(data[12:], 12, self.report_sample_pb2.Record),
+                iter_proto_records(data_after_samples, region_end, self.report_sample_pb2.Record))
+        else:
+            records = iter_proto_records(data[12:], 12, self.report_sample_pb2.Record)
+        for _, _, record in records:
             if record.HasField('sample') or record.HasField('context_switch'):
                 self.records.append(record)
             elif record.HasField('file'):
@@ -638,6 +1190,25 @@ class ProtoFileReportLib:
             self.fake_mapping_starts.append(fake_mapping_start)
             fake_mapping_start += len(file.symbol) + 1
 
+    def _read_sample_records(self):
+        """ Read sample records using the time index. When the sample filter has global time
+            ranges, only read records in those ranges. In off-cpu modes, the period of a sample
+            depends on the next sample of the thread, so all records are read.
+        """
+        begin, end = self.time_index.sample_region
+        if (self.sample_filter and self.sample_filter.global_ranges and
+                self.trace_offcpu_mode in (None, 'on-cpu')):
+            ranges = self.sample_filter.global_ranges.ranges
+            begin, end = self.time_index.get_offset_range(ranges[0][0], ranges[-1][1])
+        self.records = []
+        if begin < end:
+            with open(self.record_file, 'rb') as fh:
+                fh.seek(begin)
+                data = fh.read(end - begin)
+            for _, _, record in iter_proto_records(data, begin, self.report_sample_pb2.Record):
+                if record.HasField('sample') or record.HasField('context_switch'):
+                    self.records.append(record)
+
     def AddProguardMappingFile(self, mapping_file: Union[str, Path]):
         """ Add proguard mapping.txt to de-obfuscate method names. """
         raise NotImplementedError(
@@ -652,10 +1223,15 @@ class ProtoFileReportLib:
 
     def RemoveMethod(self, method_name_regex: str):
         """ Remove methods with name containing method_name_regex. """
-        raise NotImplementedError("Removing method isn't implemented for report_sample profiles")
+        self.remove_method_regexes.append(re.compile(method_name_regex))
+        self.removed_symbols.clear()
 
     def SetSampleFilter(self, filters: List[str]):
-        raise NotImplementedError('sample filters are not implemented for report_sample profiles')
+        """ Set options used to filter samples, in the same format as ReportLib.SetSampleFilter().
+            Samples are filtered before reading their callchains.
+        """
+        self.sample_filter = ProtoSampleFilter(filters)
+        self.thread_filter_results.clear()
 
     def GetSupportedTraceOffCpuModes(self) -> List[str]:
         """ Get trace-offcpu modes supported by the recording file. It should be called after
@@ -686,21 +1262,35 @@ class ProtoFileReportLib:
             into one thread. As a result, samples from different threads (like a thread pool) can be
             shown in one flamegraph.
         """
-        raise NotImplementedError(
-            'Aggregating threads are not implemented for report_sample profiles')
+        self.aggregate_thread_regexes = [re.compile(s) for s in thread_name_regex_list]
+        self.aggregate_thread_representatives.clear()
+        self.aggregated_threads.clear()
 
     def GetNextSample(self) -> Optional[ProtoSample]:
+        if self.records is None:
+            self._read_sample_records()
         if self.sample_queue:
             self.sample_queue.popleft()
-        while not self.sample_queue:
-            self.record_index += 1
-            if self.record_index >= len(self.records):
+        while True:
+            while not self.sample_queue:
+                self.record_index += 1
+                if self.record_index >= len(self.records):
+                    break
+                record = self.records[self.record_index]
+                if record.HasField('sample'):
+                    self._process_sample_record(record.sample)
+                elif record.HasField('context_switch'):
+                    self._process_context_switch(record.context_switch)
+            if not self.sample_queue or not self.downsampler:
+                break
+            sample = self.sample_queue[0]
+            selected = self.downsampler.select(sample.thread_id, sample.time, sample.event_count)
+            if selected:
+                sample.event_count = selected[0]
+                self.downsampler.add_function_period(
+                    self.GetSymbolOfCurrentSample().symbol_name, selected[0], selected[1])
                 break
-            record = self.records[self.record_index]
-            if record.HasField('sample'):
-                self._process_sample_record(record.sample)
-            elif record.HasField('context_switch'):
-                self._process_context_switch(record.context_switch)
+            self.sample_queue.popleft()
         return self.GetCurrentSample()
 
     def _process_sample_record(self, sample) -> None:
@@ -736,15 +1326,75 @@ class ProtoFileReportLib:
             self._add_to_sample_queue(prev_offcpu_sample)
 
     def _add_to_sample_queue(self, sample) -> None:
+        if self.sample_filter and not self._check_sample_filter(sample):
+            return
+        if self.remove_method_regexes and not self._remove_methods(sample):
+            return
         self.sample_queue.append(sample)
 
+    def _check_sample_filter(self, sample) -> bool:
+        tid = sample.thread_id
+        thread = self.thread_map[tid]
+        result = self.thread_filter_results.get(tid)
+        if result is None:
+            process = self.thread_map.get(thread.process_id, thread)
+            result = self.thread_filter_results[tid] = self.sample_filter.check_thread(
+                thread.process_id, tid, process.thread_name, thread.thread_name)
+        if result and self.sample_filter.has_time_filter:
+            result = self.sample_filter.check_time(thread.process_id, tid, sample.time)
+        return result
+
+    def _remove_methods(self, sample) -> bool:
+        """ Remove callchain entries of methods removed by RemoveMethod(). Return False if all
+            entries are removed.
+        """
+        callchain = sample.callchain
+        for i in reversed(range(len(callchain))):
+            entry = callchain[i]
+            removed = self.removed_symbols.get(entry.file_id)
+            if removed is None:
+                removed = self.removed_symbols[entry.file_id] = self._get_removed_symbols(
+                    self.files[entry.file_id])
+            if entry.symbol_id in removed:
+                del callchain[i]
+        return len(callchain) > 0
+
+    def _get_removed_symbols(self, file) -> Set[int]:
+        removed = set()
+        for symbol_id, name in enumerate(list(file.symbol) + ['unknown']):
+            if any(r.search(name) for r in self.remove_method_regexes):
+                # The unknown symbol has id -1.
+                removed.add(symbol_id if symbol_id < len(file.symbol) else -1)
+        return removed
+
+    def _get_aggregated_thread(self, tid: int) -> Tuple[int, int, str]:
+        """ Return (pid, tid, thread name) of a thread after aggregation. Threads matching a
+            regex are shown as the first thread matching it, with the regex as the thread name.
+        """
+        aggregated_thread = self.aggregated_threads.get(tid)
+        if aggregated_thread is None:
+            thread = self.thread_map[tid]
+            aggregated_thread = (thread.process_id, tid, thread.thread_name)
+            for i, regex in enumerate(self.aggregate_thread_regexes):
+                if regex.fullmatch(thread.thread_name):
+                    pid, first_tid = self.aggregate_thread_representatives.setdefault(
+                        i, (thread.process_id, tid))
+                    aggregated_thread = (pid, first_tid, regex.pattern)
+                    break
+            self.aggregated_threads[tid] = aggregated_thread
+        return aggregated_thread
+
     def GetCurrentSample(self) -> Optional[ProtoSample]:
         if not self.sample_queue:
             return None
         sample = self.sample_queue[0]
-        thread = self.thread_map[sample.thread_id]
+        if self.aggregate_thread_regexes:
+            pid, tid, thread_name = self._get_aggregated_thread(sample.thread_id)
+        else:
+            thread = self.thread_map[sample.thread_id]
+            pid, tid, thread_name = thread.process_id, thread.thread_id, thread.thread_name
         return ProtoSample(
-            ip=0, pid=thread.process_id, tid=thread.thread_id, thread_comm=thread.thread_name,
+            ip=0, pid=pid, tid=tid, thread_comm=thread_name,
             time=sample.time, in_kernel=False, cpu=0, period=sample.event_count)
 
     def GetEventOfCurrentSample(self) -> ProtoEvent:
@@ -758,17 +1408,25 @@ class ProtoFileReportLib:
 
     def GetSymbolOfCurrentSample(self) -> ProtoSymbol:
         sample = self.sample_queue[0]
-        node = sample.callchain[0]
-        return self._build_symbol(node)
+        return self._get_callchain_entry(sample.callchain[0]).symbol
 
     def GetCallChainOfCurrentSample(self) -> ProtoCallChain:
-        entries = []
         sample = self.sample_queue[0]
-        for node in sample.callchain[1:]:
-            symbol = self._build_symbol(node)
-            entries.append(ProtoCallChainEntry(ip=0, symbol=symbol))
+        get_entry = self._get_callchain_entry
+        entries = [get_entry(node) for node in sample.callchain[1:]]
         return ProtoCallChain(nr=len(entries), entries=entries)
 
+    def _get_callchain_entry(self, node) -> ProtoCallChainEntry:
+        """ Return the callchain entry of a callchain node. Entries only depend on
+            (file_id, symbol_id, vaddr_in_file), so they are built once and shared by samples.
+        """
+        key = (node.file_id, node.symbol_id, node.vaddr_in_file)
+        entry = self.callchain_entries.get(key)
+        if entry is None:
+            entry = self.callchain_entries[key] = ProtoCallChainEntry(
+                ip=0, symbol=self._build_symbol(node))
+        return entry
+
     def _build_symbol(self, node) -> ProtoSymbol:
         file = self.files[node.file_id]
         if node.symbol_id == -1:
@@ -777,7 +1435,7 @@ class ProtoFileReportLib:
             fake_symbol_pgoff = 0
         else:
             symbol_name = file.symbol[node.symbol_id]
-            fake_symbol_addr = self.fake_mapping_starts[node.file_id] = node.symbol_id + 1
+            fake_symbol_addr = self.fake_mapping_starts[node.file_id] + node.symbol_id + 1
             fake_symbol_pgoff = node.symbol_id + 1
         mapping = ProtoMapping(fake_symbol_addr, 1, fake_symbol_pgoff)
         return ProtoSymbol(dso_name=file.path, vaddr_in_file=node.vaddr_in_file,
@@ -792,10 +1450,255 @@ class ProtoFileReportLib:
     def GetArch(self) -> str:
         return ''
 
+    def GetDsoList(self, with_hit_counts: bool = False) -> List[DsoInfo]:
+        # Different files (like JIT caches) can share the same path.
+        paths = list(dict.fromkeys(file.path for file in self.files))
+        hit_counts = None
+        if with_hit_counts:
+            if self.records is None:
+                self._read_sample_records()
+            hit_counts = collections.Counter()
+            for record in self.records:
+                if record.HasField('sample'):
+                    hit_counts.update({self.files[entry.file_id].path
+                                       for entry in record.sample.callchain})
+        return [DsoInfo(path, '', None if hit_counts is None else hit_counts[path])
+                for path in paths]
+
+    def GetDownsamplingInfo(self) -> Optional[Dict[str, Any]]:
+        """ Return downsampling info set by --sample-rate or --max-samples, or None if samples
+            aren't downsampled. It is complete after reading all samples.
+        """
+        return self.downsampler.get_info() if self.downsampler else None
+
     def MetaInfo(self) -> Dict[str, str]:
         return {}
 
 
+class TimeHistogram:
+    """ A histogram of sample timestamps in fixed memory. Each bucket covers 2^width_shift ns.
+        When samples span more than max_buckets buckets, adjacent buckets are merged, doubling
+        the bucket width. Each bucket keeps [sample count, cost, begin offset, end offset]. The
+        cost of a sample is its callchain depth, to estimate the time to process it. The offsets
+        cover records of samples in the recording file.
+    """
+
+    def __init__(self, max_buckets: int = 1024):
+        self.max_buckets = max_buckets
+        self.width_shift = 0
+        # bucket index (timestamp >> width_shift) -> [count, cost, begin offset, end offset]
+        self.buckets: Dict[int, List[int]] = {}
+        self.min_index = 0
+        self.max_index = 0
+
+    def add(self, timestamp: int, cost: int, begin_offset: int = 0, end_offset: int = 0,
+            count: int = 1):
+        """ Add a record. Records not counted as samples (like context switches) use count 0,
+            so they only extend the offsets of the bucket.
+        """
+        index = timestamp >> self.width_shift
+        if not self.buckets:
+            self.min_index = self.max_index = index
+        else:
+            while max(self.max_index, index) - min(self.min_index, index) >= self.max_buckets:
+                self._double_width()
+                index = timestamp >> self.width_shift
+            self.min_index = min(self.min_index, index)
+            self.max_index = max(self.max_index, index)
+        self._merge_bucket(self.buckets, index, [count, cost, begin_offset, end_offset])
+
+    @staticmethod
+    def _merge_bucket(buckets: Dict[int, List[int]], index: int, value: List[int]):
+        bucket = buckets.get(index)
+        if bucket is None:
+            buckets[index] = value
+        else:
+            bucket[0] += value[0]
+            bucket[1] += value[1]
+            bucket[2] = min(bucket[2], value[2])
+            bucket[3] = max(bucket[3], value[3])
+
+    def _double_width(self):
+        buckets: Dict[int, List[int]] = {}
+        for index, bucket in self.buckets.items():
+            self._merge_bucket(buckets, index >> 1, bucket)
+        self.buckets = buckets
+        self.width_shift += 1
+        self.min_index >>= 1
+        self.max_index >>= 1
+
+    def get_buckets(self, begin: int, end: int) -> Iterator[Tuple[int, int, List[int]]]:
+        """ Yield (bucket begin time, bucket end time, bucket) for buckets overlapping
+            [begin, end), sorted by time.
+        """
+        for index in sorted(self.buckets):
+            bucket_begin = index << self.width_shift
+            bucket_end = (index + 1) << self.width_shift
+            if bucket_begin < end and bucket_end > begin:
+                yield bucket_begin, bucket_end, self.buckets[index]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'max_buckets': self.max_buckets, 'width_shift': self.width_shift,
+                'buckets': [[index] + bucket for index, bucket in sorted(self.buckets.items())]}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'TimeHistogram':
+        histogram = cls(data['max_buckets'])
+        histogram.width_shift = data['width_shift']
+        histogram.buckets = {item[0]: item[1:] for item in data['buckets']}
+        if histogram.buckets:
+            histogram.min_index = min(histogram.buckets)
+            histogram.max_index = max(histogram.buckets)
+        return histogram
+
+
+class RecordTimeIndex:
+    """ An index of sample timestamps in a recording file, built in one pass. It has the time
+        range of samples, a TimeHistogram of samples, and sample counts of each thread and cpu.
+        For recording files in report_sample proto format, it also has file offsets of sample
+        records, which are used by ProtoFileReportLib to only read samples in a time range.
+        It is saved in a sidecar file (<record_file>.time_index), and is only used while the
+        size and modification time of the recording file don't change.
+    """
+    VERSION = 2
+    SUFFIX = '.time_index'
+
+    def __init__(self):
+        self.record_file_size = 0
+        self.record_file_mtime_ns = 0
+        self.sample_count = 0
+        self.min_timestamp = 0
+        self.max_timestamp = 0
+        self.histogram = TimeHistogram()
+        self.thread_sample_counts: Dict[int, int] = collections.Counter()
+        # Only available for perf.data. Samples in proto files don't have cpu.
+        self.cpu_sample_counts: Dict[int, int] = collections.Counter()
+        # [begin, end) offsets of sample records in proto files. It is None for perf.data, or
+        # when other records are mixed with sample records.
+        self.sample_region: Optional[Tuple[int, int]] = None
+
+    @staticmethod
+    def get_index_path(record_file: str) -> str:
+        return record_file + RecordTimeIndex.SUFFIX
+
+    @classmethod
+    def build(cls, record_file: str) -> 'RecordTimeIndex':
+        index = cls()
+        stat = Path(record_file).stat()
+        index.record_file_size = stat.st_size
+        index.record_file_mtime_ns = stat.st_mtime_ns
+        if ProtoFileReportLib.is_supported_format(record_file):
+            index._read_proto_file(record_file)
+        else:
+            lib = ReportLib()
+            lib.SetRecordFile(record_file)
+            while True:
+                sample = lib.GetNextSample()
+                if sample is None:
+                    break
+                depth = lib.GetCallChainOfCurrentSample().nr + 1
+                index._add_sample(sample.time, sample.tid, sample.cpu, depth)
+            lib.Close()
+        return index
+
+    def _read_proto_file(self, record_file: str):
+        record_class = ProtoFileReportLib.get_report_sample_pb2().Record
+        region_begin = region_end = None
+        # Whether other records are seen after sample records, and then followed by samples.
+        has_other_records = mixed = False
+        with open(record_file, 'rb') as fh:
+            # Skip the file header.
+            fh.seek(12)
+            for begin, end, record in iter_proto_records_in_file(fh, record_class):
+                if record.HasField('sample') or record.HasField('context_switch'):
+                    if region_begin is None:
+                        region_begin = begin
+                    elif has_other_records:
+                        mixed = True
+                    region_end = end
+                    if record.HasField('sample'):
+                        self._add_sample(record.sample.time, record.sample.thread_id, None,
+                                         len(record.sample.callchain), begin, end)
+                    else:
+                        # Context switches aren't samples, but are read with samples in
+                        # off-cpu modes.
+                        self.histogram.add(record.context_switch.time, 0, begin, end, count=0)
+                elif region_begin is not None and not record.HasField('lost'):
+                    has_other_records = True
+        if region_begin is not None and not mixed:
+            self.sample_region = (region_begin, region_end)
+
+    def _add_sample(self, timestamp: int, tid: int, cpu: Optional[int], depth: int,
+                    begin_offset: int = 0, end_offset: int = 0):
+        if not self.sample_count or timestamp < self.min_timestamp:
+            self.min_timestamp = timestamp
+        if not self.sample_count or timestamp > self.max_timestamp:
+            self.max_timestamp = timestamp
+        self.sample_count += 1
+        self.histogram.add(timestamp, depth, begin_offset, end_offset)
+        self.thread_sample_counts[tid] += 1
+        if cpu is not None:
+            self.cpu_sample_counts[cpu] += 1
+
+    def get_offset_range(self, begin: int, end: int) -> Tuple[int, int]:
+        """ Return [begin, end) offsets covering sample records in time range [begin, end). """
+        buckets = [bucket for _, _, bucket in self.histogram.get_buckets(begin, end)]
+        if not buckets:
+            return (0, 0)
+        return (min(bucket[2] for bucket in buckets), max(bucket[3] for bucket in buckets))
+
+    def save(self, record_file: str):
+        data = {
+            'version': self.VERSION,
+            'record_file_size': self.record_file_size,
+            'record_file_mtime_ns': self.record_file_mtime_ns,
+            'sample_count': self.sample_count,
+            'min_timestamp': self.min_timestamp,
+            'max_timestamp': self.max_timestamp,
+            'histogram': self.histogram.to_dict(),
+            'thread_sample_counts': self.thread_sample_counts,
+            'cpu_sample_counts': self.cpu_sample_counts,
+            'sample_region': self.sample_region,
+        }
+        with open(self.get_index_path(record_file), 'w') as fh:
+            json.dump(data, fh)
+
+    @classmethod
+    def load(cls, record_file: str) -> Optional['RecordTimeIndex']:
+        """ Load the time index of a recording file. Return None if it doesn't exist, or is out
+            of date.
+        """
+        index_path = Path(cls.get_index_path(record_file))
+        if not index_path.is_file():
+            return None
+        try:
+            with open(index_path, 'r') as fh:
+                data = json.load(fh)
+            stat = Path(record_file).stat()
+            if (data.get('version') != cls.VERSION or data['record_file_size'] != stat.st_size or
+                    data['record_file_mtime_ns'] != stat.st_mtime_ns):
+                logging.info('ignore out of date time index %s', index_path)
+                return None
+            index = cls()
+            index.record_file_size = data['record_file_size']
+            index.record_file_mtime_ns = data['record_file_mtime_ns']
+            index.sample_count = data['sample_count']
+            index.min_timestamp = data['min_timestamp']
+            index.max_timestamp = data['max_timestamp']
+            index.histogram = TimeHistogram.from_dict(data['histogram'])
+            index.thread_sample_counts = collections.Counter(
+                {int(tid): count for tid, count in data['thread_sample_counts'].items()})
+            index.cpu_sample_counts = collections.Counter(
+                {int(cpu): count for cpu, count in data['cpu_sample_counts'].items()})
+            if data['sample_region']:
+                index.sample_region = tuple(data['sample_region'])
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            # A broken index is treated as absent, and can be rebuilt.
+            logging.warning('failed to read %s', index_path)
+            return None
+        return index
+
+
 def GetReportLib(record_file: str) -> Union[ReportLib, ProtoFileReportLib]:
     if ProtoFileReportLib.is_supported_format(record_file):
         lib = ProtoFileReportLib()
@@ -803,3 +1706,17 @@ def GetReportLib(record_file: str) -> Union[ReportLib, ProtoFileReportLib]:
         lib = ReportLib()
     lib.SetRecordFile(record_file)
     return lib
+
+
+def GetSampleRateOfRecordFile(record_file: str, options: ReportLibOptions) -> float:
+    """ Return the sample rate used by --sample-rate and --max-samples for the whole record file.
+        It can be passed to readers of parts of the record file, which can't compute it from
+        --max-samples themselves.
+    """
+    report_lib_class = (ProtoFileReportLib if ProtoFileReportLib.is_supported_format(record_file)
+                        else ReportLib)
+    downsampler = SampleDownsampler(
+        options.sample_rate, options.max_samples, 'uniform',
+        lambda: _read_sample_keys(report_lib_class, record_file, options))
+    downsampler._prepare()
+    return downsampler.sample_rate
@@ -20,18 +20,25 @@
 
 from __future__ import annotations
 import argparse
+import atexit
 from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass
+import json
 import logging
+import mmap
 import os
 import os.path
 from pathlib import Path
 import re
 import shutil
+import struct
 import subprocess
 import sys
+import threading
 import time
-from typing import Any, Dict, Iterator, List, Optional, Set, Tuple, Union, TextIO
+from typing import (Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Set, Tuple, Union,
+                    TextIO)
 
 
 NDK_ERROR_MESSAGE = "Please install the Android NDK (https://developer.android.com/studio/projects/install-ndk), then set NDK path with --ndk_path option."
@@ -209,9 +216,92 @@ class ToolFinder:
         path = 'toolchains/llvm/prebuilt/%s-x86_64/bin/%s' % (platform, name)
         return (name, path)
 
+    # Found tool paths are kept in a persistent cache, keyed by tool name, ndk path, arch and
+    # environment. They are checked by tool mtimes. SIMPLEPERF_TOOL_CACHE can set the cache
+    # file path, or disable the cache when it is empty.
+    CACHE_VERSION = 1
+    CACHE_MAX_ENTRIES = 256
+    _cache: Optional[Dict[str, list]] = None
+
+    @classmethod
+    def get_cache_path(cls) -> Optional[str]:
+        path = os.environ.get('SIMPLEPERF_TOOL_CACHE')
+        if path is not None:
+            return path or None
+        if is_windows():
+            cache_dir = os.environ.get('LOCALAPPDATA')
+        else:
+            cache_dir = os.environ.get('XDG_CACHE_HOME')
+            if not cache_dir and os.environ.get('HOME'):
+                cache_dir = os.path.join(os.environ['HOME'], '.cache')
+        if not cache_dir:
+            return None
+        return os.path.join(cache_dir, 'simpleperf', 'tool_paths.json')
+
+    @classmethod
+    def _load_cache(cls) -> Dict[str, list]:
+        if cls._cache is None:
+            cls._cache = {}
+            path = cls.get_cache_path()
+            if path:
+                try:
+                    with open(path, 'r') as fh:
+                        data = json.load(fh)
+                    if data['version'] == cls.CACHE_VERSION:
+                        cls._cache = data['tools']
+                except (OSError, ValueError, KeyError, TypeError):
+                    pass
+        return cls._cache
+
+    @classmethod
+    def _save_cache(cls):
+        path = cls.get_cache_path()
+        if not path:
+            return
+        while len(cls._cache) > cls.CACHE_MAX_ENTRIES:
+            del cls._cache[next(iter(cls._cache))]
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'w') as fh:
+                json.dump({'version': cls.CACHE_VERSION, 'tools': cls._cache}, fh)
+            os.replace(tmp_path, path)
+        except OSError:
+            remove(tmp_path)
+
+    @staticmethod
+    def _get_tool_mtime(path: str) -> Optional[int]:
+        if not os.path.dirname(path):
+            path = shutil.which(path)
+            if not path:
+                return None
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
     @classmethod
     def find_tool_path(cls, toolname: str, ndk_path: Optional[str] = None,
                        arch: Optional[str] = None) -> Optional[str]:
+        key = json.dumps([toolname, os.path.abspath(ndk_path) if ndk_path else '', arch or '',
+                          os.environ.get('PATH', ''), os.environ.get('HOME', ''),
+                          get_script_dir()])
+        cache = cls._load_cache()
+        entry = cache.get(key)
+        if entry and entry[1] == cls._get_tool_mtime(entry[0]):
+            return entry[0]
+        path = cls._probe_tool_path(toolname, ndk_path, arch)
+        if path:
+            mtime = cls._get_tool_mtime(path)
+            if mtime is not None:
+                cache[key] = [path, mtime]
+                cls._save_cache()
+        return path
+
+    @classmethod
+    def _probe_tool_path(cls, toolname: str, ndk_path: Optional[str] = None,
+                         arch: Optional[str] = None) -> Optional[str]:
+        """ Find a tool by running candidate paths. """
         tool_info = cls.EXPECTED_TOOLS.get(toolname)
         if not tool_info:
             return None
@@ -267,14 +357,131 @@ class ToolFinder:
         return None
 
 
+class AdbShellSession:
+    """ A persistent `adb shell` process, running shell cmds written to its stdin. The output of
+        each cmd is followed by a marker line carrying the exit code of the cmd.
+    """
+
+    def __init__(self, adb_path: str, env: Optional[Dict[str, str]]):
+        self.marker = 'SIMPLEPERF_CMD_END_' + os.urandom(8).hex()
+        self.proc = subprocess.Popen([adb_path, 'shell'], env=env, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def run(self, cmds: List[str]) -> Optional[List[Tuple[bool, str]]]:
+        """ Run shell cmds in one round trip. Return (result, stdout) for each cmd, or None if
+            the session is broken.
+        """
+        script = ''
+        for cmd in cmds:
+            # Run each cmd in a subshell, so it can't read our stdin or change the shell state.
+            script += "(%s\n) </dev/null 2>/dev/null\nprintf '\\n%s %%d\\n' $?\n" % (
+                cmd, self.marker)
+        try:
+            self.proc.stdin.write(str_to_bytes(script))
+            self.proc.stdin.flush()
+            results = []
+            lines = []
+            while len(results) < len(cmds):
+                line = bytes_to_str(self.proc.stdout.readline())
+                if not line:
+                    return None
+                if line.startswith(self.marker):
+                    # Remove the newline printed before the marker.
+                    output = ''.join(lines)[:-1]
+                    results.append((line.split()[1] == '0', output))
+                    lines = []
+                else:
+                    lines.append(line)
+            return results
+        except (OSError, IndexError):
+            return None
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.proc.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+
 class AdbHelper(object):
-    def __init__(self, enable_switch_to_root: bool = True):
-        adb_path = ToolFinder.find_tool_path('adb')
-        if not adb_path:
-            log_exit("Can't find adb in PATH environment.")
-        self.adb_path: str = adb_path
+    # Adb cmds restarting adbd or the connection, which break the shell session.
+    CMDS_BREAKING_SHELL_SESSION = {'root', 'unroot', 'reboot', 'remount', 'wait-for-device',
+                                   'disconnect', 'kill-server', 'tcpip', 'usb'}
+
+    def __init__(self, enable_switch_to_root: bool = True, use_shell_session: bool = True):
+        """ If use_shell_session is True, shell cmds run through a persistent `adb shell`
+            process, instead of forking an adb process for each cmd. It falls back to forking
+            adb processes if the session doesn't work.
+        """
+        self._adb_path: Optional[str] = None
         self.enable_switch_to_root = enable_switch_to_root
         self.serial_number: Optional[str] = None
+        self.use_shell_session = use_shell_session
+        self.shell_session: Optional[AdbShellSession] = None
+        self.shell_session_serial_number: Optional[str] = None
+        # The shell session can be used by multiple threads.
+        self.shell_session_lock = threading.Lock()
+
+    @property
+    def adb_path(self) -> str:
+        """ Find adb when it is first used. """
+        if self._adb_path is None:
+            self._adb_path = ToolFinder.find_tool_path('adb')
+            if not self._adb_path:
+                log_exit("Can't find adb in PATH environment.")
+        return self._adb_path
+
+    @adb_path.setter
+    def adb_path(self, path: str):
+        self._adb_path = path
+
+    def _get_env(self) -> Optional[Dict[str, str]]:
+        if not self.serial_number:
+            return None
+        env = os.environ.copy()
+        env['ANDROID_SERIAL'] = self.serial_number
+        return env
+
+    def close_shell_session(self):
+        with self.shell_session_lock:
+            if self.shell_session:
+                self.shell_session.close()
+                self.shell_session = None
+
+    def run_shell_cmds(self, cmds: List[str]) -> List[Tuple[bool, str]]:
+        """ Run shell cmds in one round trip through the shell session. Return (result, stdout)
+            for each cmd. Stderr of the cmds is dropped.
+        """
+        if self.use_shell_session:
+            with self.shell_session_lock:
+                if self.shell_session and (
+                        self.shell_session_serial_number != self.serial_number):
+                    self.shell_session.close()
+                    self.shell_session = None
+                new_session = self.shell_session is None
+                if new_session:
+                    logging.debug('start adb shell session')
+                    self.shell_session = AdbShellSession(self.adb_path, self._get_env())
+                    self.shell_session_serial_number = self.serial_number
+                results = self.shell_session.run(cmds)
+                if results is not None:
+                    for cmd, (result, _) in zip(cmds, results):
+                        logging.debug('run adb shell cmd: %s  [result %s]' % (cmd, result))
+                    return results
+                self.shell_session.close()
+                self.shell_session = None
+                if new_session:
+                    logging.debug("adb shell session doesn't work, run adb cmds instead")
+                    self.use_shell_session = False
+        results = []
+        for cmd in cmds:
+            results.append(self._run_adb_cmd(['shell', cmd], False, False))
+        return results
 
     def is_device_available(self) -> bool:
         return self.run_and_return_output(['shell', 'whoami'])[0]
@@ -284,14 +491,23 @@ class AdbHelper(object):
 
     def run_and_return_output(self, adb_args: List[str], log_output: bool = False,
                               log_stderr: bool = False) -> Tuple[bool, str]:
+        if (self.use_shell_session and not log_stderr and len(adb_args) > 1 and
+                adb_args[0] == 'shell'):
+            cmd = ' '.join(str(arg) for arg in adb_args[1:])
+            result, stdout_data = self.run_shell_cmds([cmd])[0]
+            if log_output and stdout_data:
+                logging.debug(stdout_data)
+            return (result, stdout_data)
+        if adb_args and adb_args[0] in self.CMDS_BREAKING_SHELL_SESSION:
+            self.close_shell_session()
+        return self._run_adb_cmd(adb_args, log_output, log_stderr)
+
+    def _run_adb_cmd(self, adb_args: List[str], log_output: bool,
+                     log_stderr: bool) -> Tuple[bool, str]:
         adb_args = [self.adb_path] + adb_args
         logging.debug('run adb cmd: %s' % adb_args)
-        env = None
-        if self.serial_number:
-            env = os.environ.copy()
-            env['ANDROID_SERIAL'] = self.serial_number
         subproc = subprocess.Popen(
-            adb_args, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            adb_args, env=self._get_env(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         stdout_data, stderr_data = subproc.communicate()
         stdout_data = bytes_to_str(stdout_data)
         stderr_data = bytes_to_str(stderr_data)
@@ -304,6 +520,27 @@ class AdbHelper(object):
         logging.debug('run adb cmd: %s  [result %s]' % (adb_args, result))
         return (result, stdout_data)
 
+    def read_tar_stream(self, adb_args: List[str]) -> Iterator[Tuple[str, BinaryIO]]:
+        """ Run an adb cmd writing a tar archive to stdout, like `exec-out tar -cf - ...`.
+            Yield (path, file object) for each regular file in the archive, without buffering
+            the whole archive in memory. Raise tarfile.TarError for a broken archive.
+        """
+        # tarfile imports compression modules, which are slow to import.
+        import tarfile
+
+        adb_args = [self.adb_path] + adb_args
+        logging.debug('run adb cmd: %s' % adb_args)
+        subproc = subprocess.Popen(
+            adb_args, env=self._get_env(), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            with tarfile.open(fileobj=subproc.stdout, mode='r|') as tar:
+                for member in tar:
+                    if member.isfile():
+                        yield member.name, tar.extractfile(member)
+        finally:
+            subproc.stdout.close()
+            subproc.wait()
+
     def check_run(self, adb_args: List[str], log_output: bool = False):
         self.check_run_and_return_output(adb_args, log_output)
 
@@ -347,6 +584,18 @@ class AdbHelper(object):
         result, stdoutdata = self.run_and_return_output(['shell', 'getprop', name])
         return stdoutdata.strip() if result else None
 
+    def get_properties(self, names: List[str]) -> Dict[str, Optional[str]]:
+        """ Get multiple properties in one shell cmd. """
+        result, stdoutdata = self.run_and_return_output(['shell', 'getprop'])
+        if not result:
+            return {name: None for name in names}
+        props = {}
+        for line in stdoutdata.splitlines():
+            m = re.match(r'\[(.*?)\]: \[(.*)\]$', line.strip())
+            if m:
+                props[m.group(1)] = m.group(2).strip()
+        return {name: props.get(name, '') for name in names}
+
     def set_property(self, name: str, value: str) -> bool:
         return self.run(['shell', 'setprop', name, value])
 
@@ -367,9 +616,10 @@ class AdbHelper(object):
 
     def get_android_version(self) -> int:
         """ Get Android version on device, like 7 is for Android N, 8 is for Android O."""
-        build_version = self.get_property('ro.build.version.codename')
+        props = self.get_properties(['ro.build.version.codename', 'ro.build.version.release'])
+        build_version = props['ro.build.version.codename']
         if not build_version or build_version == 'REL':
-            build_version = self.get_property('ro.build.version.release')
+            build_version = props['ro.build.version.release']
         android_version = 0
         if build_version:
             if build_version[0].isdigit():
@@ -417,6 +667,211 @@ def open_report_in_browser(report_path: str):
         webbrowser.open_new_tab(report_path)
 
 
+class BuildIdList:
+    """ Map build ids to binary paths in binary_cache. It is stored in two files:
+        1. build_id_list: lines in format "<build_id>=<path_in_binary_cache>", read by simpleperf.
+        2. build_id_list.sorted: a binary file with records sorted by build id, which can be
+           searched through mmap without parsing the whole file. It is used when it was written
+           together with the current build_id_list.
+    """
+    TEXT_FILE = 'build_id_list'
+    SORTED_FILE = 'build_id_list.sorted'
+    # magic, version, size and mtime of build_id_list, record count
+    SORTED_HEADER = struct.Struct('<8sIQQI')
+    SORTED_MAGIC = b'BUILDIDS'
+    SORTED_VERSION = 1
+    # build id (20 bytes), offset and size of path in the string data
+    SORTED_RECORD = struct.Struct('<20sII')
+
+    def __init__(self, binary_cache_dir: Path):
+        self.binary_cache_dir = binary_cache_dir
+        # Map from build id to path relative to binary_cache_dir. It is None until needed.
+        self.entries: Optional[Dict[str, str]] = None
+        # Map from path to build ids, the reverse of entries. build_id_list written by other
+        # tools can have multiple build ids for a path.
+        self.path_to_build_ids: Dict[str, Set[str]] = {}
+        self.sorted_data: Optional[mmap.mmap] = None
+        self.record_count = 0
+        self.changed = False
+
+    def exists(self) -> bool:
+        return (self.binary_cache_dir / self.TEXT_FILE).is_file()
+
+    def load(self):
+        """ Use the sorted file if it is up to date. Otherwise, parse build_id_list. """
+        if not self._load_sorted_file():
+            self._load_entries()
+
+    def _get_text_file_key(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.binary_cache_dir / self.TEXT_FILE)
+        except OSError:
+            return None
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def _load_sorted_file(self) -> bool:
+        text_file_key = self._get_text_file_key()
+        if text_file_key is None:
+            return False
+        try:
+            with open(self.binary_cache_dir / self.SORTED_FILE, 'rb') as fh:
+                header = fh.read(self.SORTED_HEADER.size)
+                if len(header) != self.SORTED_HEADER.size:
+                    return False
+                magic, version, text_size, text_mtime, count = self.SORTED_HEADER.unpack(header)
+                if (magic != self.SORTED_MAGIC or version != self.SORTED_VERSION or
+                        (text_size, text_mtime) != text_file_key):
+                    return False
+                self.sorted_data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+                self.record_count = count
+                return True
+        except (OSError, ValueError):
+            return False
+
+    def _load_entries(self):
+        if self.entries is not None:
+            return
+        self.entries = {}
+        if self.sorted_data:
+            for i in range(self.record_count):
+                build_id, path = self._get_record(i)
+                self._set_entry('0x' + build_id.hex(), path)
+            self.sorted_data.close()
+            self.sorted_data = None
+            return
+        build_id_list_file = self.binary_cache_dir / self.TEXT_FILE
+        if build_id_list_file.is_file():
+            with open(build_id_list_file, 'rb') as fh:
+                for line in fh:
+                    # lines are in format "<build_id>=<path_in_binary_cache>".
+                    items = bytes_to_str(line).strip().split('=')
+                    if len(items) == 2:
+                        self._set_entry(items[0], items[1])
+
+    def _set_entry(self, build_id: str, path: str):
+        if build_id in self.entries:
+            self._del_entry(build_id)
+        self.entries[build_id] = path
+        self.path_to_build_ids.setdefault(path, set()).add(build_id)
+
+    def _del_entry(self, build_id: str):
+        path = self.entries.pop(build_id)
+        build_ids = self.path_to_build_ids[path]
+        build_ids.discard(build_id)
+        if not build_ids:
+            del self.path_to_build_ids[path]
+
+    def _get_record(self, i: int) -> Tuple[bytes, str]:
+        build_id, offset, size = self.SORTED_RECORD.unpack_from(
+            self.sorted_data, self.SORTED_HEADER.size + i * self.SORTED_RECORD.size)
+        start = self.SORTED_HEADER.size + self.record_count * self.SORTED_RECORD.size + offset
+        return build_id, bytes_to_str(self.sorted_data[start: start + size])
+
+    @classmethod
+    def _build_id_to_bytes(cls, build_id: str) -> Optional[bytes]:
+        """ Only padded build ids ("0x" + 40 hex numbers) can be stored in the sorted file. """
+        if len(build_id) == 42 and build_id.startswith('0x'):
+            try:
+                return bytes.fromhex(build_id[2:])
+            except ValueError:
+                pass
+        return None
+
+    def get(self, build_id: str) -> Optional[Path]:
+        """ Return the path of a binary in binary_cache. """
+        if self.sorted_data is not None:
+            key = self._build_id_to_bytes(build_id)
+            if key is None:
+                return None
+            record_size = self.SORTED_RECORD.size
+            lo, hi = 0, self.record_count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                offset = self.SORTED_HEADER.size + mid * record_size
+                mid_key = self.sorted_data[offset: offset + 20]
+                if mid_key < key:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo < self.record_count:
+                record_key, path = self._get_record(lo)
+                if record_key == key:
+                    return self.binary_cache_dir / path
+            return None
+        self._load_entries()
+        path = self.entries.get(build_id)
+        return self.binary_cache_dir / path if path else None
+
+    def items(self) -> Iterator[Tuple[str, Path]]:
+        self._load_entries()
+        for build_id, path in self.entries.items():
+            yield build_id, self.binary_cache_dir / path
+
+    def add(self, build_id: str, path: Union[Path, str]):
+        """ Add a binary in binary_cache. A path maps to only one build id. """
+        self._load_entries()
+        relative_path = str(Path(path).relative_to(self.binary_cache_dir))
+        if self.entries.get(build_id) == relative_path:
+            return
+        for old_build_id in list(self.path_to_build_ids.get(relative_path, ())):
+            self._del_entry(old_build_id)
+        self._set_entry(build_id, relative_path)
+        self.changed = True
+
+    def remove_path(self, path: Union[Path, str]):
+        """ Remove the build id of a binary in binary_cache, like when it no longer has one. """
+        self._load_entries()
+        relative_path = str(Path(path).relative_to(self.binary_cache_dir))
+        for build_id in list(self.path_to_build_ids.get(relative_path, ())):
+            self._del_entry(build_id)
+            self.changed = True
+
+    def remove_missing_files(self):
+        self._load_entries()
+        for build_id, path in list(self.entries.items()):
+            if not (self.binary_cache_dir / path).is_file():
+                self._del_entry(build_id)
+                self.changed = True
+
+    def save(self):
+        """ Write build_id_list and build_id_list.sorted if changed. """
+        self._load_entries()
+        if not self.changed and self.exists():
+            return
+        items = sorted(self.entries.items())
+        text_file = self.binary_cache_dir / self.TEXT_FILE
+        sorted_file = self.binary_cache_dir / self.SORTED_FILE
+        # Write in binary mode to avoid "\r\n" problem on windows, which can confuse simpleperf.
+        with open(text_file, 'wb') as fh:
+            for build_id, path in items:
+                fh.write(str_to_bytes(f'{build_id}={path}\n'))
+
+        records = []
+        for build_id, path in items:
+            key = self._build_id_to_bytes(build_id)
+            if key is None:
+                # Can't be stored in the sorted file. Readers will parse build_id_list instead.
+                if sorted_file.is_file():
+                    sorted_file.unlink()
+                self.changed = False
+                return
+            records.append((key, str_to_bytes(path)))
+        records.sort()
+        text_size, text_mtime = self._get_text_file_key()
+        data = [self.SORTED_HEADER.pack(self.SORTED_MAGIC, self.SORTED_VERSION, text_size,
+                                        text_mtime, len(records))]
+        offset = 0
+        for key, path_bytes in records:
+            data.append(self.SORTED_RECORD.pack(key, offset, len(path_bytes)))
+            offset += len(path_bytes)
+        data += [path_bytes for _, path_bytes in records]
+        tmp_file = sorted_file.with_name(sorted_file.name + '.tmp')
+        with open(tmp_file, 'wb') as fh:
+            fh.write(b''.join(data))
+        os.replace(tmp_file, sorted_file)
+        self.changed = False
+
+
 class BinaryFinder:
     def __init__(self, binary_cache_dir: Optional[Union[Path, str]], readelf: ReadElf):
         if isinstance(binary_cache_dir, str):
@@ -425,25 +880,19 @@ class BinaryFinder:
         self.readelf = readelf
         self.build_id_map = self._load_build_id_map()
 
-    def _load_build_id_map(self) -> Dict[str, Path]:
-        build_id_map: Dict[str, Path] = {}
+    def _load_build_id_map(self) -> Optional[BuildIdList]:
         if self.binary_cache_dir:
-            build_id_list_file = self.binary_cache_dir / 'build_id_list'
-            if build_id_list_file.is_file():
-                with open(self.binary_cache_dir / 'build_id_list', 'rb') as fh:
-                    for line in fh.readlines():
-                        # lines are in format "<build_id>=<path_in_binary_cache>".
-                        items = bytes_to_str(line).strip().split('=')
-                        if len(items) == 2:
-                            build_id_map[items[0]] = self.binary_cache_dir / items[1]
-        return build_id_map
+            build_id_list = BuildIdList(self.binary_cache_dir)
+            build_id_list.load()
+            return build_id_list
+        return None
 
     def find_binary(self, dso_path_in_record_file: str,
                     expected_build_id: Optional[str]) -> Optional[Path]:
         """ If expected_build_id is None, don't check build id.
             Otherwise, the build id of the found binary should match the expected one."""
         # Find binary from build id map.
-        if expected_build_id:
+        if expected_build_id and self.build_id_map:
             path = self.build_id_map.get(expected_build_id)
             if path and self._check_path(path, expected_build_id):
                 return path
@@ -536,14 +985,22 @@ class Addr2Nearestline(object):
     def __init__(
             self, ndk_path: Optional[str],
             binary_finder: BinaryFinder, with_function_name: bool):
-        self.symbolizer_path = ToolFinder.find_tool_path('llvm-symbolizer', ndk_path)
-        if not self.symbolizer_path:
-            log_exit("Can't find llvm-symbolizer. " + NDK_ERROR_MESSAGE)
+        self.ndk_path = ndk_path
+        self._symbolizer_path: Optional[str] = None
         self.readelf = ReadElf(ndk_path)
         self.dso_map: Dict[str, Addr2Nearestline.Dso] = {}  # map from dso_path to Dso.
         self.binary_finder = binary_finder
         self.with_function_name = with_function_name
 
+    @property
+    def symbolizer_path(self) -> str:
+        """ Find llvm-symbolizer when it is first used. """
+        if self._symbolizer_path is None:
+            self._symbolizer_path = ToolFinder.find_tool_path('llvm-symbolizer', self.ndk_path)
+            if not self._symbolizer_path:
+                log_exit("Can't find llvm-symbolizer. " + NDK_ERROR_MESSAGE)
+        return self._symbolizer_path
+
     def add_addr(self, dso_path: str, build_id: Optional[str], func_addr: int, addr: int):
         dso = self.dso_map.get(dso_path)
         if dso is None:
@@ -552,7 +1009,9 @@ class Addr2Nearestline(object):
             dso.addrs[addr] = self.Addr(func_addr)
 
     def convert_addrs_to_lines(self, jobs: int):
-        with ThreadPoolExecutor(jobs) as executor:
+        StageProfiler.add_count('addr2line addrs', sum(len(dso.addrs)
+                                                       for dso in self.dso_map.values()))
+        with StageProfiler.stage('symbolization (addr2line)'), ThreadPoolExecutor(jobs) as executor:
             futures: List[Future] = []
             for dso_path, dso in self.dso_map.items():
                 futures.append(executor.submit(self._convert_addrs_in_one_dso, dso_path, dso))
@@ -845,10 +1304,12 @@ class Objdump(object):
         if arch == 'arm' and 'llvm-objdump' in objdump_path:
             args += ['--print-imm-hex']
         logging.debug('disassembling: %s', ' '.join(args))
+        StageProfiler.add_count('disassembled functions')
         try:
-            subproc = subprocess.Popen(args, stdout=subprocess.PIPE)
-            (stdoutdata, _) = subproc.communicate()
-            stdoutdata = bytes_to_str(stdoutdata)
+            with StageProfiler.stage('disassembly (objdump)'):
+                subproc = subprocess.Popen(args, stdout=subprocess.PIPE)
+                (stdoutdata, _) = subproc.communicate()
+                stdoutdata = bytes_to_str(stdoutdata)
         except OSError:
             return None
 
@@ -889,10 +1350,12 @@ class Objdump(object):
                 real_path]
         if arch == 'arm' and 'llvm-objdump' in objdump_path:
             args += ['--print-imm-hex']
+        StageProfiler.add_count('disassembled functions', len(sorted_addr_ranges))
         try:
-            proc = subprocess.Popen(args, stdout=subprocess.PIPE, text=True)
-            result = self._parse_disassembly_for_functions(proc.stdout, sorted_addr_ranges)
-            proc.wait()
+            with StageProfiler.stage('disassembly (objdump)'):
+                proc = subprocess.Popen(args, stdout=subprocess.PIPE, text=True)
+                result = self._parse_disassembly_for_functions(proc.stdout, sorted_addr_ranges)
+                proc.wait()
         except OSError:
             return None
         return result
@@ -942,9 +1405,17 @@ class ReadElf(object):
     """ A wrapper of readelf. """
 
     def __init__(self, ndk_path: Optional[str]):
-        self.readelf_path = ToolFinder.find_tool_path('llvm-readelf', ndk_path)
-        if not self.readelf_path:
-            log_exit("Can't find llvm-readelf. " + NDK_ERROR_MESSAGE)
+        self.ndk_path = ndk_path
+        self._readelf_path: Optional[str] = None
+
+    @property
+    def readelf_path(self) -> str:
+        """ Find llvm-readelf when it is first used. """
+        if self._readelf_path is None:
+            self._readelf_path = ToolFinder.find_tool_path('llvm-readelf', self.ndk_path)
+            if not self._readelf_path:
+                log_exit("Can't find llvm-readelf. " + NDK_ERROR_MESSAGE)
+        return self._readelf_path
 
     @staticmethod
     def is_elf_file(path: Union[Path, str]) -> bool:
@@ -1089,6 +1560,175 @@ class Log:
         cls.logger.addHandler(handler)
 
 
+class StageProfiler:
+    """ Measure time spent in named stages, and count events (like samples and frames) of a
+        script. It is enabled by the --profile-stages option, and prints a summary at exit.
+        When not enabled, stage() and add_count() do nothing.
+    """
+    enabled = False
+    lock = threading.Lock()
+
+    @classmethod
+    def init(cls, output_format: str = 'text', output_file: Optional[str] = None,
+             cprofile_file: Optional[str] = None, trace_memory: bool = False):
+        cls.enabled = True
+        cls.output_format = output_format
+        cls.output_file = output_file
+        cls.cprofile_file = cprofile_file
+        cls.trace_memory = trace_memory
+        cls.start_time = time.perf_counter()
+        # stage name -> [calls, seconds, peak memory in bytes]
+        cls.stages: Dict[str, List[Union[int, float]]] = {}
+        cls.counters: Dict[str, int] = {}
+        # counter name -> hashes of unique keys
+        cls.unique_keys: Dict[str, Set[int]] = {}
+        # Stack of [peak memory before entering a stage, max peak memory of child stages].
+        cls.memory_stack: List[List[int]] = []
+        if trace_memory:
+            import tracemalloc
+            tracemalloc.start()
+        cls.profiler = None
+        if cprofile_file:
+            import cProfile
+            cls.profiler = cProfile.Profile()
+            cls.profiler.enable()
+        atexit.register(cls.report)
+
+    @classmethod
+    @contextmanager
+    def stage(cls, name: str) -> Iterator[None]:
+        """ Add the time spent in a with block to a stage. Nested stages are included in the
+            time of the outer stage. Stages running in multiple threads add up their time.
+        """
+        if not cls.enabled:
+            yield
+            return
+        # Add the stage now, to show stages in the order they start.
+        cls.add_stage_time(name, 0.0, calls=0)
+        trace_memory = cls.trace_memory and threading.current_thread() is threading.main_thread()
+        if trace_memory:
+            import tracemalloc
+            cls.memory_stack.append([tracemalloc.get_traced_memory()[1], 0])
+            tracemalloc.reset_peak()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            cls.add_stage_time(name, time.perf_counter() - start_time)
+            if trace_memory:
+                peak_before, child_peak = cls.memory_stack.pop()
+                peak = max(tracemalloc.get_traced_memory()[1], child_peak)
+                with cls.lock:
+                    stage = cls.stages[name]
+                    stage[2] = max(stage[2], peak)
+                if cls.memory_stack:
+                    parent = cls.memory_stack[-1]
+                    parent[1] = max(parent[1], peak, peak_before)
+
+    @classmethod
+    def add_stage_time(cls, name: str, seconds: float, calls: int = 1):
+        with cls.lock:
+            stage = cls.stages.get(name)
+            if stage is None:
+                stage = cls.stages[name] = [0, 0.0, 0]
+            stage[0] += calls
+            stage[1] += seconds
+
+    @classmethod
+    def add_count(cls, name: str, count: int = 1):
+        if cls.enabled:
+            with cls.lock:
+                cls.counters[name] = cls.counters.get(name, 0) + count
+
+    @classmethod
+    def add_unique(cls, name: str, key: Any):
+        """ Count unique keys (like callchains) in a counter. """
+        if cls.enabled:
+            with cls.lock:
+                cls.unique_keys.setdefault(name, set()).add(hash(key))
+
+    @classmethod
+    def timed(cls, name: str, func: Callable, counter: Optional[str] = None) -> Callable:
+        """ Wrap a function to add its run time to a stage. If counter is set, count calls
+            returning a value other than None in it.
+        """
+        def wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            result = func(*args, **kwargs)
+            cls.add_stage_time(name, time.perf_counter() - start_time)
+            if counter and result is not None:
+                cls.add_count(counter)
+            return result
+        return wrapper
+
+    @classmethod
+    def get_summary(cls) -> Dict[str, Any]:
+        total_time = time.perf_counter() - cls.start_time
+        counters = dict(cls.counters)
+        for name, keys in cls.unique_keys.items():
+            counters[name] = len(keys)
+        summary = {
+            'total_seconds': total_time,
+            'stages': {
+                name: {'calls': calls, 'seconds': seconds,
+                       'percent': seconds * 100 / total_time if total_time else 0}
+                for name, (calls, seconds, _) in cls.stages.items()},
+            'counters': {
+                name: {'count': count, 'per_second': count / total_time if total_time else 0}
+                for name, count in counters.items()},
+        }
+        if cls.trace_memory:
+            import tracemalloc
+            # Peak memory is only traced for stages using stage() in the main thread.
+            for name, (_, _, peak) in cls.stages.items():
+                if peak:
+                    summary['stages'][name]['peak_memory_bytes'] = peak
+            summary['peak_memory_bytes'] = max(
+                [tracemalloc.get_traced_memory()[1]] + [stage[2] for stage in cls.stages.values()])
+        return summary
+
+    @classmethod
+    def format_summary(cls, summary: Dict[str, Any]) -> str:
+        lines = ['Stage profile (total %.3f s):' % summary['total_seconds']]
+        if summary['stages']:
+            name_width = max(len(name) for name in summary['stages'])
+            header = '%-*s  %10s  %10s  %7s' % (name_width, 'stage', 'calls', 'seconds', '%')
+            if cls.trace_memory:
+                header += '  %12s' % 'peak_mem(MB)'
+            lines.append(header)
+            for name, stage in summary['stages'].items():
+                line = '%-*s  %10d  %10.3f  %6.2f%%' % (
+                    name_width, name, stage['calls'], stage['seconds'], stage['percent'])
+                if 'peak_memory_bytes' in stage:
+                    line += '  %12.1f' % (stage['peak_memory_bytes'] / 1024 / 1024)
+                lines.append(line)
+        if summary['counters']:
+            name_width = max(len(name) for name in summary['counters'])
+            lines.append('%-*s  %12s  %12s' % (name_width, 'counter', 'count', 'per_second'))
+            for name, counter in summary['counters'].items():
+                lines.append('%-*s  %12d  %12.1f' % (
+                    name_width, name, counter['count'], counter['per_second']))
+        if cls.trace_memory:
+            lines.append('peak memory: %.1f MB' % (summary['peak_memory_bytes'] / 1024 / 1024))
+        return '\n'.join(lines) + '\n'
+
+    @classmethod
+    def report(cls):
+        if cls.profiler:
+            cls.profiler.disable()
+            cls.profiler.dump_stats(cls.cprofile_file)
+        summary = cls.get_summary()
+        if cls.output_format == 'json':
+            content = json.dumps(summary, indent=2) + '\n'
+        else:
+            content = cls.format_summary(summary)
+        if cls.output_file:
+            with open(cls.output_file, 'w') as fh:
+                fh.write(content)
+        else:
+            sys.stderr.write(content)
+
+
 class ArgParseFormatter(
         argparse.ArgumentDefaultsHelpFormatter, argparse.RawDescriptionHelpFormatter):
     pass
@@ -1102,6 +1742,9 @@ class ReportLibOptions:
     proguard_mapping_files: List[str]
     sample_filters: List[str]
     aggregate_threads: List[str]
+    sample_rate: Optional[float] = None
+    max_samples: Optional[int] = None
+    sampling_mode: str = 'uniform'
 
 
 class BaseArgumentParser(argparse.ArgumentParser):
@@ -1139,6 +1782,21 @@ class BaseArgumentParser(argparse.ArgumentParser):
             help="""Aggregate threads with names matching the same regex. As a result, samples from
                     different threads (like a thread pool) can be shown in one flamegraph.
                 """)
+        parser.add_argument(
+            '--sample-rate', type=float, metavar='rate',
+            help="""Only report a deterministic subset of samples for a fast preview, like 0.1 for
+                    about 10%% of samples. Periods of reported samples are scaled up, so event
+                    counts are estimates of the full profile.""")
+        parser.add_argument(
+            '--max-samples', type=int, metavar='count',
+            help="""Only report about this many samples, selected like --sample-rate. It reads
+                    the record file twice, first to count samples.""")
+        parser.add_argument(
+            '--sampling-mode', choices=['uniform', 'stratified'], default='uniform',
+            help="""How to select samples for --sample-rate and --max-samples. uniform: each
+                    sample is selected with the same probability. stratified: group samples by
+                    thread and time, and keep at least one sample in each group, so short-lived
+                    threads and bursts are still shown.""")
 
     def _add_sample_filter_options(
             self, group: Optional[Any] = None, with_pid_shortcut: bool = True):
@@ -1215,19 +1873,43 @@ class BaseArgumentParser(argparse.ArgumentParser):
             filters.extend(['--filter-file', args.filter_file])
         return filters
 
+    def _add_profile_stages_options(self):
+        group = self.add_argument_group('Stage profiling options')
+        group.add_argument(
+            '--profile-stages', nargs='?', const='text', choices=['text', 'json'],
+            help="""Measure time spent in stages of the script (like reading samples,
+                    symbolization, disassembly and writing output), and count samples, frames
+                    and unique callchains. Print a summary in text or json format at exit.""")
+        group.add_argument('--profile-stages-output', metavar='file',
+                           help='Write the stage profiling summary to a file instead of stderr.')
+        group.add_argument('--profile-stages-cprofile', metavar='file',
+                           help='Run cProfile for the whole script, and dump stats to a file.')
+        group.add_argument('--profile-stages-tracemalloc', action='store_true',
+                           help='Trace peak memory usage of each stage using tracemalloc.')
+
     def parse_known_args(self, *args, **kwargs):
         self.add_argument(
             '--log', choices=['debug', 'info', 'warning'],
             default='info', help='set log level')
+        self._add_profile_stages_options()
         namespace, left_args = super().parse_known_args(*args, **kwargs)
 
         if self.has_report_lib_options:
+            if namespace.sample_rate is not None and not 0 < namespace.sample_rate <= 1:
+                log_exit('--sample-rate should be in (0, 1].')
+            if namespace.max_samples is not None and namespace.max_samples < 1:
+                log_exit('--max-samples should be at least 1.')
             sample_filters = self._build_sample_filter(namespace)
             report_lib_options = ReportLibOptions(
                 namespace.show_art_frames, namespace.remove_method, namespace.trace_offcpu,
-                namespace.proguard_mapping_file, sample_filters, namespace.aggregate_threads)
+                namespace.proguard_mapping_file, sample_filters, namespace.aggregate_threads,
+                namespace.sample_rate, namespace.max_samples, namespace.sampling_mode)
             setattr(namespace, 'report_lib_options', report_lib_options)
 
         if not Log.initialized:
             Log.init(namespace.log)
+        if namespace.profile_stages and not StageProfiler.enabled:
+            StageProfiler.init(namespace.profile_stages, namespace.profile_stages_output,
+                               namespace.profile_stages_cprofile,
+                               namespace.profile_stages_tracemalloc)
         return namespace, left_args
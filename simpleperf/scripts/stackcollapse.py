@@ -26,9 +26,10 @@
 
 from collections import defaultdict
 from simpleperf_report_lib import GetReportLib
-from simpleperf_utils import BaseArgumentParser, flatten_arg_list, ReportLibOptions
+from simpleperf_utils import BaseArgumentParser, flatten_arg_list, ReportLibOptions, StageProfiler
 from typing import DefaultDict, List, Optional, Set
 
+import json
 import logging
 import sys
 
@@ -61,6 +62,7 @@ def collapse_stacks(
     while True:
         sample = lib.GetNextSample()
         if sample is None:
+            downsampling_info = lib.GetDownsamplingInfo()
             lib.Close()
             break
         event = lib.GetEventOfCurrentSample()
@@ -95,8 +97,13 @@ def collapse_stacks(
         stack.reverse()
         stacks[";".join(stack)] += sample.period
 
-    for k in sorted(stacks.keys()):
-        print("%s %d" % (k, stacks[k]))
+    with StageProfiler.stage('write stacks'):
+        for k in sorted(stacks.keys()):
+            print("%s %d" % (k, stacks[k]))
+    if downsampling_info:
+        # The collapsed stack format has no place for metadata. So log it.
+        logging.info('Periods are estimated from downsampled samples: %s',
+                     json.dumps(downsampling_info))
 
 
 def main():
@@ -119,17 +126,18 @@ def main():
     parser.add_report_lib_options(sample_filter_group=sample_filter_group,
                                   sample_filter_with_pid_shortcut=False)
     args = parser.parse_args()
-    collapse_stacks(
-        record_file=args.record_file,
-        symfs_dir=args.symfs,
-        kallsyms_file=args.kallsyms,
-        event_filter=args.event_filter,
-        include_pid=args.pid,
-        include_tid=args.tid,
-        annotate_kernel=args.kernel,
-        annotate_jit=args.jit,
-        include_addrs=args.addrs,
-        report_lib_options=args.report_lib_options)
+    with StageProfiler.stage('collapse stacks'):
+        collapse_stacks(
+            record_file=args.record_file,
+            symfs_dir=args.symfs,
+            kallsyms_file=args.kallsyms,
+            event_filter=args.event_filter,
+            include_pid=args.pid,
+            include_tid=args.tid,
+            annotate_kernel=args.kernel,
+            annotate_jit=args.jit,
+            include_addrs=args.addrs,
+            report_lib_options=args.report_lib_options)
 
 
 if __name__ == '__main__':
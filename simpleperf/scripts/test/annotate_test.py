@@ -14,11 +14,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import os
 from pathlib import Path
 import re
 import tempfile
 
+from annotate import FilePeriod, Period, SourceFileAnnotator
 from binary_cache_builder import BinaryCacheBuilder
 from . test_utils import TestBase, TestHelper
 
@@ -81,3 +83,52 @@ class TestAnnotate(TestBase):
              '--show-art-frames'])
         summary = Path('annotated_files') / 'summary'
         self.check_strings_in_file(summary, 'total period: 9800649')
+
+    def test_multiple_record_files(self):
+        testdata_file = TestHelper.testdata_path('display_bitmaps.proto_data')
+        summary = Path('annotated_files') / 'summary'
+        self.run_cmd(['annotate.py', '-i', testdata_file, '-j', '1'])
+        self.check_strings_in_file(summary, ['total period: 131250000'])
+        # Record files are read in parallel.
+        self.run_cmd(['annotate.py', '-i', testdata_file, testdata_file, '-j', '2'])
+        self.check_strings_in_file(summary, ['total period: 262500000'])
+
+    def test_annotate_files_incrementally(self):
+        source_file = Path('src') / 'foo.cpp'
+        source_file.parent.mkdir()
+        source_file.write_text('int main() {\n  return 0;\n}\n')
+        source_path = str(source_file)
+        config = {'perf_data_list': [], 'source_dirs': [], 'dso_filters': [],
+                  'ndk_path': TestHelper.ndk_path, 'raw_period': True, 'summary_width': 80,
+                  'jobs': 2}
+
+        def annotate(line_period: Period):
+            annotator = SourceFileAnnotator(config)
+            file_period = FilePeriod(source_path)
+            file_period.add_period(line_period)
+            file_period.add_line_period(2, line_period)
+            annotator.file_periods[source_path] = file_period
+            annotator._annotate_files()
+
+        annotated_file = Path('annotated_files') / 'src' / 'foo.cpp'
+        stale_file = Path('annotated_files') / 'stale' / 'bar.cpp'
+        annotate(Period(10, 20))
+        self.check_strings_in_file(annotated_file, ['/* Total 20, Self 10        */  return 0;'])
+        # Annotated files are written through temporary files.
+        self.assertEqual([path.name for path in annotated_file.parent.iterdir()], ['foo.cpp'])
+        with open(Path('annotated_files') / 'line_periods.json', 'r') as fh:
+            index = json.load(fh)
+        self.assertEqual(index['files'][source_path]['lines'], [[2, 10, 20]])
+        self.assertEqual(index['files'][source_path]['period'], [10, 20])
+
+        # Unchanged files aren't written again, and stale files are removed.
+        mtime = annotated_file.stat().st_mtime_ns
+        stale_file.parent.mkdir()
+        stale_file.write_text('')
+        annotate(Period(10, 20))
+        self.assertEqual(annotated_file.stat().st_mtime_ns, mtime)
+        self.assertFalse(stale_file.parent.exists())
+
+        # Files with changed periods are written again.
+        annotate(Period(30, 40))
+        self.check_strings_in_file(annotated_file, ['/* Total 40, Self 30        */  return 0;'])
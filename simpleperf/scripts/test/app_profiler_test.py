@@ -15,12 +15,15 @@
 # limitations under the License.
 
 from app_profiler import NativeLibDownloader
+from pathlib import Path
 import shutil
 import subprocess
 import sys
+from typing import List
+import unittest
 
-from simpleperf_utils import str_to_bytes, bytes_to_str, remove
-from . test_utils import TestBase, TestHelper, INFERNO_SCRIPT
+from simpleperf_utils import AdbHelper, is_windows, str_to_bytes, bytes_to_str, remove
+from . test_utils import create_fake_adb, TestBase, TestHelper, INFERNO_SCRIPT
 
 
 class TestNativeProfiling(TestBase):
@@ -148,3 +151,51 @@ class TestNativeLibDownloader(TestBase):
         target_file_stat = self.list_lib_on_device(target_file)
         downloader.sync_native_libs_on_device()
         self.assertNotEqual(target_file_stat, self.list_lib_on_device(target_file))
+
+
+@unittest.skipIf(is_windows(), 'fake adb script needs a unix shell')
+class TestNativeLibDownloaderWithFakeAdb(TestBase):
+    def setUp(self):
+        super(TestNativeLibDownloaderWithFakeAdb, self).setUp()
+        self.device_root = self.test_dir / 'device'
+        (self.device_root / 'data' / 'local' / 'tmp').mkdir(parents=True)
+        fake_adb, self.adb_log = create_fake_adb(self.test_dir, self.device_root)
+        # Log each shell cmd as an adb cmd.
+        self.adb = AdbHelper(use_shell_session=False)
+        self.adb.adb_path = str(fake_adb)
+        self.lib_dir = self.test_dir / 'libs'
+        self.lib_dir.mkdir()
+        for arch in ['arm', 'arm64']:
+            shutil.copy(TestHelper.testdata_path('simpleperf_runtest_two_functions_' + arch),
+                        self.lib_dir / ('lib%s.so' % arch))
+
+    def sync_in_batch(self, downloader: NativeLibDownloader) -> List[str]:
+        """ Return adb cmds used in sync. """
+        remove(self.adb_log)
+        self.assertTrue(downloader.sync_native_libs_in_batch())
+        return [line.split()[0] for line in self.adb_log.read_text().splitlines()]
+
+    def test_sync_native_libs_in_batch(self):
+        downloader = NativeLibDownloader(TestHelper.ndk_path, 'arm64', self.adb)
+        downloader.collect_native_libs_on_host(self.lib_dir)
+        self.assertEqual(len(downloader.host_build_id_map), 2)
+        dir_on_device = self.device_root / downloader.dir_on_device.lstrip('/')
+
+        # List files on device in one cmd, push one archive and unpack it in one cmd.
+        self.assertEqual(self.sync_in_batch(downloader), ['shell', 'push', 'shell'])
+        for entry in downloader.host_build_id_map.values():
+            self.assertEqual((dir_on_device / entry.name).read_bytes(),
+                             Path(entry.path).read_bytes())
+        self.assertEqual(len((dir_on_device / 'build_id_list').read_text().splitlines()), 2)
+        self.assertFalse((dir_on_device / downloader.ARCHIVE_NAME).exists())
+        self.assertIn('push native libs', downloader.timings)
+
+        # Nothing is pushed when libs on device are up to date.
+        self.assertEqual(self.sync_in_batch(downloader), ['shell'])
+        self.assertEqual(len(downloader.device_build_id_map), 2)
+
+        # Libs not on host are removed from device.
+        build_id, entry = downloader.host_build_id_map.popitem()
+        self.assertEqual(self.sync_in_batch(downloader), ['shell', 'push', 'shell'])
+        self.assertFalse((dir_on_device / entry.name).exists())
+        self.assertNotIn(build_id, (dir_on_device / 'build_id_list').read_text())
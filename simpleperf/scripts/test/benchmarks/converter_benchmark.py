@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2024 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""converter_benchmark.py: measure converters in simpleperf/scripts on recording files.
+
+    Each converter runs on recording files in script_testdata, and on larger synthetic recording
+    files, generated by repeating samples of a testdata file, or by synthetic_profile_generator.py
+    with a given number of samples. For each run, it measures wall time, samples per second, peak
+    RSS and output size. Results can be written to a json file, and compared with a baseline json
+    file. It fails (exit code 1) when a result regresses more than the thresholds. It runs
+    offline, on a Linux host.
+
+    Recording files in perf.data format need libsimpleperf_report.so. Runs which can't read
+    their inputs are reported as failed, but don't fail the benchmark.
+"""
+
+import json
+import os
+from pathlib import Path
+import platform
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+SCRIPT_DIR = Path(__file__).resolve().parents[2]
+TESTDATA_DIR = SCRIPT_DIR / 'test' / 'script_testdata'
+sys.path.insert(0, str(SCRIPT_DIR))
+
+from simpleperf_report_lib import GetReportLib, ProtoFileReportLib  # noqa: E402
+from simpleperf_utils import BaseArgumentParser, log_exit  # noqa: E402
+from synthetic_profile_generator import (  # noqa: E402
+    generate_synthetic_profile, SyntheticProfileConfig)
+
+# Converter name -> args. {input} and {output} are replaced by paths of the recording file and
+# the output file. Converters without {output} write to stdout, which is redirected to the
+# output file.
+CONVERTERS: Dict[str, List[str]] = {
+    'gecko_profile_generator.py': ['-i', '{input}'],
+    'pprof_proto_generator.py': ['-i', '{input}', '-o', '{output}'],
+    'report_html.py': ['-i', '{input}', '-o', '{output}', '--no_browser'],
+    'report_sample.py': ['-i', '{input}', '-o', '{output}'],
+    'report_top_functions.py': ['-i', '{input}', '-o', '{output}'],
+    'stackcollapse.py': ['-i', '{input}'],
+}
+
+DEFAULT_INPUTS = ['display_bitmaps.proto_data', 'perf_with_long_callchain.data',
+                  'two_process_perf.data']
+
+# Synthetic inputs are generated by repeating samples of this file.
+SYNTHETIC_SOURCE = 'display_bitmaps.proto_data'
+DEFAULT_SYNTHETIC_SCALES = [20]
+# Sample counts of inputs generated by synthetic_profile_generator.py.
+DEFAULT_SYNTHETIC_SAMPLES = [20000]
+
+# Compared fields in results, and whether a larger value is a regression.
+COMPARED_FIELDS = {
+    'wall_time_ms': True,
+    'samples_per_sec': False,
+    'peak_rss_kb': True,
+    'output_size': True,
+}
+
+
+def generate_scaled_proto_file(src_path: Path, dest_path: Path, scale: int):
+    """ Generate a recording file in cmd_report_sample.proto format, by repeating samples in
+        src_path `scale` times. Timestamps of repeated samples are shifted to follow the
+        previous copy.
+    """
+    report_sample_pb2 = ProtoFileReportLib.get_report_sample_pb2()
+    data = src_path.read_bytes()
+    header, i = data[:12], 12
+    sample_records: List[Any] = []
+    other_records: List[bytes] = []
+    while i + 4 <= len(data):
+        size = struct.unpack('<I', data[i:i + 4])[0]
+        if size == 0:
+            break
+        record_data = data[i + 4: i + 4 + size]
+        i += 4 + size
+        record = report_sample_pb2.Record()
+        record.ParseFromString(record_data)
+        if record.HasField('sample'):
+            sample_records.append(record)
+        else:
+            other_records.append(record_data)
+    times = [record.sample.time for record in sample_records]
+    duration = max(times) - min(times) + 1 if times else 0
+
+    def write_record(fh, record_data: bytes):
+        fh.write(struct.pack('<I', len(record_data)))
+        fh.write(record_data)
+
+    with open(dest_path, 'wb') as fh:
+        fh.write(header)
+        for k in range(scale):
+            for record in sample_records:
+                new_record = report_sample_pb2.Record()
+                new_record.CopyFrom(record)
+                new_record.sample.time += k * duration
+                write_record(fh, new_record.SerializeToString())
+        for record_data in other_records:
+            write_record(fh, record_data)
+        fh.write(struct.pack('<I', 0))
+
+
+def count_samples(record_file: Path) -> Optional[int]:
+    """ Return the number of samples in a recording file, or None if it can't be read. """
+    try:
+        lib = GetReportLib(str(record_file))
+        count = 0
+        while lib.GetNextSample():
+            count += 1
+        lib.Close()
+        return count
+    except Exception:
+        return None
+
+
+def run_once(args: List[str], output_path: Path, use_stdout: bool) -> Tuple[bool, float, int]:
+    """ Run a cmd, return (succeeded, wall time in ms, peak RSS in KB). """
+    stdout = open(output_path, 'wb') if use_stdout else subprocess.DEVNULL
+    start_time = time.perf_counter()
+    proc = subprocess.Popen(args, stdout=stdout, stderr=subprocess.DEVNULL)
+    # Use wait4() to get resource usage of this child process only.
+    _, status, rusage = os.wait4(proc.pid, 0)
+    wall_time = (time.perf_counter() - start_time) * 1000
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if use_stdout:
+        stdout.close()
+    return proc.returncode == 0, wall_time, rusage.ru_maxrss
+
+
+def measure_converter(converter: str, input_path: Path, sample_count: Optional[int],
+                      work_dir: Path, repeat: int) -> Dict[str, Any]:
+    output_path = work_dir / (converter + '.out')
+    use_stdout = '{output}' not in CONVERTERS[converter]
+    args = [sys.executable, str(SCRIPT_DIR / converter)]
+    args += [arg.format(input=input_path, output=output_path) for arg in CONVERTERS[converter]]
+    times = []
+    peak_rss = 0
+    for _ in range(repeat):
+        ok, wall_time, rss = run_once(args, output_path, use_stdout)
+        if not ok:
+            return {'ok': False}
+        times.append(wall_time)
+        peak_rss = max(peak_rss, rss)
+    result = {'ok': True, 'wall_time_ms': statistics.median(times), 'peak_rss_kb': peak_rss,
+              'output_size': output_path.stat().st_size if output_path.is_file() else 0}
+    if sample_count is not None:
+        result['sample_count'] = sample_count
+        result['samples_per_sec'] = sample_count / (result['wall_time_ms'] / 1000)
+    output_path.unlink(missing_ok=True)
+    return result
+
+
+def compare_with_baseline(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]],
+                          thresholds: Dict[str, float]) -> List[str]:
+    """ Return a list of regressions. A result regresses when it fails but succeeded in the
+        baseline, or when it is worse than the baseline by more than the threshold, which is a
+        fraction of the baseline value.
+    """
+    regressions = []
+    for name, result in results.items():
+        base_result = baseline.get(name)
+        if not base_result or not base_result.get('ok'):
+            continue
+        if not result.get('ok'):
+            regressions.append('%s: failed, but succeeded in the baseline' % name)
+            continue
+        for field, larger_is_worse in COMPARED_FIELDS.items():
+            value, base_value = result.get(field), base_result.get(field)
+            if value is None or not base_value:
+                continue
+            change = (value - base_value) / base_value
+            if not larger_is_worse:
+                change = -change
+            if change > thresholds[field]:
+                regressions.append('%s: %s %.1f -> %.1f (%+.1f%%)' % (
+                    name, field, base_value, value, change * 100))
+    return regressions
+
+
+def main():
+    parser = BaseArgumentParser(description=__doc__)
+    parser.add_argument('--converters', nargs='+', default=list(CONVERTERS),
+                        choices=list(CONVERTERS), help='converters to measure')
+    parser.add_argument('--inputs', nargs='+', default=DEFAULT_INPUTS,
+                        help='recording files in script_testdata, or paths of recording files')
+    parser.add_argument('--synthetic-scales', nargs='*', type=int,
+                        default=DEFAULT_SYNTHETIC_SCALES, help="""
+                        Also generate synthetic inputs by repeating samples of %s, by these
+                        times.""" % SYNTHETIC_SOURCE)
+    parser.add_argument('--synthetic-samples', nargs='*', type=int,
+                        default=DEFAULT_SYNTHETIC_SAMPLES, help="""
+                        Also run on inputs generated by synthetic_profile_generator.py, with
+                        these numbers of samples""")
+    parser.add_argument('--synthetic-offcpu', action='store_true',
+                        help='add off-cpu samples in inputs generated by --synthetic-samples')
+    parser.add_argument('-n', '--repeat', type=int, default=3, help='run each converter n times')
+    parser.add_argument('--json', help='write results to a json file')
+    parser.add_argument('--baseline', help='compare results with a json file written by --json')
+    parser.add_argument('--time-threshold', type=float, default=0.2, help="""
+                        allowed fraction of increase in wall time, also used for samples/s""")
+    parser.add_argument('--rss-threshold', type=float, default=0.2,
+                        help='allowed fraction of increase in peak RSS')
+    parser.add_argument('--size-threshold', type=float, default=0.05,
+                        help='allowed fraction of increase in output size')
+    args = parser.parse_args()
+    if not hasattr(os, 'wait4'):
+        log_exit('converter_benchmark.py needs os.wait4(), which is only available on Unix.')
+
+    results: Dict[str, Dict[str, Any]] = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = Path(tmp_dir)
+        inputs: List[Tuple[str, Path]] = []
+        for name in args.inputs:
+            path = TESTDATA_DIR / name
+            inputs.append((name, path if path.is_file() else Path(name)))
+        for scale in args.synthetic_scales:
+            name = 'synthetic_x%d.proto_data' % scale
+            path = work_dir / name
+            generate_scaled_proto_file(TESTDATA_DIR / SYNTHETIC_SOURCE, path, scale)
+            inputs.append((name, path))
+        for sample_count in args.synthetic_samples:
+            name = 'synthetic_%d.proto_data' % sample_count
+            path = work_dir / name
+            generate_synthetic_profile(path, SyntheticProfileConfig(
+                samples=sample_count, offcpu=args.synthetic_offcpu))
+            inputs.append((name, path))
+
+        for input_name, input_path in inputs:
+            sample_count = count_samples(input_path)
+            for converter in args.converters:
+                results['%s:%s' % (converter, input_name)] = measure_converter(
+                    converter, input_path, sample_count, work_dir, args.repeat)
+
+    name_width = max(len(name) for name in results)
+    print('%-*s  %10s  %12s  %10s  %12s' % (name_width, 'run', 'time(ms)', 'samples/s',
+                                            'rss(KB)', 'output(B)'))
+    for name, result in results.items():
+        if not result['ok']:
+            print('%-*s  FAILED' % (name_width, name))
+            continue
+        print('%-*s  %10.1f  %12.0f  %10d  %12d' % (
+            name_width, name, result['wall_time_ms'], result.get('samples_per_sec', 0),
+            result['peak_rss_kb'], result['output_size']))
+
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump({'python': platform.python_version(), 'results': results}, fh, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r') as fh:
+            baseline = json.load(fh)['results']
+        thresholds = {'wall_time_ms': args.time_threshold, 'samples_per_sec': args.time_threshold,
+                      'peak_rss_kb': args.rss_threshold, 'output_size': args.size_threshold}
+        regressions = compare_with_baseline(results, baseline, thresholds)
+        if regressions:
+            print('\nRegressions compared with %s:' % args.baseline)
+            for regression in regressions:
+                print('  ' + regression)
+            sys.exit(1)
+        print('\nNo regressions compared with %s.' % args.baseline)
+
+
+if __name__ == '__main__':
+    main()
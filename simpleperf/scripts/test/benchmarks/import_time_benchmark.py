@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2024 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""import_time_benchmark.py: check import time of entry points in simpleperf/scripts.
+
+    Each script is run as `python -X importtime <script> --help`. The import time is the sum of
+    cumulative times of modules imported by the script, excluding modules imported by the
+    interpreter at startup. It fails (exit code 1) when a script exceeds its import time budget,
+    or imports a module which should only be imported when needed (like protobuf or bokeh).
+"""
+
+import json
+import re
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List, Set, Tuple
+
+SCRIPT_DIR = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(SCRIPT_DIR))
+
+from simpleperf_utils import BaseArgumentParser  # noqa: E402
+from startup_benchmark import ENTRY_POINTS  # noqa: E402
+
+# Import time budget of each script in milliseconds, when not in IMPORT_BUDGETS.
+DEFAULT_IMPORT_BUDGET_MS = 150
+IMPORT_BUDGETS: Dict[str, float] = {
+    # report.py imports tkinter for its GUI.
+    'report.py': 250,
+}
+
+# Modules only imported by code paths needing them. They shouldn't be imported for --help.
+LAZY_MODULES = ['bokeh', 'google.protobuf', 'jinja2', 'pandas']
+
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def parse_import_time(output: str) -> List[Tuple[str, int, float]]:
+    """ Parse -X importtime output, return a list of (module, nesting level, cumulative ms). """
+    result = []
+    for line in output.splitlines():
+        m = IMPORT_TIME_LINE.match(line)
+        if m:
+            level = (len(m.group(3)) - 1) // 2
+            result.append((m.group(4), level, int(m.group(2)) / 1000))
+    return result
+
+
+def run_with_import_time(args: List[str]) -> List[Tuple[str, int, float]]:
+    proc = subprocess.run([sys.executable, '-X', 'importtime'] + args, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, text=True)
+    return parse_import_time(proc.stderr)
+
+
+def get_startup_modules() -> Set[str]:
+    """ Return modules imported by the interpreter before running a script. """
+    return {name for name, _, _ in run_with_import_time(['-c', 'pass'])}
+
+
+def measure_script(script: str, startup_modules: Set[str]) -> Tuple[float, Set[str]]:
+    """ Return (import time in ms, imported modules) of running a script with --help. """
+    imports = run_with_import_time([str(SCRIPT_DIR / script), '--help'])
+    import_time = sum(cumulative for name, level, cumulative in imports
+                      if level == 0 and name not in startup_modules)
+    return import_time, {name for name, _, _ in imports}
+
+
+def find_lazy_modules(modules: Set[str]) -> List[str]:
+    return sorted(name for name in modules
+                  if any(name == lazy or name.startswith(lazy + '.') for lazy in LAZY_MODULES))
+
+
+def main():
+    parser = BaseArgumentParser(description=__doc__)
+    parser.add_argument('--scripts', nargs='+', default=ENTRY_POINTS,
+                        help='scripts to check, relative to simpleperf/scripts')
+    parser.add_argument('--budget', type=float,
+                        help='import time budget in ms for all scripts, overriding the defaults')
+    parser.add_argument('-n', '--repeat', type=int, default=5,
+                        help='run each script n times, and use the median import time')
+    parser.add_argument('--json', help='write results to a json file')
+    args = parser.parse_args()
+
+    startup_modules = get_startup_modules()
+    results = {}
+    failed = False
+    for script in args.scripts:
+        times = []
+        lazy_modules = set()
+        for _ in range(args.repeat):
+            import_time, modules = measure_script(script, startup_modules)
+            times.append(import_time)
+            lazy_modules.update(find_lazy_modules(modules))
+        budget = args.budget or IMPORT_BUDGETS.get(script, DEFAULT_IMPORT_BUDGET_MS)
+        result = {
+            'median_ms': statistics.median(times),
+            'budget_ms': budget,
+            'lazy_modules_imported': sorted(lazy_modules),
+        }
+        result['ok'] = result['median_ms'] <= budget and not lazy_modules
+        failed = failed or not result['ok']
+        results[script] = result
+
+    name_width = max(len(name) for name in results)
+    print('%-*s  %10s  %10s  %s' % (name_width, 'script', 'import(ms)', 'budget(ms)', 'status'))
+    for name, result in results.items():
+        status = 'OK' if result['ok'] else 'FAILED'
+        if result['lazy_modules_imported']:
+            status += ' (imported %s)' % ', '.join(result['lazy_modules_imported'])
+        print('%-*s  %10.1f  %10.1f  %s' % (name_width, name, result['median_ms'],
+                                            result['budget_ms'], status))
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(results, fh, indent=2)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
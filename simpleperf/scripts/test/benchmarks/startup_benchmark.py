@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2024 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""startup_benchmark.py: measure startup time of entry points in simpleperf/scripts.
+
+    Each script is run with --help, which covers importing modules and parsing arguments.
+    Tool discovery (ToolFinder.find_tool_path) is measured separately, with an empty tool cache
+    and with a filled one.
+"""
+
+import json
+import os
+from pathlib import Path
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+SCRIPT_DIR = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(SCRIPT_DIR))
+
+from simpleperf_utils import BaseArgumentParser, ToolFinder  # noqa: E402
+
+ENTRY_POINTS = [
+    'annotate.py',
+    'api_profiler.py',
+    'app_profiler.py',
+    'binary_cache_builder.py',
+    'debug_unwind_reporter.py',
+    'gecko_profile_generator.py',
+    'inferno/inferno.py',
+    'ipc.py',
+    'pprof_proto_generator.py',
+    'purgatorio/purgatorio.py',
+    'report.py',
+    'report_html.py',
+    'report_sample.py',
+    'report_top_functions.py',
+    'run_simpleperf_on_device.py',
+    'run_simpleperf_without_usb_connection.py',
+    'sample_filter.py',
+    'stackcollapse.py',
+]
+
+FIND_TOOL_CODE = """
+import sys
+sys.path.insert(0, %r)
+from simpleperf_utils import ToolFinder
+ToolFinder.find_tool_path(%r, %r)
+"""
+
+
+def measure(args: List[str], repeat: int, env: Dict[str, str]) -> Dict[str, float]:
+    """ Return min and median wall time of running a cmd, in milliseconds. """
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env)
+        times.append((time.perf_counter() - start_time) * 1000)
+    return {'min_ms': min(times), 'median_ms': statistics.median(times)}
+
+
+def main():
+    parser = BaseArgumentParser(description=__doc__)
+    parser.add_argument('--scripts', nargs='+', default=ENTRY_POINTS,
+                        help='scripts to measure, relative to simpleperf/scripts')
+    parser.add_argument('--tools', nargs='*', default=list(ToolFinder.EXPECTED_TOOLS),
+                        help='tools to find')
+    parser.add_argument('--ndk_path', help='Set the path of a ndk release.')
+    parser.add_argument('-n', '--repeat', type=int, default=5, help='run each cmd n times')
+    parser.add_argument('--json', help='write results to a json file')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env = os.environ.copy()
+        # Keep the user's tool cache untouched.
+        env['SIMPLEPERF_TOOL_CACHE'] = os.path.join(tmp_dir, 'tool_paths.json')
+        for script in args.scripts:
+            results[script] = measure(
+                [sys.executable, str(SCRIPT_DIR / script), '--help'], args.repeat, env)
+
+        for tool in args.tools:
+            cmd = [sys.executable, '-c', FIND_TOOL_CODE % (str(SCRIPT_DIR), tool, args.ndk_path)]
+            env['SIMPLEPERF_TOOL_CACHE'] = ''
+            results['find %s (no cache)' % tool] = measure(cmd, args.repeat, env)
+            env['SIMPLEPERF_TOOL_CACHE'] = os.path.join(tmp_dir, 'tool_paths.json')
+            subprocess.run(cmd, env=env)
+            results['find %s (cached)' % tool] = measure(cmd, args.repeat, env)
+
+    name_width = max(len(name) for name in results)
+    print('%-*s  %10s  %10s' % (name_width, 'entry', 'min(ms)', 'median(ms)'))
+    for name, result in results.items():
+        print('%-*s  %10.1f  %10.1f' % (name_width, name, result['min_ms'], result['median_ms']))
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(results, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2024 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""synthetic_profile_generator.py: generate synthetic recording files in cmd_report_sample.proto
+    format, which can be read by ProtoFileReportLib (and all scripts using GetReportLib()).
+
+    The number of samples, threads, processes, binaries, symbols and distinct callchains, the
+    distribution of callchain depths and off-cpu samples are configurable. The output only depends
+    on the options (including --seed). Samples are written in a stream, so memory usage doesn't
+    grow with the number of samples, and multi-GB files can be generated.
+
+  Example:
+    # Generate 10 million samples with 64 threads and off-cpu samples.
+    ./synthetic_profile_generator.py -o synthetic.proto_data --samples 10000000 --threads 64 \\
+        --offcpu
+"""
+
+import bisect
+from dataclasses import dataclass
+import heapq
+from pathlib import Path
+import random
+import struct
+import sys
+from typing import BinaryIO, Dict, List, Tuple, Union
+
+SCRIPT_DIR = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(SCRIPT_DIR))
+
+from simpleperf_report_lib import ProtoFileReportLib  # noqa: E402
+from simpleperf_utils import BaseArgumentParser, log_exit  # noqa: E402
+
+DEPTH_DISTRIBUTIONS = ['fixed', 'uniform', 'geometric']
+KERNEL_DSO = '[kernel.kallsyms]'
+# Kernel frames on top of off-cpu samples.
+OFFCPU_FRAMES = ['__schedule', 'schedule', 'futex_wait_queue', 'futex_wait', 'do_futex']
+PROCESS_ID_START = 10000
+
+
+@dataclass
+class SyntheticProfileConfig:
+    """ Options of a synthetic profile. """
+    samples: int = 10000
+    processes: int = 2
+    threads: int = 8
+    dsos: int = 20
+    symbols_per_dso: int = 100
+    # Number of distinct callchains of on-cpu samples.
+    callchains: int = 1000
+    depth_distribution: str = 'geometric'
+    # The depth for fixed distribution, or the mean depth for other distributions.
+    depth: int = 16
+    max_depth: int = 128
+    # Period of each on-cpu sample, in ns.
+    sample_period: int = 1000000
+    # Generate off-cpu samples and context switch records, like `simpleperf record --trace-offcpu`.
+    offcpu: bool = False
+    # Probability of a thread going off cpu after a sample.
+    offcpu_ratio: float = 0.1
+    seed: int = 0
+
+
+def encode_varint(value: int) -> bytes:
+    data = bytearray()
+    while value >= 0x80:
+        data.append((value & 0x7f) | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def encode_length_delimited(field_number: int, data: bytes) -> bytes:
+    return encode_varint((field_number << 3) | 2) + encode_varint(len(data)) + data
+
+
+def encode_varint_field(field_number: int, value: int) -> bytes:
+    return encode_varint(field_number << 3) + encode_varint(value)
+
+
+class SyntheticProfileGenerator:
+    """ Write a synthetic profile to a file object. Sample records are encoded directly, without
+        building protobuf messages, because they are the bulk of the output. Other records are
+        built with report_sample_pb2.
+    """
+
+    def __init__(self, config: SyntheticProfileConfig):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.report_sample_pb2 = ProtoFileReportLib.get_report_sample_pb2()
+        self.dso_paths = ['/system/lib64/libsynthetic%d.so' % i for i in range(config.dsos)]
+        self.kernel_file_id = config.dsos
+        # Encoded callchain entries, indexed by (file_id, symbol_id).
+        self.entry_cache: Dict[Tuple[int, int], bytes] = {}
+        # Cumulative weights to pick symbols and callchains with a Zipf-like skew, so a few of them
+        # are hot, like in real profiles.
+        self.symbol_weights = self._zipf_cumulative_weights(config.dsos * config.symbols_per_dso)
+        self.callchain_weights = self._zipf_cumulative_weights(config.callchains)
+        self.threads = self._create_threads()
+        self.callchains = self._create_callchains()
+        self.offcpu_callchain_suffix = b''.join(
+            self._get_entry(self.kernel_file_id, i) for i in range(len(OFFCPU_FRAMES)))
+
+    @staticmethod
+    def _zipf_cumulative_weights(n: int) -> List[float]:
+        weights = []
+        total = 0.0
+        for rank in range(n):
+            total += 1 / (rank + 1)
+            weights.append(total)
+        return weights
+
+    def _pick(self, cumulative_weights: List[float]) -> int:
+        value = self.rng.random() * cumulative_weights[-1]
+        return min(bisect.bisect_right(cumulative_weights, value), len(cumulative_weights) - 1)
+
+    def _create_threads(self) -> List[Tuple[int, int, str]]:
+        """ Return [(tid, pid, thread name)]. The first thread of each process is its main thread.
+        """
+        threads = []
+        config = self.config
+        for i in range(config.threads):
+            process_index = i % config.processes
+            pid = PROCESS_ID_START + process_index * (config.threads + 1)
+            if i < config.processes:
+                threads.append((pid, pid, 'com.example.synthetic%d' % process_index))
+            else:
+                threads.append((pid + 1 + i // config.processes, pid, 'worker-%d' % i))
+        return threads
+
+    def _get_depth(self) -> int:
+        config = self.config
+        if config.depth_distribution == 'fixed':
+            depth = config.depth
+        elif config.depth_distribution == 'uniform':
+            depth = self.rng.randint(1, 2 * config.depth - 1)
+        else:
+            depth = 1
+            while self.rng.random() >= 1 / config.depth:
+                depth += 1
+                if depth >= config.max_depth:
+                    break
+        return max(1, min(depth, config.max_depth))
+
+    def _get_entry(self, file_id: int, symbol_id: int) -> bytes:
+        entry = self.entry_cache.get((file_id, symbol_id))
+        if entry is None:
+            data = (encode_varint_field(1, 0x1000 + symbol_id * 0x40) +
+                    encode_varint_field(2, file_id) + encode_varint_field(3, symbol_id))
+            entry = self.entry_cache[(file_id, symbol_id)] = encode_length_delimited(3, data)
+        return entry
+
+    def _create_callchains(self) -> List[bytes]:
+        """ Create encoded callchains, leaf first. A new callchain extends a prefix of a previous
+            one, so callchains share callers, like in real profiles.
+        """
+        callchains: List[bytes] = []
+        root_frames: List[List[Tuple[int, int]]] = []
+        for _ in range(self.config.callchains):
+            depth = self._get_depth()
+            frames = []
+            if root_frames:
+                parent = root_frames[self.rng.randrange(len(root_frames))]
+                frames = parent[:self.rng.randint(0, min(len(parent), depth - 1))]
+            while len(frames) < depth:
+                symbol_index = self._pick(self.symbol_weights)
+                frames.append(divmod(symbol_index, self.config.symbols_per_dso))
+            root_frames.append(frames)
+            callchains.append(b''.join(self._get_entry(file_id, symbol_id)
+                                       for file_id, symbol_id in reversed(frames)))
+        return callchains
+
+    def _write_record(self, fh: BinaryIO, record_data: bytes):
+        fh.write(struct.pack('<I', len(record_data)))
+        fh.write(record_data)
+
+    def _write_message(self, fh: BinaryIO, **kwargs):
+        self._write_record(fh, self.report_sample_pb2.Record(**kwargs).SerializeToString())
+
+    def _write_sample(self, fh: BinaryIO, time: int, tid: int, callchain: bytes,
+                      event_count: int, event_type_id: int):
+        sample = (encode_varint_field(1, time) + encode_varint_field(2, tid) + callchain +
+                  encode_varint_field(4, event_count) + encode_varint_field(5, event_type_id))
+        self._write_record(fh, encode_length_delimited(1, sample))
+
+    def write(self, fh: BinaryIO):
+        config = self.config
+        pb2 = self.report_sample_pb2
+        fh.write(b'SIMPLEPERF' + struct.pack('<H', 1))
+        event_types = ['cpu-clock']
+        if config.offcpu:
+            event_types.append('sched:sched_switch')
+        self._write_message(fh, meta_info=pb2.MetaInfo(
+            event_type=event_types, app_package_name='com.example.synthetic0',
+            trace_offcpu=config.offcpu))
+
+        time = 1000000000
+        # Time between two samples of all threads.
+        interval = max(1, config.sample_period // len(self.threads))
+        awake_threads = list(range(len(self.threads)))
+        # (wakeup time, thread index) of off-cpu threads
+        sleeping_threads: List[Tuple[int, int]] = []
+        for _ in range(config.samples):
+            if not awake_threads:
+                time = max(time, sleeping_threads[0][0])
+            while sleeping_threads and sleeping_threads[0][0] <= time:
+                wakeup_time, thread_index = heapq.heappop(sleeping_threads)
+                self._write_message(fh, context_switch=pb2.ContextSwitch(
+                    switch_on=True, time=wakeup_time, thread_id=self.threads[thread_index][0]))
+                awake_threads.append(thread_index)
+            thread_index = awake_threads[self.rng.randrange(len(awake_threads))]
+            tid = self.threads[thread_index][0]
+            callchain = self.callchains[self._pick(self.callchain_weights)]
+            if config.offcpu and self.rng.random() < config.offcpu_ratio:
+                # The thread is scheduled out. Its off-cpu period is computed by the reader,
+                # from the time it is switched on again.
+                self._write_sample(fh, time, tid, self.offcpu_callchain_suffix + callchain, 1, 1)
+                awake_threads.remove(thread_index)
+                sleep_time = int(self.rng.expovariate(1 / (10 * config.sample_period))) + 1
+                heapq.heappush(sleeping_threads, (time + sleep_time, thread_index))
+            else:
+                self._write_sample(fh, time, tid, callchain, config.sample_period, 0)
+            time += interval
+        for wakeup_time, thread_index in sorted(sleeping_threads):
+            self._write_message(fh, context_switch=pb2.ContextSwitch(
+                switch_on=True, time=wakeup_time, thread_id=self.threads[thread_index][0]))
+
+        for file_id, path in enumerate(self.dso_paths):
+            symbols = ['synthetic_%d_func_%d' % (file_id, i)
+                       for i in range(config.symbols_per_dso)]
+            self._write_message(fh, file=pb2.File(id=file_id, path=path, symbol=symbols))
+        self._write_message(fh, file=pb2.File(
+            id=self.kernel_file_id, path=KERNEL_DSO, symbol=OFFCPU_FRAMES))
+        for tid, pid, name in self.threads:
+            self._write_message(fh, thread=pb2.Thread(
+                thread_id=tid, process_id=pid, thread_name=name))
+        fh.write(struct.pack('<I', 0))
+
+
+def generate_synthetic_profile(path: Union[str, Path], config: SyntheticProfileConfig):
+    with open(path, 'wb') as fh:
+        SyntheticProfileGenerator(config).write(fh)
+
+
+def main():
+    parser = BaseArgumentParser(description=__doc__)
+    default = SyntheticProfileConfig()
+    parser.add_argument('-o', '--output', required=True, help='output file')
+    parser.add_argument('--samples', type=int, default=default.samples, help='number of samples')
+    parser.add_argument('--processes', type=int, default=default.processes,
+                        help='number of processes')
+    parser.add_argument('--threads', type=int, default=default.threads,
+                        help='number of threads in all processes')
+    parser.add_argument('--dsos', type=int, default=default.dsos, help='number of binaries')
+    parser.add_argument('--symbols-per-dso', type=int, default=default.symbols_per_dso,
+                        help='number of symbols in each binary')
+    parser.add_argument('--callchains', type=int, default=default.callchains,
+                        help='number of distinct callchains')
+    parser.add_argument('--depth-distribution', choices=DEPTH_DISTRIBUTIONS,
+                        default=default.depth_distribution, help='distribution of callchain depth')
+    parser.add_argument('--depth', type=int, default=default.depth,
+                        help='callchain depth for fixed distribution, or the mean depth')
+    parser.add_argument('--max-depth', type=int, default=default.max_depth,
+                        help='max callchain depth')
+    parser.add_argument('--sample-period', type=int, default=default.sample_period,
+                        help='period of each on-cpu sample in ns')
+    parser.add_argument('--offcpu', action='store_true',
+                        help='generate off-cpu samples and context switch records')
+    parser.add_argument('--offcpu-ratio', type=float, default=default.offcpu_ratio,
+                        help='probability of a thread going off cpu after a sample')
+    parser.add_argument('--seed', type=int, default=default.seed, help='random seed')
+    args = parser.parse_args()
+
+    config = SyntheticProfileConfig(
+        samples=args.samples, processes=args.processes, threads=args.threads, dsos=args.dsos,
+        symbols_per_dso=args.symbols_per_dso, callchains=args.callchains,
+        depth_distribution=args.depth_distribution, depth=args.depth, max_depth=args.max_depth,
+        sample_period=args.sample_period, offcpu=args.offcpu, offcpu_ratio=args.offcpu_ratio,
+        seed=args.seed)
+    if min(config.processes, config.dsos, config.symbols_per_dso, config.callchains,
+           config.depth, config.max_depth, config.sample_period) < 1 or config.samples < 0:
+        log_exit('Invalid options: counts should be positive.')
+    if config.threads < config.processes:
+        log_exit('--threads should be at least --processes.')
+    if not 0 <= config.offcpu_ratio <= 1:
+        log_exit('--offcpu-ratio should be in [0, 1].')
+    generate_synthetic_profile(args.output, config)
+
+
+if __name__ == '__main__':
+    main()
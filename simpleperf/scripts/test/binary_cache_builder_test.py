@@ -19,11 +19,14 @@ import os
 from pathlib import Path
 import shutil
 import tempfile
+from typing import List
+import unittest
 import zipfile
 
-from binary_cache_builder import BinaryCacheBuilder
-from simpleperf_utils import ReadElf, remove, ToolFinder
-from . test_utils import TestBase, TestHelper
+from binary_cache_builder import (BinaryCache, BinaryCacheBuilder, BinaryIndex,
+                                  BinarySourceFromDevice, FileLinker)
+from simpleperf_utils import BuildIdList, is_windows, ReadElf, remove, ToolFinder
+from . test_utils import create_fake_adb, TestBase, TestHelper
 
 
 class TestBinaryCacheBuilder(TestBase):
@@ -143,3 +146,174 @@ class TestBinaryCacheBuilder(TestBase):
         self.assertTrue(build_id_list_path.is_file())
         with open(build_id_list_path, 'r') as fh:
             self.assertIn('simpleperf_runtest_two_functions_arm64', fh.read())
+
+    def test_binary_index(self):
+        symfs_dir = self.test_dir / 'symfs_dir'
+        symfs_dir.mkdir()
+        filename = 'simpleperf_runtest_two_functions_arm'
+        shutil.copy(TestHelper.testdata_path(filename), symfs_dir)
+        readelf = ReadElf(TestHelper.ndk_path)
+        build_id = readelf.get_build_id(symfs_dir / filename)
+
+        def build_binary_cache() -> List[str]:
+            builder = BinaryCacheBuilder(TestHelper.ndk_path, False)
+            builder.binaries[filename] = build_id
+            read_files = []
+            get_build_id = builder.readelf.get_build_id
+
+            def counting_get_build_id(path, *args, **kwargs):
+                read_files.append(Path(path).name)
+                return get_build_id(path, *args, **kwargs)
+            builder.readelf.get_build_id = counting_get_build_id
+            builder.copy_binaries_from_symfs_dirs([symfs_dir])
+            self.assertTrue(filecmp.cmp(builder.find_path_in_cache(filename),
+                                        symfs_dir / filename))
+            return read_files
+
+        self.assertIn(filename, build_binary_cache())
+        self.assertTrue((Path('binary_cache') / BinaryIndex.FILE_NAME).is_file())
+        # Build ids of unchanged files are read from the index.
+        self.assertEqual(build_binary_cache(), [])
+        # Build ids of new files are read.
+        shutil.copy(TestHelper.testdata_path('simpleperf_runtest_two_functions_x86'),
+                    symfs_dir / 'new_elf')
+        self.assertEqual(build_binary_cache(), ['new_elf'])
+
+    def test_shared_store(self):
+        symfs_dir = self.test_dir / 'symfs_dir'
+        symfs_dir.mkdir()
+        filename = 'simpleperf_runtest_two_functions_arm'
+        source_file = symfs_dir / filename
+        shutil.copy(TestHelper.testdata_path(filename), source_file)
+        store_dir = self.test_dir / 'store'
+
+        target_files = []
+        for binary_cache_dir in ['binary_cache1', 'binary_cache2']:
+            builder = BinaryCacheBuilder(TestHelper.ndk_path, False, shared_store_dir=store_dir)
+            builder.binary_cache_dir = Path(binary_cache_dir)
+            builder.binary_cache = BinaryCache(builder.binary_cache_dir)
+            builder.binaries[filename] = builder.readelf.get_build_id(source_file)
+            builder.copy_binaries_from_symfs_dirs([symfs_dir])
+            target_file = builder.find_path_in_cache(filename)
+            self.assertTrue(filecmp.cmp(target_file, source_file))
+            target_files.append(target_file)
+
+        # Both binary_cache dirs use the same file in the store.
+        store_files = [p for p in store_dir.glob('*/*') if p.is_file()]
+        self.assertEqual(len(store_files), 1)
+        self.assertTrue(filecmp.cmp(store_files[0], source_file))
+        # The store isn't affected when the source file is modified in place.
+        with open(source_file, 'ab') as fh:
+            fh.write(b'\0')
+        self.assertEqual(os.path.getsize(store_files[0]), os.path.getsize(target_files[0]))
+        self.assertFalse(os.path.samefile(store_files[0], source_file))
+
+    def test_file_linker(self):
+        source_file = self.test_dir / 'source'
+        source_file.write_bytes(b'data')
+        target_file = self.test_dir / 'target'
+        self.assertIn(FileLinker(False).link_or_copy(source_file, target_file),
+                      ['reflink', 'copy'])
+        self.assertFalse(os.path.samefile(source_file, target_file))
+        self.assertIn(FileLinker(True).link_or_copy(source_file, target_file),
+                      ['reflink', 'hardlink', 'symlink', 'copy'])
+        self.assertEqual(target_file.read_bytes(), b'data')
+
+    def test_update_build_id_list(self):
+        symfs_dir = self.test_dir / 'symfs_dir'
+        symfs_dir.mkdir()
+        builder = BinaryCacheBuilder(TestHelper.ndk_path, False)
+        for filename in ['simpleperf_runtest_two_functions_arm',
+                         'simpleperf_runtest_two_functions_arm64']:
+            shutil.copy(TestHelper.testdata_path(filename), symfs_dir)
+            builder.binaries[filename] = builder.readelf.get_build_id(symfs_dir / filename)
+        builder.copy_binaries_from_symfs_dirs([symfs_dir])
+        builder.create_build_id_list()
+
+        binary_cache_dir = builder.binary_cache_dir
+        with open(binary_cache_dir / 'build_id_list', 'r') as fh:
+            self.assertEqual(len(fh.readlines()), 2)
+        self.assertTrue((binary_cache_dir / 'build_id_list.sorted').is_file())
+        build_id_list = BuildIdList(binary_cache_dir)
+        build_id_list.load()
+        self.assertIsNotNone(build_id_list.sorted_data)
+        for filename, build_id in builder.binaries.items():
+            self.assertEqual(build_id_list.get(build_id), builder.find_path_in_cache(filename))
+        self.assertIsNone(build_id_list.get('0x' + '0' * 40))
+
+        # Removed files are removed from the list.
+        builder.find_path_in_cache('simpleperf_runtest_two_functions_arm64').unlink()
+        builder = BinaryCacheBuilder(TestHelper.ndk_path, False)
+        builder.create_build_id_list()
+        with open(binary_cache_dir / 'build_id_list', 'r') as fh:
+            lines = fh.readlines()
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].strip().endswith('simpleperf_runtest_two_functions_arm'))
+
+        # Files dropped into binary_cache by hand are added to the list.
+        manual_dir = binary_cache_dir / 'manual'
+        manual_dir.mkdir()
+        shutil.copy(TestHelper.testdata_path('simpleperf_runtest_two_functions_arm64'), manual_dir)
+        builder = BinaryCacheBuilder(TestHelper.ndk_path, False)
+        builder.create_build_id_list()
+        build_id = builder.readelf.get_build_id(
+            manual_dir / 'simpleperf_runtest_two_functions_arm64')
+        build_id_list = BuildIdList(binary_cache_dir)
+        build_id_list.load()
+        self.assertEqual(build_id_list.get(build_id),
+                         manual_dir / 'simpleperf_runtest_two_functions_arm64')
+
+        # When build_id_list.sorted is out of date, build_id_list is used.
+        with open(binary_cache_dir / 'build_id_list', 'a') as fh:
+            fh.write('0x1234=a/b\n')
+        build_id_list = BuildIdList(binary_cache_dir)
+        build_id_list.load()
+        self.assertIsNone(build_id_list.sorted_data)
+        self.assertEqual(build_id_list.get('0x1234'), binary_cache_dir / 'a' / 'b')
+
+        # A path maps to only one build id.
+        build_id_list.add('0x5678', binary_cache_dir / 'a' / 'b')
+        self.assertIsNone(build_id_list.get('0x1234'))
+        self.assertEqual(build_id_list.get('0x5678'), binary_cache_dir / 'a' / 'b')
+        build_id_list.remove_path(binary_cache_dir / 'a' / 'b')
+        self.assertIsNone(build_id_list.get('0x5678'))
+        self.assertEqual(build_id_list.get(build_id),
+                         manual_dir / 'simpleperf_runtest_two_functions_arm64')
+
+    @unittest.skipIf(is_windows(), 'fake adb script needs a unix shell')
+    def test_pull_binaries_from_device(self):
+        # Use a fake adb, which accesses host files as files on device.
+        fake_adb, adb_log = create_fake_adb(self.test_dir)
+        device_dir = self.test_dir / 'device'
+        device_dir.mkdir()
+        readelf = ReadElf(TestHelper.ndk_path)
+        binaries = {}
+        for filename in ['simpleperf_runtest_two_functions_arm',
+                         'simpleperf_runtest_two_functions_arm64']:
+            shutil.copy(TestHelper.testdata_path(filename), device_dir)
+            binaries[str(device_dir / filename)] = readelf.get_build_id(device_dir / filename)
+        binaries[str(device_dir / 'not_exist')] = ''
+
+        def pull_binaries() -> List[str]:
+            source = BinarySourceFromDevice(readelf, disable_adb_root=True)
+            source.adb.adb_path = str(fake_adb)
+            # Log each shell cmd as an adb cmd.
+            source.adb.use_shell_session = False
+            remove(adb_log)
+            binary_cache = BinaryCache(Path('binary_cache'))
+            source.collect_binaries(binaries, binary_cache)
+            for path, build_id in binaries.items():
+                if build_id:
+                    self.assertTrue(filecmp.cmp(
+                        binary_cache.get_path_in_cache(path, build_id), path))
+            return adb_log.read_text().splitlines()
+
+        # Check files on device in one command, then pull them in one tar stream.
+        adb_cmds = [cmd.split()[:2] for cmd in pull_binaries()]
+        self.assertEqual(adb_cmds.count(['shell', 'for']), 1)
+        self.assertEqual(adb_cmds.count(['exec-out', 'tar']), 1)
+        self.assertNotIn('pull', [cmd[0] for cmd in adb_cmds])
+        # Files in binary_cache with matching build ids aren't pulled again.
+        adb_cmds = [cmd.split()[:2] for cmd in pull_binaries()]
+        self.assertEqual(adb_cmds.count(['shell', 'for']), 1)
+        self.assertEqual(adb_cmds.count(['exec-out', 'tar']), 0)
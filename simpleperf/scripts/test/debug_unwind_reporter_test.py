@@ -14,8 +14,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import shutil
 from typing import List
 
+from debug_unwind_reporter import ReportInput, ReportOutputSummary, read_sample_lines, split_file
+import debug_unwind_reporter
 from . test_utils import TestBase, TestHelper
 
 
@@ -66,3 +70,44 @@ class TestDebugUnwindReporter(TestBase):
             ['--include-sample-time', '626970513562864', '--show-callchain-fixed-by-joiner'])
         self.assertFalse('sample_time: 626968109563718' in output)
         self.assertTrue('sample_time: 626970513562864' in output)
+
+    def test_use_index_option(self):
+        report_file = 'debug_unwind_report.txt'
+        shutil.copy(TestHelper.testdata_dir / report_file, report_file)
+        for options in [[], ['--summary'], ['--include-error-code', '4',
+                                            '--show-callchain-fixed-by-joiner']]:
+            args = ['debug_unwind_reporter.py', '-i', report_file] + options
+            want = self.run_cmd(args, return_output=True)
+            # The first run builds the index, the second run uses it.
+            for _ in range(2):
+                got = self.run_cmd(args + ['--use-index'], return_output=True)
+                self.assertEqual(got, want)
+            self.assertTrue(os.path.isfile(report_file + '.index'))
+
+        # The index is rebuilt when the report file changes.
+        with open(report_file, 'a') as fh:
+            fh.write('sample_time: 1\nunwinding_error_code: 9\n\n')
+        output = self.run_cmd(['debug_unwind_reporter.py', '-i', report_file, '--use-index',
+                               '--include-sample-time', '1'], return_output=True)
+        self.assertIn('unwinding_error_code: 9', output)
+
+    def test_split_file_into_chunks(self):
+        report_file = str(TestHelper.testdata_dir / 'debug_unwind_report.txt')
+        want = [offset for offset, _, _ in read_sample_lines(report_file)]
+        old_chunk_size = debug_unwind_reporter.MIN_CHUNK_SIZE
+        debug_unwind_reporter.MIN_CHUNK_SIZE = 1000
+        try:
+            chunks = split_file(report_file, 8)
+        finally:
+            debug_unwind_reporter.MIN_CHUNK_SIZE = old_chunk_size
+        self.assertEqual(len(chunks), 8)
+        got = []
+        summary = ReportOutputSummary()
+        for start, end in chunks:
+            got += [offset for offset, _, _ in read_sample_lines(report_file, start, end)]
+            chunk_summary = ReportOutputSummary()
+            for sample in ReportInput().get_samples(report_file, start, end):
+                chunk_summary.report(sample)
+            summary.merge(chunk_summary)
+        self.assertEqual(got, want)
+        self.assertEqual(sum(summary.error_code_counter.values()), len(want))
@@ -27,7 +27,9 @@ It includes below tests:
 import argparse
 from dataclasses import dataclass
 import fnmatch
+import heapq
 import inspect
+import json
 import multiprocessing as mp
 import os
 from pathlib import Path
@@ -37,7 +39,7 @@ import sys
 import time
 from tqdm import tqdm
 import types
-from typing import List, Optional
+from typing import Dict, List, Optional
 import unittest
 
 from simpleperf_utils import BaseArgumentParser, extant_dir, log_exit, remove, is_darwin
@@ -58,6 +60,7 @@ from . purgatorio_test import *
 from . report_html_test import *
 from . report_lib_test import *
 from . report_sample_test import *
+from . report_top_functions_test import *
 from . run_simpleperf_on_device_test import *
 from . sample_filter_test import *
 from . stackcollapse_test import *
@@ -79,7 +82,16 @@ def get_args() -> argparse.Namespace:
     parser.add_argument('-r', '--repeat', type=int, default=1, help='times to repeat tests')
     parser.add_argument('--test-from', help='Run tests following the selected test.')
     parser.add_argument('--test-dir', default='test_dir', help='Directory to store test results')
-    return parser.parse_args()
+    parser.add_argument('--host-jobs', type=int, default=1, help="""
+        Run host tests in n processes in parallel. Tests are split by their durations in
+        --durations-file, if it is set.""")
+    parser.add_argument('--durations-file', help="""
+        A json file keeping test durations of previous runs, used to split host tests. It is
+        updated after running tests. Not used by default.""")
+    args = parser.parse_args()
+    if args.host_jobs < 1:
+        log_exit('Invalid --host-jobs option.')
+    return args
 
 
 def get_all_tests() -> List[str]:
@@ -130,12 +142,15 @@ def get_test_type(test: str) -> Optional[str]:
                          'TestBinaryCacheBuilder',
                          'TestDebugUnwindReporter',
                          'TestInferno',
+                         'TestNativeLibDownloaderWithFakeAdb',
+                         'TestParseFileFeature',
                          'TestPprofProtoGenerator',
                          'TestProtoFileReportLib',
                          'TestPurgatorio',
                          'TestReportHtml',
                          'TestReportLib',
                          'TestReportSample',
+                         'TestReportTopFunctions',
                          'TestSampleFilter',
                          'TestStackCollapse',
                          'TestTools',
@@ -144,6 +159,44 @@ def get_test_type(test: str) -> Optional[str]:
     return None
 
 
+def load_test_durations(path: Optional[Path]) -> Dict[str, float]:
+    """ Return test durations in seconds, recorded in previous runs. """
+    if path:
+        try:
+            with open(path, 'r') as fh:
+                return {test: float(duration) for test, duration in json.load(fh).items()}
+        except (OSError, ValueError, AttributeError):
+            pass
+    return {}
+
+
+def split_tests_by_duration(
+        tests: List[str],
+        durations: Dict[str, float],
+        count: int) -> List[List[str]]:
+    """ Split tests into at most count groups with similar total durations, using longest
+        processing time first scheduling. Tests without durations use the mean duration.
+        Tests in each group keep their original order.
+    """
+    count = min(count, len(tests))
+    if count <= 1:
+        return [tests]
+    known = [durations[test] for test in tests if test in durations]
+    default_duration = sum(known) / len(known) if known else 1.0
+    # (total duration, group index)
+    loads = [(0.0, i) for i in range(count)]
+    group_of_test: Dict[str, int] = {}
+    for test in sorted(tests, key=lambda test: durations.get(test, default_duration),
+                       reverse=True):
+        load, i = heapq.heappop(loads)
+        group_of_test[test] = i
+        heapq.heappush(loads, (load + durations.get(test, default_duration), i))
+    groups: List[List[str]] = [[] for _ in range(count)]
+    for test in tests:
+        groups[group_of_test[test]].append(test)
+    return groups
+
+
 def build_testdata(testdata_dir: Path):
     """ Collect testdata in testdata_dir.
         In system/extras/simpleperf/scripts, testdata comes from:
@@ -385,6 +438,13 @@ class TestSummary:
         if has_update:
             self.write_summary()
 
+    def get_host_test_durations(self) -> Dict[str, float]:
+        durations = {}
+        for (test, test_env), result in self.results.items():
+            if test_env == 'host' and result:
+                durations[test] = float(result.duration.rstrip('s'))
+        return durations
+
     def write_summary(self):
         with open('test_summary.txt', 'w') as fh, \
                 open('failed_test_summary.txt', 'w') as failed_fh:
@@ -404,6 +464,8 @@ class TestManager:
         self.repeat_count = args.repeat
         self.test_options = self._build_test_options(args)
         self.devices = self._build_test_devices(args)
+        self.host_jobs = args.host_jobs
+        self.durations_file = Path(args.durations_file) if args.durations_file else None
         self.progress_bar: Optional[ProgressBar] = None
         self.test_summary: Optional[TestSummary] = None
 
@@ -468,9 +530,24 @@ class TestManager:
             self.wait_for_test_results([test_proc], self.repeat_count)
 
     def run_host_tests(self, tests: List[str]):
-        """ Tests run only once on host. """
-        test_proc = TestProcess('host_tests', tests, None, 1, self.test_options)
-        self.wait_for_test_results([test_proc], 1)
+        """ Tests run only once on host. They can be split into multiple processes. """
+        groups = split_tests_by_duration(
+            tests, load_test_durations(self.durations_file), self.host_jobs)
+        if len(groups) == 1:
+            test_procs = [TestProcess('host_tests', tests, None, 1, self.test_options)]
+        else:
+            test_procs = [TestProcess('host_tests_%d' % i, group, None, 1, self.test_options)
+                          for i, group in enumerate(groups)]
+        self.wait_for_test_results(test_procs, 1)
+
+    def save_test_durations(self):
+        """ Add durations of host tests in this run to the durations file. """
+        if not self.durations_file:
+            return
+        durations = load_test_durations(self.durations_file)
+        durations.update(self.test_summary.get_host_test_durations())
+        with open(self.durations_file, 'w') as fh:
+            json.dump(durations, fh, indent=2, sort_keys=True)
 
     def wait_for_test_results(self, test_procs: List[TestProcess], repeat_count: int):
         test_count = sum(len(test_proc.tests) for test_proc in test_procs)
@@ -508,6 +585,7 @@ def run_tests_in_child_process(tests: List[str], args: argparse.Namespace) -> bo
     mp.set_start_method('spawn')  # to be consistent on darwin, linux, windows
     test_manager = TestManager(args)
     test_manager.run_all_tests(tests)
+    test_manager.save_test_durations()
 
     total_test_count = test_manager.test_summary.test_count
     failed_test_count = test_manager.test_summary.failed_test_count
@@ -528,6 +606,8 @@ def main() -> bool:
         print('\n'.join(tests))
         return True
 
+    if args.durations_file:
+        args.durations_file = str(Path(args.durations_file).resolve())
     test_dir = Path(args.test_dir).resolve()
     remove(test_dir)
     test_dir.mkdir(parents=True)
@@ -21,8 +21,15 @@ import re
 import tempfile
 from typing import Any, Dict, List, Set
 
+from inferno.data_types import Thread
+
 from . test_utils import INFERNO_SCRIPT, TestBase, TestHelper
 
+FakeSample = collections.namedtuple('FakeSample', ['thread_comm', 'period'])
+FakeSymbol = collections.namedtuple('FakeSymbol', ['symbol_name', 'dso_name'])
+FakeCallChainEntry = collections.namedtuple('FakeCallChainEntry', ['ip', 'symbol'])
+FakeCallChain = collections.namedtuple('FakeCallChain', ['nr', 'entries'])
+
 
 class TestInferno(TestBase):
     def get_report(self, options: List[str]) -> str:
@@ -90,3 +97,44 @@ class TestInferno(TestBase):
         self.assertNotIn(art_frame_str, report)
         report = self.get_report(options + ['--show-art-frames'])
         self.assertIn(art_frame_str, report)
+
+    def test_output_format(self):
+        options = ['--record_file', TestHelper.testdata_path('perf_display_bitmaps.data'), '-sc']
+        report = self.get_report(options + ['--output_format', 'canvas'])
+        self.assertIn('canvasFlamegraphInit', report)
+        self.assertIn('flamegraph_canvas', report)
+        self.assertNotIn('<svg', report)
+
+        self.run_cmd([INFERNO_SCRIPT, '--output_format', 'json', '-o', 'report.json'] + options)
+        with open('report.json', 'r') as fh:
+            data = json.load(fh)
+        self.assertIn(31850, [thread['tid'] for thread in data['threads']])
+        for thread in data['threads']:
+            nodes = thread['flamegraph']['nodes']
+            self.assertEqual(len(nodes) % 5, 0)
+            for string_id in nodes[3::5] + nodes[4::5]:
+                self.assertLess(string_id, len(data['strings']))
+
+    def test_deep_callchain(self):
+        thread = Thread(1, 1)
+        depth = 10000
+        entries = [FakeCallChainEntry(1, FakeSymbol('func%d' % i, 'libfoo.so'))
+                   for i in range(depth)]
+        thread.add_callchain(FakeCallChain(depth, entries), FakeSymbol('leaf', 'libfoo.so'),
+                             FakeSample('thread', 10))
+        thread.flamegraph.trim_callchain(0, 1000000000)
+        self.assertEqual(thread.flamegraph.get_max_depth(), depth + 2)
+        self.assertEqual(thread.flamegraph.generate_offset(0), 10)
+
+    def test_merge_narrow_call_sites(self):
+        thread = Thread(1, 1)
+        thread.add_callchain(FakeCallChain(0, []), FakeSymbol('wide', 'libfoo.so'),
+                             FakeSample('thread', 1000))
+        for i in range(100):
+            thread.add_callchain(FakeCallChain(0, []), FakeSymbol('narrow%d' % i, 'libfoo.so'),
+                                 FakeSample('thread', 1))
+        thread.flamegraph.trim_callchain(0, 1000000000, 10)
+        children = thread.flamegraph.children
+        self.assertEqual([c.method for c in children], ['wide', '[other]'])
+        self.assertEqual(children[1].num_events, 100)
+        self.assertEqual(children[1].dso, '100 merged call sites')
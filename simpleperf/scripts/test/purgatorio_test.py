@@ -50,3 +50,14 @@ class TestPurgatorio(TestBase):
         self.assertIn(art_frame_str, report)
         report = self.get_report(options + ['--no-show-art-frames'])
         self.assertNotIn(art_frame_str, report)
+
+    def test_time_resolution(self):
+        options = ['-i', TestHelper.testdata_path('perf_display_bitmaps.data')]
+        report = self.get_report(options + ['--time_resolution', '0'])
+        self.assertIn('callchain_ids', report)
+        self.assertIn('callchain_counts', report)
+        size_without_downsampling = len(report)
+        # Merging samples into 100ms buckets makes a smaller report.
+        report = self.get_report(options + ['--time_resolution', '100'])
+        self.assertLess(len(report), size_without_downsampling)
+        self.get_report(options + ['--no_webgl'])
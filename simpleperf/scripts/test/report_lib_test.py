@@ -14,15 +14,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import json
 import os
 from pathlib import Path
 import shutil
+import struct
 import subprocess
+import sys
 import tempfile
-from typing import Dict, List, Optional, Set
+from typing import Dict, List, Optional, Set, Tuple
 
-from simpleperf_report_lib import ReportLib, ProtoFileReportLib
-from simpleperf_utils import get_host_binary_path, ReadElf
+from simpleperf_report_lib import (DSO_DEX_FILE, parse_file_feature, ReportLib, ProtoFileReportLib,
+                                   RecordTimeIndex)
+from simpleperf_utils import get_host_binary_path, ReadElf, ReportLibOptions
 from . test_utils import TestBase, TestHelper
 
 
@@ -401,6 +406,48 @@ class TestReportLib(TestBase):
         self.assertEqual(symbol.symbol_addr, 0xffffffc008fb3e0c)
         self.assertEqual(symbol.symbol_len, 0x4c)
 
+    def test_get_dso_list(self):
+        self.report_lib.SetRecordFile(TestHelper.testdata_path('perf_with_add_counter.data'))
+        dso_list = self.report_lib.GetDsoList()
+        self.assertEqual([dso.path for dso in dso_list], [
+            '[kernel.kallsyms]', '/lib/x86_64-linux-gnu/ld-2.32.so', '/bin/sleep',
+            '/lib/x86_64-linux-gnu/libc-2.32.so'])
+        self.assertEqual(dso_list[2].build_id, '0xef54849d8b0d072d42f371d9c8459fd6de57c988')
+        self.assertTrue(all(dso.hit_count is None for dso in dso_list))
+
+        # Hit counts are the same as those collected by iterating samples.
+        hit_counts = collections.Counter()
+        while self.report_lib.GetNextSample():
+            dso_names = {self.report_lib.GetSymbolOfCurrentSample().dso_name}
+            callchain = self.report_lib.GetCallChainOfCurrentSample()
+            for i in range(callchain.nr):
+                dso_names.add(callchain.entries[i].symbol.dso_name)
+            hit_counts.update(dso_names)
+        report_lib = ReportLib()
+        report_lib.SetRecordFile(TestHelper.testdata_path('perf_with_add_counter.data'))
+        for dso in report_lib.GetDsoList(with_hit_counts=True):
+            self.assertEqual(dso.hit_count, hit_counts[dso.path])
+        report_lib.Close()
+
+
+class TestParseFileFeature(TestBase):
+    def test_parse_file_feature(self):
+        def file_msg(path: str, dso_type: int, symbol_count: int) -> bytes:
+            msg = path.encode() + b'\0' + struct.pack('<IQI', dso_type, 0, symbol_count)
+            msg += b''.join(struct.pack('<QII', 0, 1, 2) + b'f\0' for _ in range(symbol_count))
+            return struct.pack('<I', len(msg)) + msg
+
+        # Type 2 is DSO_ELF_FILE.
+        data = (file_msg('/system/lib64/libc.so', 2, 0) +
+                file_msg('/data/app/base.apk!/classes.dex', DSO_DEX_FILE, 0) +
+                file_msg('/data/app/base.apk!/classes2.dex', DSO_DEX_FILE, 1))
+        # Dex files without symbols are skipped only when symbols are dumped.
+        self.assertEqual(parse_file_feature(data, False), [
+            '/system/lib64/libc.so', '/data/app/base.apk!/classes2.dex'])
+        self.assertEqual(parse_file_feature(data, False, False), [
+            '/system/lib64/libc.so', '/data/app/base.apk!/classes.dex',
+            '/data/app/base.apk!/classes2.dex'])
+
 
 class TestProtoFileReportLib(TestBase):
     def test_smoke(self):
@@ -419,6 +466,272 @@ class TestProtoFileReportLib(TestBase):
             report_lib.GetCallChainOfCurrentSample()
         self.assertEqual(sample_count, 525)
 
+    def test_get_dso_list(self):
+        report_lib = ProtoFileReportLib()
+        report_lib.SetRecordFile(TestHelper.testdata_path('display_bitmaps.proto_data'))
+        hit_counts = collections.Counter()
+        while report_lib.GetNextSample():
+            dso_names = {report_lib.GetSymbolOfCurrentSample().dso_name}
+            callchain = report_lib.GetCallChainOfCurrentSample()
+            for i in range(callchain.nr):
+                dso_names.add(callchain.entries[i].symbol.dso_name)
+            hit_counts.update(dso_names)
+
+        dso_list = report_lib.GetDsoList(with_hit_counts=True)
+        self.assertEqual({dso.path for dso in dso_list}, set(hit_counts))
+        for dso in dso_list:
+            self.assertEqual(dso.hit_count, hit_counts[dso.path])
+        report_lib.Close()
+
+    def test_symbol_cache(self):
+        report_lib = ProtoFileReportLib()
+        report_lib.SetRecordFile(TestHelper.testdata_path('display_bitmaps.proto_data'))
+        symbols = {}
+        while report_lib.GetNextSample():
+            sample = report_lib.sample_queue[0]
+            callchain = report_lib.GetCallChainOfCurrentSample()
+            entry_symbols = [report_lib.GetSymbolOfCurrentSample()] + [
+                callchain.entries[i].symbol for i in range(callchain.nr)]
+            self.assertEqual(len(entry_symbols), len(sample.callchain))
+            for node, symbol in zip(sample.callchain, entry_symbols):
+                # Cached symbols are the same as symbols built without the cache.
+                self.assertEqual(symbol, report_lib._build_symbol(node))
+                key = (node.file_id, node.symbol_id, node.vaddr_in_file)
+                self.assertIs(symbols.setdefault(key, symbol), symbol)
+        self.assertEqual(len(report_lib.callchain_entries), len(symbols))
+        # Symbols in different files have different fake mappings.
+        mappings = {}
+        for symbol in symbols.values():
+            if symbol.symbol_name != 'unknown':
+                mappings.setdefault(symbol.mapping[0].start, set()).add(
+                    (symbol.dso_name, symbol.symbol_name))
+        self.assertTrue(all(len(names) == 1 for names in mappings.values()))
+        report_lib.Close()
+
+    def test_time_index(self):
+        shutil.copy(TestHelper.testdata_path('display_bitmaps.proto_data'), 'perf.proto_data')
+        filter_file = Path('filter_file')
+        filter_file.write_text('GLOBAL_BEGIN 684943449406175\nGLOBAL_END 684943516618526\n')
+
+        def get_samples() -> Tuple[List[Tuple[int, int, str]], int]:
+            """ Return samples passing the filter file, and the number of records read. """
+            report_lib = ProtoFileReportLib()
+            report_lib.SetRecordFile('perf.proto_data')
+            report_lib.SetSampleFilter(['--filter-file', str(filter_file)])
+            samples = []
+            while report_lib.GetNextSample():
+                sample = report_lib.GetCurrentSample()
+                samples.append((sample.time, sample.tid,
+                                report_lib.GetSymbolOfCurrentSample().symbol_name))
+            record_count = len(report_lib.records)
+            report_lib.Close()
+            return samples, record_count
+
+        samples, record_count = get_samples()
+        self.assertEqual(record_count, 525)
+        time_index = RecordTimeIndex.build('perf.proto_data')
+        self.assertIsNotNone(time_index.sample_region)
+        time_index.save('perf.proto_data')
+        # With the index, only records in the time range of the filter file are read.
+        indexed_samples, record_count = get_samples()
+        self.assertEqual(indexed_samples, samples)
+        self.assertLess(record_count, 525)
+        self.assertGreaterEqual(record_count, len(samples))
+
+        # A broken index is ignored.
+        index_path = Path(RecordTimeIndex.get_index_path('perf.proto_data'))
+        index_data = json.loads(index_path.read_text())
+        del index_data['histogram']
+        for broken_data in [index_path.read_text()[:100], json.dumps(index_data), '[]']:
+            index_path.write_text(broken_data)
+            self.assertIsNone(RecordTimeIndex.load('perf.proto_data'))
+            self.assertEqual(get_samples(), (samples, 525))
+
+    def test_set_sample_filter(self):
+        def get_threads_for_filter(filters: List[str]) -> Dict[int, int]:
+            report_lib = ProtoFileReportLib()
+            report_lib.SetRecordFile(TestHelper.testdata_path('display_bitmaps.proto_data'))
+            report_lib.SetSampleFilter(filters)
+            threads = collections.Counter()
+            while report_lib.GetNextSample():
+                threads[report_lib.GetCurrentSample().tid] += 1
+            report_lib.Close()
+            return threads
+
+        self.assertEqual(get_threads_for_filter(['--exclude-pid', '31850']), {})
+        self.assertEqual(sum(get_threads_for_filter(['--include-pid', '31850']).values()), 525)
+        self.assertNotIn(31881, get_threads_for_filter(['--exclude-tid', '31881']))
+        self.assertEqual(set(get_threads_for_filter(['--include-tid', '31881,31850'])),
+                         {31881, 31850})
+        self.assertEqual(get_threads_for_filter(
+            ['--exclude-process-name', 'com.example.android.displayingbitmaps']), {})
+        self.assertNotIn(31850, get_threads_for_filter(
+            ['--exclude-thread-name', 'com.example.android.displayingbitmaps']))
+        self.assertEqual(set(get_threads_for_filter(['--include-thread-name', 'AsyncTask'])),
+                         {31897, 31898})
+        # Check that thread name can have space.
+        self.assertEqual(set(get_threads_for_filter(
+            ['--include-thread-name', 'Jit thread pool'])), {31856})
+
+        Path('filter_file').write_text(
+            '// comment\nGLOBAL_BEGIN 684943449406175\nGLOBAL_END 684943449406176\n')
+        self.assertEqual(get_threads_for_filter(['--filter-file', 'filter_file']), {31881: 1})
+        Path('filter_file').write_text(
+            'THREAD_BEGIN 31850 0\nTHREAD_END 31850 684943583830876\n')
+        self.assertEqual(get_threads_for_filter(['--filter-file', 'filter_file']), {31850: 164})
+        Path('filter_file').write_text(
+            'PROCESS_BEGIN 31850 684943500000000\nPROCESS_END 31850 684943583830876\n')
+        threads = get_threads_for_filter(['--filter-file', 'filter_file'])
+        self.assertLess(sum(threads.values()), 525)
+        self.assertGreater(sum(threads.values()), 0)
+        # Like simpleperf, a range without an end extends to the end of the recording.
+        Path('filter_file').write_text('PROCESS_BEGIN 31850 684943500000000\n')
+        self.assertEqual(get_threads_for_filter(['--filter-file', 'filter_file']), threads)
+        # A repeated begin doesn't change the begin of the range.
+        Path('filter_file').write_text('GLOBAL_BEGIN 684943449406175\nGLOBAL_BEGIN 0\n' +
+                                       'GLOBAL_END 684943449406176\n')
+        self.assertEqual(get_threads_for_filter(['--filter-file', 'filter_file']), {31881: 1})
+        # A range should have begin < end.
+        Path('filter_file').write_text('GLOBAL_BEGIN 684943449406176\nGLOBAL_END 684943449406176\n')
+        with self.assertRaisesRegex(RuntimeError, 'invalid time range'):
+            get_threads_for_filter(['--filter-file', 'filter_file'])
+        # Timestamps in filter files can't be converted from realtime to monotonic.
+        Path('filter_file').write_text(
+            'CLOCK realtime\nGLOBAL_BEGIN 684943449406175\nGLOBAL_END 684943449406176\n')
+        with self.assertRaisesRegex(RuntimeError, 'only the monotonic clock is supported'):
+            get_threads_for_filter(['--filter-file', 'filter_file'])
+
+    def test_aggregate_threads(self):
+        report_lib = ProtoFileReportLib()
+        report_lib.SetRecordFile(TestHelper.testdata_path('display_bitmaps.proto_data'))
+        report_lib.AggregateThreads(['AsyncTask.*'])
+        thread_names = collections.Counter()
+        while sample := report_lib.GetNextSample():
+            thread_names[sample.thread_comm] += 1
+            if sample.thread_comm == 'AsyncTask.*':
+                self.assertIn(sample.tid, (31897, 31898))
+        report_lib.Close()
+        self.assertEqual(thread_names['AsyncTask.*'], 19)
+        self.assertNotIn('AsyncTask #3', thread_names)
+        self.assertNotIn('AsyncTask #4', thread_names)
+
+        # Like simpleperf, regexes should match whole thread names.
+        report_lib = ProtoFileReportLib()
+        report_lib.SetRecordFile(TestHelper.testdata_path('display_bitmaps.proto_data'))
+        report_lib.AggregateThreads(['AsyncTask'])
+        thread_names = collections.Counter()
+        while sample := report_lib.GetNextSample():
+            thread_names[sample.thread_comm] += 1
+        report_lib.Close()
+        self.assertNotIn('AsyncTask', thread_names)
+        self.assertIn('AsyncTask #3', thread_names)
+
+    def test_remove_method(self):
+        def get_methods(report_lib) -> Set[str]:
+            methods = set()
+            while report_lib.GetNextSample():
+                methods.add(report_lib.GetSymbolOfCurrentSample().symbol_name)
+                callchain = report_lib.GetCallChainOfCurrentSample()
+                for i in range(callchain.nr):
+                    methods.add(callchain.entries[i].symbol.symbol_name)
+            report_lib.Close()
+            return methods
+
+        report_lib = ProtoFileReportLib()
+        report_lib.SetRecordFile(TestHelper.testdata_path('display_bitmaps.proto_data'))
+        methods = get_methods(report_lib)
+        self.assertTrue(any(method.startswith('android.os.') for method in methods))
+        report_lib = ProtoFileReportLib()
+        report_lib.SetRecordFile(TestHelper.testdata_path('display_bitmaps.proto_data'))
+        report_lib.RemoveMethod(r'^android\.os\.')
+        new_methods = get_methods(report_lib)
+        self.assertEqual(new_methods, {m for m in methods if not m.startswith('android.os.')})
+
+    def test_synthetic_profile_generator(self):
+        generator = TestHelper.script_path('test/benchmarks/synthetic_profile_generator.py')
+
+        def generate(path: str, options: List[str]):
+            subprocess.check_call([sys.executable, generator, '-o', path] + options)
+
+        options = ['--samples', '500', '--threads', '6', '--processes', '3', '--dsos', '4',
+                   '--symbols-per-dso', '10', '--depth-distribution', 'fixed', '--depth', '5']
+        generate('1.proto_data', options)
+        generate('2.proto_data', options)
+        generate('3.proto_data', options + ['--seed', '1'])
+        # The output only depends on the options.
+        self.assertEqual(Path('1.proto_data').read_bytes(), Path('2.proto_data').read_bytes())
+        self.assertNotEqual(Path('1.proto_data').read_bytes(), Path('3.proto_data').read_bytes())
+
+        lib = ProtoFileReportLib()
+        lib.SetRecordFile('1.proto_data')
+        sample_count = 0
+        pids, tids, dsos = set(), set(), set()
+        while sample := lib.GetNextSample():
+            sample_count += 1
+            pids.add(sample.pid)
+            tids.add(sample.tid)
+            self.assertEqual(lib.GetCallChainOfCurrentSample().nr, 4)
+            dsos.add(lib.GetSymbolOfCurrentSample().dso_name)
+        self.assertEqual(sample_count, 500)
+        self.assertEqual(len(pids), 3)
+        self.assertEqual(len(tids), 6)
+        self.assertLessEqual(len(dsos), 4)
+
+        generate('offcpu.proto_data', ['--samples', '500', '--offcpu', '--offcpu-ratio', '0.5'])
+        lib = ProtoFileReportLib()
+        lib.SetRecordFile('offcpu.proto_data')
+        self.assertIn('off-cpu', lib.GetSupportedTraceOffCpuModes())
+        lib.SetTraceOffCpuMode('off-cpu')
+        offcpu_samples = 0
+        while lib.GetNextSample():
+            offcpu_samples += 1
+            self.assertEqual(lib.GetSymbolOfCurrentSample().symbol_name, '__schedule')
+        self.assertGreater(offcpu_samples, 100)
+        # Context switch records aren't counted as samples in the time index.
+        time_index = RecordTimeIndex.build('offcpu.proto_data')
+        self.assertEqual(time_index.sample_count, 500)
+        self.assertEqual(sum(bucket[0] for bucket in time_index.histogram.buckets.values()), 500)
+        self.assertIsNotNone(time_index.sample_region)
+
+    def test_downsampling(self):
+        def read_samples(**kwargs) -> List[tuple]:
+            report_lib = ProtoFileReportLib()
+            report_lib.SetRecordFile(TestHelper.testdata_path('display_bitmaps.proto_data'))
+            report_lib.SetReportOptions(ReportLibOptions(
+                False, None, None, None, None, None, **kwargs))
+            samples = []
+            while sample := report_lib.GetNextSample():
+                samples.append((sample.tid, sample.time, sample.period))
+            self.info = report_lib.GetDownsamplingInfo()
+            report_lib.Close()
+            return samples
+
+        all_samples = read_samples()
+        self.assertIsNone(self.info)
+        total_period = sum(s[2] for s in all_samples)
+
+        samples = read_samples(sample_rate=0.2)
+        # Downsampling is deterministic.
+        self.assertEqual(read_samples(sample_rate=0.2), samples)
+        self.assertLess(len(samples), len(all_samples) * 0.4)
+        self.assertTrue({(tid, time) for tid, time, _ in samples}.issubset(
+            {(tid, time) for tid, time, _ in all_samples}))
+        # Periods are scaled up to estimate the total period.
+        self.assertAlmostEqual(sum(s[2] for s in samples) / total_period, 1, delta=0.25)
+        self.assertEqual(self.info['samples_read'], len(all_samples))
+        self.assertEqual(self.info['samples_kept'], len(samples))
+        self.assertAlmostEqual(self.info['sampling_factor'], len(all_samples) / len(samples))
+        for function in self.info['top_functions']:
+            self.assertLessEqual(function['lower'], function['period'])
+            self.assertLessEqual(function['period'], function['upper'])
+
+        samples = read_samples(max_samples=100)
+        self.assertLess(abs(len(samples) - 100), 30)
+        # Stratified mode keeps samples of more threads than uniform mode.
+        uniform_tids = {s[0] for s in read_samples(max_samples=20)}
+        stratified_tids = {s[0] for s in read_samples(max_samples=20, sampling_mode='stratified')}
+        self.assertGreater(len(stratified_tids), len(uniform_tids))
+
     def convert_perf_data_to_proto_file(self, perf_data_path: str) -> str:
         simpleperf_path = get_host_binary_path('simpleperf')
         proto_file_path = 'perf.trace'
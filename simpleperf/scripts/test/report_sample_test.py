@@ -14,6 +14,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import os
 import re
 import tempfile
@@ -21,6 +22,7 @@ from typing import List, Optional, Set
 
 from . test_utils import TestBase, TestHelper
 from simpleperf_utils import remove
+from report_sample import read_binary_samples, TsvSampleWriter
 
 
 class TestReportSample(TestBase):
@@ -133,3 +135,77 @@ class TestReportSample(TestBase):
         report = self.get_record_data_string(
             'perf_with_interpreter_frames.data', ['--show-art-frames'])
         self.assertIn(art_frame_str, report)
+
+    def test_output_formats(self):
+        record_file = TestHelper.testdata_path('display_bitmaps.proto_data')
+        self.run_cmd(['report_sample.py', '-i', record_file, '--format', 'jsonl', '-o',
+                      'samples.jsonl'])
+        with open('samples.jsonl') as f:
+            samples = [json.loads(line) for line in f]
+        self.assertEqual(len(samples), 525)
+        self.assertEqual(samples[0]['thread_comm'], 'RenderThread')
+        self.assertEqual(samples[0]['time'], 684943449406175)
+
+        self.run_cmd(['report_sample.py', '-i', record_file, '--format', 'tsv', '-o',
+                      'samples.tsv'])
+        with open('samples.tsv') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0].split('\t'), TsvSampleWriter.COLUMNS)
+        self.assertEqual(len(lines), 1 + len(samples))
+        fields = lines[1].split('\t')
+        self.assertEqual(fields[:7], ['RenderThread', '31850', '31881', '0', '684943449406175',
+                                      '250000', 'cpu-clock'])
+        self.assertEqual(len(fields[7].split(';')), len(samples[0]['callchain']))
+
+        self.run_cmd(['report_sample.py', '-i', record_file, '--format', 'binary', '-o',
+                      'samples.bin'])
+        with open('samples.bin', 'rb') as f:
+            self.assertEqual(list(read_binary_samples(f)), samples)
+
+    def test_jobs(self):
+        want = self.get_record_data_string('perf_display_bitmaps.data')
+        got = self.get_record_data_string('perf_display_bitmaps.data', ['-j', '4'])
+        self.assertEqual(got, want)
+
+        # Each time shard resets the string table in binary format.
+        self.run_cmd(['report_sample.py', '-i',
+                      TestHelper.testdata_path('perf_display_bitmaps.data'), '--format',
+                      'binary', '-o', 'samples.bin'])
+        self.run_cmd(['report_sample.py', '-i',
+                      TestHelper.testdata_path('perf_display_bitmaps.data'), '--format',
+                      'binary', '-j', '4', '-o', 'samples_parallel.bin'])
+        with open('samples.bin', 'rb') as f:
+            want = list(read_binary_samples(f))
+        with open('samples_parallel.bin', 'rb') as f:
+            got = list(read_binary_samples(f))
+        self.assertEqual(got, want)
+
+    def test_jobs_with_max_samples(self):
+        record_file = TestHelper.testdata_path('display_bitmaps.proto_data')
+
+        def get_sample_times(options: List[str]) -> List[int]:
+            self.run_cmd(['report_sample.py', '-i', record_file, '--format', 'jsonl', '-o',
+                          'samples.jsonl', '--max-samples', '100'] + options)
+            with open('samples.jsonl') as f:
+                return [json.loads(line)['time'] for line in f]
+
+        want = get_sample_times([])
+        self.assertLess(abs(len(want) - 100), 30)
+        # All shards use the sample rate of the whole record file.
+        self.assertEqual(get_sample_times(['-j', '4']), want)
+
+    def test_profile_stages(self):
+        record_file = TestHelper.testdata_path('display_bitmaps.proto_data')
+        output = self.run_cmd(['report_sample.py', '-i', record_file, '-o', 'samples.txt',
+                               '--profile-stages', 'json', '--profile-stages-output',
+                               'stages.json', '--profile-stages-tracemalloc'], return_output=True)
+        self.assertEqual(output, '')
+        with open('stages.json') as f:
+            summary = json.load(f)
+        self.assertEqual(list(summary['stages']),
+                         ['open record file', 'read samples', 'write samples'])
+        self.assertEqual(summary['stages']['write samples']['calls'], 525)
+        self.assertEqual(summary['counters']['samples']['count'], 525)
+        self.assertEqual(summary['counters']['unique callchains']['count'], 58)
+        self.assertGreater(summary['counters']['frames']['count'], 525)
+        self.assertGreater(summary['peak_memory_bytes'], 0)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2024 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import collections
+import json
+import subprocess
+import sys
+from typing import Any, Dict, List, Tuple
+
+from simpleperf_report_lib import ProtoFileReportLib
+from . test_utils import TestBase, TestHelper
+
+
+class TestReportTopFunctions(TestBase):
+    def get_report(self, options: List[str]) -> List[Dict[str, Any]]:
+        args = ['report_top_functions.py', '--json'] + options
+        return json.loads(self.run_cmd(args, return_output=True))
+
+    def get_exact_self_periods(self, record_file: str) -> Dict[Tuple[str, str], int]:
+        periods = collections.Counter()
+        lib = ProtoFileReportLib()
+        lib.SetRecordFile(record_file)
+        while lib.GetNextSample():
+            symbol = lib.GetSymbolOfCurrentSample()
+            periods[(symbol.dso_name, symbol.symbol_name)] += lib.GetCurrentSample().period
+        lib.Close()
+        return periods
+
+    def test_report(self):
+        record_file = TestHelper.testdata_path('display_bitmaps.proto_data')
+        report = self.get_report(['-i', record_file, '--top', '3'])
+        self.assertEqual(len(report), 1)
+        group = report[0]
+        self.assertEqual(group['event_name'], 'cpu-clock')
+        self.assertEqual(group['sample_count'], 525)
+        self.assertEqual(group['event_count'], 131250000)
+        exact_periods = self.get_exact_self_periods(record_file)
+        for function in group['self']['functions']:
+            exact_period = exact_periods[(function['dso'], function['symbol'])]
+            self.assertEqual(function['period'], exact_period)
+            self.assertEqual(function['error'], 0)
+            self.assertTrue(function['guaranteed'])
+        self.assertEqual(len(group['children']['functions']), 3)
+
+        report = self.get_report(['-i', record_file, '--per-process'])
+        # Processes are named after their main threads, even when other threads are seen first.
+        self.assertEqual({group['process_name'] for group in report},
+                         {'com.example.android.displayingbitmaps'})
+        self.assertEqual(sum(group['event_count'] for group in report), 131250000)
+
+        generator = TestHelper.script_path('test/benchmarks/synthetic_profile_generator.py')
+        subprocess.check_call([sys.executable, generator, '-o', 'synthetic.proto_data',
+                               '--samples', '500', '--processes', '3', '--threads', '9'])
+        report = self.get_report(['-i', 'synthetic.proto_data', '--per-process'])
+        self.assertEqual({group['process_name'] for group in report},
+                         {'com.example.synthetic0', 'com.example.synthetic1',
+                          'com.example.synthetic2'})
+        report = self.get_report(['-i', 'synthetic.proto_data', '--per-process',
+                                  '--max-processes', '2'])
+        self.assertEqual(len(report), 3)
+        self.assertIn('[other processes]', {group['process_name'] for group in report})
+        self.assertEqual(sum(group['sample_count'] for group in report), 500)
+
+    def test_error_bounds(self):
+        record_file = TestHelper.testdata_path('display_bitmaps.proto_data')
+        exact_periods = self.get_exact_self_periods(record_file)
+        # With the default capacity, the sketch keeps all functions, and periods are exact. With
+        # a small capacity, functions are evicted from the sketch.
+        for capacity in ['1000', '8']:
+            report = self.get_report(['-i', record_file, '--top', '3', '--capacity', capacity])
+            top = report[0]['self']
+            reported = set()
+            for function in top['functions']:
+                reported.add((function['dso'], function['symbol']))
+                exact_period = exact_periods[(function['dso'], function['symbol'])]
+                self.assertLessEqual(function['period'] - function['error'], exact_period)
+                self.assertGreaterEqual(function['period'], exact_period)
+            # Functions not reported include ones ranked after top 3 in the sketch.
+            unlisted_periods = [period for function, period in exact_periods.items()
+                                if function not in reported]
+            self.assertLessEqual(max(unlisted_periods), top['unlisted_bound'])
+            if capacity == '1000':
+                self.assertEqual(max(unlisted_periods), top['unlisted_bound'])
+            # Event counts are exact.
+            self.assertEqual(report[0]['event_count'], 131250000)
+
+    def test_merge_sketches(self):
+        record_file = TestHelper.testdata_path('display_bitmaps.proto_data')
+        self.run_cmd(['report_top_functions.py', '-i', record_file,
+                      '--sketch-output', 'sketch.json'])
+        report = self.get_report(['--sketch-input', 'sketch.json', 'sketch.json',
+                                  '-i', record_file, record_file, '-j', '2'])
+        group = report[0]
+        self.assertEqual(group['sample_count'], 4 * 525)
+        self.assertEqual(group['event_count'], 4 * 131250000)
+        exact_periods = self.get_exact_self_periods(record_file)
+        for function in group['self']['functions']:
+            exact_period = exact_periods[(function['dso'], function['symbol'])]
+            self.assertEqual(function['period'], 4 * exact_period)
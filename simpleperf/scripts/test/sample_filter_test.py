@@ -18,9 +18,11 @@ import json
 import os
 from pathlib import Path
 import re
+import shutil
 import tempfile
-from typing import List, Optional, Set
+from typing import List, Optional, Set, Tuple
 
+from simpleperf_report_lib import ProtoFileReportLib
 from . test_utils import TestBase, TestHelper
 
 
@@ -40,3 +42,62 @@ class TestSampleFilter(TestBase):
         part2_data = Path('sample_filter_part2').read_text()
         self.assertIn('GLOBAL_BEGIN 684943516618526', part2_data)
         self.assertIn('GLOBAL_END 684943583830876', part2_data)
+
+    def test_time_index(self):
+        shutil.copy(TestHelper.testdata_path('display_bitmaps.proto_data'), 'perf.proto_data')
+        self.run_cmd(['sample_filter.py', '-i', 'perf.proto_data', '--build-time-index'])
+        index_data = json.loads(Path('perf.proto_data.time_index').read_text())
+        self.assertEqual(index_data['sample_count'], 525)
+        self.assertEqual(index_data['min_timestamp'], 684943449406175)
+        self.assertEqual(index_data['max_timestamp'], 684943583830875)
+        self.assertEqual(index_data['thread_sample_counts']['31881'], 271)
+
+        output = self.run_cmd(['sample_filter.py', '-i', 'perf.proto_data',
+                               '--show-time-range'], return_output=True)
+        self.assertIn('0.134 s', output)
+        self.run_cmd(['sample_filter.py', '-i', 'perf.proto_data', '--split-time-range', '2'])
+        part1_data = Path('sample_filter_part1').read_text()
+        self.assertIn('GLOBAL_BEGIN 684943449406175', part1_data)
+        self.assertIn('GLOBAL_END 684943516618526', part1_data)
+
+        # The index is ignored after the recording file changes.
+        index_data['min_timestamp'] = 0
+        Path('perf.proto_data.time_index').write_text(json.dumps(index_data))
+        output = self.run_cmd(['sample_filter.py', '-i', 'perf.proto_data',
+                               '--show-time-range'], return_output=True)
+        self.assertNotIn('0.134 s', output)
+        os.utime('perf.proto_data', ns=(0, 0))
+        output = self.run_cmd(['sample_filter.py', '-i', 'perf.proto_data',
+                               '--show-time-range'], return_output=True)
+        self.assertIn('0.134 s', output)
+
+    def test_split_by_samples_and_cost(self):
+        shutil.copy(TestHelper.testdata_path('display_bitmaps.proto_data'), 'perf.proto_data')
+
+        def get_part_stats(split_by: str) -> List[Tuple[int, int]]:
+            """ Return (sample count, cost) of each part. """
+            self.run_cmd(['sample_filter.py', '-i', 'perf.proto_data', '--split-time-range', '4',
+                          '--split-by', split_by, '-o', split_by])
+            stats = []
+            for i in range(4):
+                report_lib = ProtoFileReportLib()
+                report_lib.SetRecordFile('perf.proto_data')
+                report_lib.SetSampleFilter(['--filter-file', '%s_part%d' % (split_by, i + 1)])
+                sample_count = cost = 0
+                while report_lib.GetNextSample():
+                    sample_count += 1
+                    cost += report_lib.GetCallChainOfCurrentSample().nr + 1
+                report_lib.Close()
+                stats.append((sample_count, cost))
+            return stats
+
+        stats = get_part_stats('samples')
+        self.assertEqual(sum(s[0] for s in stats), 525)
+        for sample_count, _ in stats:
+            self.assertAlmostEqual(sample_count, 525 / 4, delta=525 * 0.05)
+        time_stats = get_part_stats('time')
+        self.assertEqual(sum(s[1] for s in time_stats), sum(s[1] for s in stats))
+        total_cost = sum(s[1] for s in time_stats)
+        for _, cost in get_part_stats('cost'):
+            self.assertAlmostEqual(cost, total_cost / 4, delta=total_cost * 0.05)
+        self.assertIn('split by cost', Path('cost_part1').read_text())
@@ -34,6 +34,60 @@ from simpleperf_utils import remove, get_script_dir, AdbHelper, is_windows, byte
 INFERNO_SCRIPT = str(Path(__file__).parents[1] / ('inferno.bat' if is_windows() else 'inferno.sh'))
 
 
+FAKE_ADB_SCRIPT = """#!{python}
+import shutil
+import subprocess
+import sys
+
+DEVICE_ROOT = {device_root!r}
+
+
+def to_host_path(s):
+    # Map paths under /data/local/tmp on device into DEVICE_ROOT on host.
+    return s.replace('/data/local/tmp', DEVICE_ROOT + '/data/local/tmp') if DEVICE_ROOT else s
+
+
+with open({log_path!r}, 'a') as fh:
+    fh.write(' '.join(sys.argv[1:]) + '\\n')
+args = sys.argv[1:]
+if args[0] == 'version':
+    print('Android Debug Bridge version 1.0.41')
+elif args == ['shell']:
+    # Interactive shell reading cmds from stdin.
+    proc = subprocess.Popen(['sh'], stdin=subprocess.PIPE, text=True)
+    for line in sys.stdin:
+        proc.stdin.write(to_host_path(line))
+        proc.stdin.flush()
+    proc.stdin.close()
+    sys.exit(proc.wait())
+elif args[0] in ('shell', 'exec-out'):
+    if args[1:] == ['whoami']:
+        print('shell')
+    else:
+        sys.exit(subprocess.call(['sh', '-c', to_host_path(' '.join(args[1:]))]))
+elif args[0] == 'pull':
+    shutil.copy(to_host_path(args[1]), args[2])
+elif args[0] == 'push':
+    shutil.copy(args[1], to_host_path(args[2]))
+else:
+    sys.exit(1)
+"""
+
+
+def create_fake_adb(dir_path: Path, device_root: Optional[Path] = None) -> Tuple[Path, Path]:
+    """ Create a fake adb script, which runs device commands on host. Paths under
+        /data/local/tmp on device are mapped into device_root if it is set.
+        Return (path of the fake adb, path of a log file recording adb args).
+    """
+    adb_path = dir_path / 'fake_adb'
+    log_path = dir_path / 'adb.log'
+    adb_path.write_text(FAKE_ADB_SCRIPT.format(
+        python=sys.executable, device_root=str(device_root) if device_root else '',
+        log_path=str(log_path)))
+    adb_path.chmod(0o755)
+    return adb_path, log_path
+
+
 class TestHelper:
     """ Keep global test options. """
 
@@ -54,6 +108,9 @@ class TestHelper:
         cls.browser_option = [] if use_browser else ['--no_browser']
         cls.ndk_path = ndk_path
         cls.progress_conn = progress_conn
+        # Keep found tool paths in the test dir, instead of the user's cache dir. Scripts run by
+        # tests inherit it.
+        os.environ['SIMPLEPERF_TOOL_CACHE'] = str(cls.test_base_dir / 'tool_paths.json')
 
         # Logs can come from multiple processes. So use append mode to avoid overwrite.
         cls.log_fh = open(cls.test_base_dir / 'test.log', 'a')
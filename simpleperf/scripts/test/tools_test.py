@@ -15,13 +15,20 @@
 # limitations under the License.
 
 import io
+import json
 import os
 from pathlib import Path
+import re
+import subprocess
+import sys
+import unittest
 
 from binary_cache_builder import BinaryCacheBuilder
-from simpleperf_utils import (Addr2Nearestline, AddrRange, BinaryFinder, Disassembly, Objdump,
-                              ReadElf, SourceFileSearcher, is_windows, remove)
-from . test_utils import TestBase, TestHelper
+import simpleperf_utils
+from simpleperf_utils import (AdbHelper, Addr2Nearestline, AddrRange, BinaryFinder, Disassembly,
+                              Objdump, ReadElf, SourceFileSearcher, ToolFinder, is_windows,
+                              remove)
+from . test_utils import create_fake_adb, TestBase, TestHelper
 
 
 class TestTools(TestBase):
@@ -437,3 +444,147 @@ ffffffc0089bbb34:      	stp	x29, x30, [sp, #-0x30]!
         # The binary should has a matched build id.
         path = binary_finder.find_binary('/' + elf_name, 'wrong_build_id')
         self.assertIsNone(path)
+
+    @unittest.skipIf(is_windows(), 'fake adb script needs a unix shell')
+    def test_adb_shell_session(self):
+        fake_adb, adb_log = create_fake_adb(self.test_dir)
+        # Add a fake getprop cmd.
+        bin_dir = self.test_dir / 'bin'
+        bin_dir.mkdir()
+        getprop = bin_dir / 'getprop'
+        getprop.write_text('#!/bin/sh\necho "[ro.build.version.codename]: [REL]"\n' +
+                           'echo "[ro.build.version.release]: [14]"\n')
+        getprop.chmod(0o755)
+        old_path = os.environ['PATH']
+        os.environ['PATH'] = str(bin_dir) + os.pathsep + old_path
+        try:
+            adb = AdbHelper()
+            adb.adb_path = str(fake_adb)
+            self.assertEqual(adb.run_and_return_output(['shell', 'echo', 'hello']),
+                             (True, 'hello\n'))
+            self.assertEqual(adb.run_and_return_output(['shell', 'printf', 'no_newline']),
+                             (True, 'no_newline'))
+            self.assertFalse(adb.run(['shell', 'false']))
+            self.assertEqual(adb.run_shell_cmds(['echo a', 'exit 3', 'echo b']),
+                             [(True, 'a\n'), (False, ''), (True, 'b\n')])
+            self.assertEqual(adb.get_properties(['ro.build.version.release', 'not_exist']),
+                             {'ro.build.version.release': '14', 'not_exist': ''})
+            self.assertEqual(adb.get_android_version(), 14)
+            # All shell cmds run in one adb process.
+            self.assertEqual(adb_log.read_text().splitlines(), ['shell'])
+
+            # Fall back to running an adb process for each cmd when the session is broken.
+            adb.shell_session.proc.kill()
+            adb.shell_session.proc.wait()
+            self.assertEqual(adb.run_and_return_output(['shell', 'echo', 'hello']),
+                             (True, 'hello\n'))
+            self.assertEqual(adb_log.read_text().splitlines()[-1], 'shell echo hello')
+            adb.close_shell_session()
+        finally:
+            os.environ['PATH'] = old_path
+
+    def test_tool_finder_cache(self):
+        cache_path = self.test_dir / 'tool_paths.json'
+        old_cache_env = os.environ.get('SIMPLEPERF_TOOL_CACHE')
+        os.environ['SIMPLEPERF_TOOL_CACHE'] = str(cache_path)
+        probed_tools = []
+        is_executable_available = simpleperf_utils.is_executable_available
+
+        def counting_is_executable_available(executable, option='--help'):
+            probed_tools.append(executable)
+            return is_executable_available(executable, option)
+
+        def find_readelf() -> str:
+            # Reload the cache file, like a new process.
+            ToolFinder._cache = None
+            probed_tools.clear()
+            return ToolFinder.find_tool_path('llvm-readelf', TestHelper.ndk_path)
+
+        simpleperf_utils.is_executable_available = counting_is_executable_available
+        try:
+            path = find_readelf()
+            self.assertTrue(path)
+            self.assertTrue(probed_tools)
+            self.assertTrue(cache_path.is_file())
+            # Use the cached path without probing.
+            self.assertEqual(find_readelf(), path)
+            self.assertEqual(probed_tools, [])
+            # Probe again when the tool mtime changes.
+            data = json.loads(cache_path.read_text())
+            for entry in data['tools'].values():
+                entry[1] -= 1
+            cache_path.write_text(json.dumps(data))
+            self.assertEqual(find_readelf(), path)
+            self.assertTrue(probed_tools)
+        finally:
+            simpleperf_utils.is_executable_available = is_executable_available
+            ToolFinder._cache = None
+            if old_cache_env is None:
+                del os.environ['SIMPLEPERF_TOOL_CACHE']
+            else:
+                os.environ['SIMPLEPERF_TOOL_CACHE'] = old_cache_env
+
+    def test_find_tools_lazily(self):
+        readelf = ReadElf('ndk_path_not_used_until_needed')
+        self.assertIsNone(readelf._readelf_path)
+        self.assertTrue(readelf.readelf_path)
+
+    def test_lazy_imports(self):
+        # Heavy modules shouldn't be imported when only showing help messages.
+        for script in ['pprof_proto_generator.py', 'purgatorio/purgatorio.py', 'report_sample.py']:
+            proc = subprocess.run(
+                [sys.executable, '-X', 'importtime', TestHelper.script_path(script), '--help'],
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+            self.assertEqual(proc.returncode, 0)
+            for module in ['bokeh', 'google.protobuf', 'jinja2', 'pandas', 'tarfile']:
+                self.assertNotRegex(proc.stderr, r'\| +%s(\.|\n)' % re.escape(module))
+
+    def test_converter_benchmark(self):
+        benchmark = TestHelper.script_path('test/benchmarks/converter_benchmark.py')
+        args = [sys.executable, benchmark, '--converters', 'stackcollapse.py', '--inputs',
+                'display_bitmaps.proto_data', '--synthetic-scales', '2', '--synthetic-samples',
+                '1000', '-n', '1']
+        subprocess.check_call(args + ['--json', 'baseline.json'], stdout=subprocess.DEVNULL)
+        results = json.loads(Path('baseline.json').read_text())['results']
+        result = results['stackcollapse.py:synthetic_x2.proto_data']
+        self.assertTrue(result['ok'])
+        self.assertEqual(result['sample_count'], 2 * 525)
+        for field in ['wall_time_ms', 'samples_per_sec', 'peak_rss_kb', 'output_size']:
+            self.assertGreater(result[field], 0)
+        generated_result = results['stackcollapse.py:synthetic_1000.proto_data']
+        self.assertTrue(generated_result['ok'])
+        self.assertEqual(generated_result['sample_count'], 1000)
+
+        # Fail when a result regresses more than thresholds.
+        result['output_size'] //= 2
+        Path('baseline.json').write_text(json.dumps({'results': results}))
+        proc = subprocess.run(args + ['--baseline', 'baseline.json', '--time-threshold', '100',
+                                      '--rss-threshold', '100'], stdout=subprocess.PIPE, text=True)
+        self.assertEqual(proc.returncode, 1)
+        self.assertIn('stackcollapse.py:synthetic_x2.proto_data: output_size', proc.stdout)
+
+        # Fail when a run succeeded in the baseline, but fails now. Runs failing in both are
+        # skipped.
+        Path('bad.proto_data').write_bytes(b'not a recording file')
+        args = [sys.executable, benchmark, '--converters', 'stackcollapse.py', '--inputs',
+                'bad.proto_data', '--synthetic-scales', '--synthetic-samples', '-n', '1',
+                '--baseline', 'baseline.json']
+        for base_ok, returncode in [(True, 1), (False, 0)]:
+            base_result = dict(result, ok=True) if base_ok else {'ok': False}
+            Path('baseline.json').write_text(json.dumps(
+                {'results': {'stackcollapse.py:bad.proto_data': base_result}}))
+            proc = subprocess.run(args, stdout=subprocess.PIPE, text=True)
+            self.assertEqual(proc.returncode, returncode)
+            self.assertEqual('stackcollapse.py:bad.proto_data: failed' in proc.stdout, base_ok)
+
+    def test_split_tests_by_duration(self):
+        from . do_test import split_tests_by_duration
+        tests = ['a', 'b', 'c', 'd', 'e']
+        durations = {'a': 1, 'b': 7, 'c': 4, 'd': 3}
+        groups = split_tests_by_duration(tests, durations, 2)
+        # The longest tests are placed first. 'e' uses the mean duration.
+        self.assertEqual(groups, [['b', 'd'], ['a', 'c', 'e']])
+        self.assertEqual(split_tests_by_duration(tests, {}, 1), [tests])
+        groups = split_tests_by_duration(tests, {}, 10)
+        self.assertEqual(sorted(sum(groups, [])), tests)
+        self.assertEqual(len(groups), 5)